@@ -0,0 +1,231 @@
+"""Measure encoding throughput for every codec and album art mode.
+
+Every configuration encodes all files of a corpus (see benchmarks.corpus) one after
+another in a separate interpreter, so that peak memory usage of the child processes
+can be attributed to it.
+
+    python -m benchmarks.bench_encode /tmp/flacmirror-corpus --output results.json
+    python -m benchmarks.bench_encode /tmp/flacmirror-corpus --compare results.json
+    python -m benchmarks.bench_encode /tmp/flacmirror-corpus --native-parity
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional
+
+from flacmirror import native, ogg
+from flacmirror.albumart import AlbumArtCache
+from flacmirror.encode import encode_flac
+from flacmirror.metadata import read_metadata
+from flacmirror.metrics import metrics
+from flacmirror.processes import check_requirements
+
+from .common import environment, make_options, write_results
+
+CODECS = ["opus", "vorbis", "aac", "mp3"]
+ALBUMART_MODES = ["optimize", "resize", "keep", "discard"]
+SUFFIXES = {"opus": ".opus", "vorbis": ".ogg", "aac": ".m4a", "mp3": ".mp3"}
+
+
+def run_config(
+    corpus_dir: Path, codec: str, albumart: str, backend: str = "process"
+) -> Dict[str, Any]:
+    files = sorted((corpus_dir / "flac").glob("*.flac"))
+    audio_seconds = sum(
+        read_metadata(file, pictures=False).streaminfo.duration for file in files
+    )
+    metrics.reset()
+    with TemporaryDirectory() as tmp_dir:
+        options = make_options(
+            corpus_dir,
+            Path(tmp_dir),
+            codec=codec,
+            albumart=albumart,
+            encoder_backend=backend,
+        )
+        art_cache = AlbumArtCache()
+        start = time.perf_counter()
+        for file in files:
+            output = Path(tmp_dir) / (file.stem + SUFFIXES[codec])
+            encode_flac(file, output, options, art_cache)
+        wall = time.perf_counter() - start
+        output_bytes = sum(file.stat().st_size for file in Path(tmp_dir).iterdir())
+    # ru_maxrss is in KiB on Linux
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # The native backend encodes in this process
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "codec": codec,
+        "albumart": albumart,
+        "backend": backend,
+        "tracks": len(files),
+        "audio_seconds": audio_seconds,
+        "wall_seconds": wall,
+        "cpu_seconds": children.ru_utime + children.ru_stime,
+        "own_cpu_seconds": own.ru_utime + own.ru_stime,
+        "tracks_per_second": len(files) / wall,
+        "realtime_factor": audio_seconds / wall,
+        "peak_child_rss_mb": children.ru_maxrss / 1024,
+        "processes_spawned": metrics.counters.get("processes_spawned", 0),
+        "output_mb": output_bytes / 1e6,
+    }
+
+
+def run_config_isolated(
+    corpus_dir: Path, codec: str, albumart: str, backend: str
+) -> Dict[str, Any]:
+    args = [
+        sys.executable,
+        "-m",
+        "benchmarks.bench_encode",
+        str(corpus_dir),
+        "--backend",
+        backend,
+        "--single",
+        codec,
+        albumart,
+    ]
+    results = subprocess.run(args, check=True, capture_output=True)
+    return json.loads(results.stdout)
+
+
+def opus_audio(file: Path) -> bytes:
+    """The packets of the audio pages of an opus file, without the headers"""
+    data = file.read_bytes()
+    audio = []
+    offset = 0
+    while offset < len(data):
+        page = ogg.read_page(data, offset)
+        # Header pages have the granule position 0
+        if page.granule != 0:
+            audio.append(page.body)
+        offset += page.size
+    return b"".join(audio)
+
+
+def native_parity(corpus_dir: Path) -> List[Dict[str, Any]]:
+    """Encode every file with opusenc and the native backend and compare the audio.
+
+    libopusenc is the library opusenc is built on, so the audio packets are the
+    same if the native backend passes the same samples with the same settings.
+    """
+    results = []
+    with TemporaryDirectory() as tmp_dir:
+        for file in sorted((corpus_dir / "flac").glob("*.flac")):
+            streaminfo = read_metadata(file, pictures=False).streaminfo
+            result: Dict[str, Any] = {
+                "file": file.name,
+                "bits_per_sample": streaminfo.bits_per_sample,
+                "audio_seconds": streaminfo.duration,
+            }
+            outputs = []
+            for backend in ["process", "native"]:
+                options = make_options(
+                    corpus_dir,
+                    Path(tmp_dir),
+                    albumart="discard",
+                    encoder_backend=backend,
+                )
+                output = Path(tmp_dir) / f"{file.stem}.{backend}.opus"
+                start = time.perf_counter()
+                encode_flac(file, output, options)
+                result[f"{backend}_seconds"] = time.perf_counter() - start
+                outputs.append(opus_audio(output))
+            result["identical_audio"] = outputs[0] == outputs[1]
+            results.append(result)
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]]):
+    baseline_configs = {(r["codec"], r["albumart"]): r for r in baseline}
+    print(f"{'config':<20} {'tracks/s':>10} {'before':>10} {'change':>8}")
+    for result in results:
+        old = baseline_configs.get((result["codec"], result["albumart"]))
+        config = f"{result['codec']}/{result['albumart']}"
+        if old is None:
+            print(f"{config:<20} {result['tracks_per_second']:>10.2f}")
+            continue
+        change = result["tracks_per_second"] / old["tracks_per_second"] - 1
+        print(
+            f"{config:<20} {result['tracks_per_second']:>10.2f}"
+            f" {old['tracks_per_second']:>10.2f} {change:>+8.1%}"
+        )
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument("corpus", help="Directory created by benchmarks.corpus")
+    argparser.add_argument("--codec", action="append", choices=CODECS)
+    argparser.add_argument("--albumart", action="append", choices=ALBUMART_MODES)
+    argparser.add_argument("--output", help="Write results to this json file")
+    argparser.add_argument("--compare", help="Compare to an earlier results file")
+    argparser.add_argument(
+        "--backend",
+        choices=["process", "native"],
+        default="process",
+        help="Value of --encoder-backend",
+    )
+    argparser.add_argument(
+        "--native-parity",
+        action="store_true",
+        help="Compare the audio and speed of the native opus encoder with opusenc",
+    )
+    argparser.add_argument("--single", nargs=2, help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+    corpus_dir = Path(args.corpus)
+
+    if args.native_parity:
+        if not native.available("opus"):
+            sys.exit("libFLAC or libopusenc not found")
+        results = native_parity(corpus_dir)
+        for result in results:
+            overhead = result["native_seconds"] / result["process_seconds"] - 1
+            print(
+                f"{result['file']} ({result['bits_per_sample']} bit):"
+                f" {'identical' if result['identical_audio'] else 'different'} audio,"
+                f" opusenc {result['process_seconds']:.2f} s,"
+                f" native {result['native_seconds']:.2f} s ({overhead:+.1%})"
+            )
+        if args.output is not None:
+            write_results(
+                Path(args.output), {"environment": environment(), "results": results}
+            )
+        return
+
+    if args.single is not None:
+        print(json.dumps(run_config(corpus_dir, *args.single, args.backend)))
+        return
+
+    results = []
+    for codec in args.codec or CODECS:
+        for albumart in args.albumart or ALBUMART_MODES:
+            if not check_requirements(
+                make_options(corpus_dir, corpus_dir, codec=codec, albumart=albumart)
+            ):
+                print(f"Skipping {codec}/{albumart}, requirements not met")
+                continue
+            result = run_config_isolated(corpus_dir, codec, albumart, args.backend)
+            print(
+                f"{codec}/{albumart}: {result['tracks_per_second']:.2f} tracks/s,"
+                f" {result['realtime_factor']:.1f}x realtime,"
+                f" {result['peak_child_rss_mb']:.1f} MB peak child RSS,"
+                f" {result['processes_spawned']} processes"
+            )
+            results.append(result)
+
+    output: Optional[str] = args.output
+    if output is not None:
+        write_results(Path(output), {"environment": environment(), "results": results})
+    if args.compare is not None:
+        baseline = json.loads(Path(args.compare).read_text())["results"]
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
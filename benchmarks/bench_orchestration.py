@@ -0,0 +1,244 @@
+"""Measure the orchestration overhead of flacmirror on very large trees.
+
+All external programs are replaced by tiny shell scripts on PATH that only create
+their output files, so check_requirements and the Process classes run unchanged but
+encoding costs nothing. This shows how scanning, job generation and scheduling scale
+with the number of files.
+
+    python -m benchmarks.bench_orchestration --files 10000 100000 1000000
+"""
+
+import argparse
+import io
+import os
+import resource
+import shutil
+import stat
+import struct
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from flacmirror.files import scan_files
+from flacmirror.metrics import metrics
+from flacmirror.processes import check_requirements
+from flacmirror.queue import JobQueue
+
+from .common import environment, make_options, write_results
+
+TRACKS_PER_ALBUM = 12
+ALBUMS_PER_ARTIST = 8
+
+# Skip options with a value (--bitrate 128) and create the output file argument
+_CREATE_SECOND_ARG = """\
+while [ "${1#--}" != "$1" ]; do shift 2; done
+: > "$2"
+"""
+_CREATE_AFTER_O = """\
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then : > "$2"; fi
+    shift
+done
+"""
+# Without -o, every input gets an output with the same name and the suffix .ogg
+_OGGENC = """\
+output=""
+for arg; do
+    if [ "$prev" = "-o" ]; then output="$arg"; fi
+    prev="$arg"
+done
+if [ -n "$output" ]; then
+    : > "$output"
+else
+    for arg; do
+        case "$arg" in
+            *.flac) : > "${arg%.flac}.ogg" ;;
+        esac
+    done
+fi
+"""
+_CREATE_LAST_ARG = """\
+for last; do :; done
+if [ "$last" != "-" ]; then : > "$last"; fi
+"""
+STUBS = {
+    "opusenc": _CREATE_SECOND_ARG,
+    "oggenc": _OGGENC,
+    "fdkaac": _CREATE_AFTER_O + "cat > /dev/null\n",
+    "ffmpeg": _CREATE_LAST_ARG,
+    "vorbiscomment": "cat > /dev/null\n",
+    "convert": "cat\n",
+    "atomicparsley": "",
+    "flac": "",
+}
+
+
+def install_stubs(bin_dir: Path):
+    """Put stub executables for every program flacmirror calls in front of PATH"""
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, body in STUBS.items():
+        file = bin_dir / name
+        file.write_text("#!/bin/sh\n" + body)
+        file.chmod(file.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = str(bin_dir) + os.pathsep + os.environ.get("PATH", "")
+
+
+def flac_header(total_samples: int, sample_rate: int = 44100) -> bytes:
+    """A flac file with only a STREAMINFO block, enough for flacmirror's parser"""
+    packed = (sample_rate << 44) | (1 << 41) | (15 << 36) | total_samples
+    streaminfo = (
+        struct.pack(">HH", 4096, 4096)
+        + bytes(6)
+        + struct.pack(">Q", packed)
+        + bytes(16)
+    )
+    return b"fLaC" + bytes([0x80]) + len(streaminfo).to_bytes(3, "big") + streaminfo
+
+
+def generate_tree(directory: Path, num_files: int):
+    """Create num_files small flac files in an artist/album/track layout"""
+    # A few different durations so that --schedule lpt has something to sort
+    headers = [flac_header(44100 * (120 + 37 * i)) for i in range(TRACKS_PER_ALBUM)]
+    album_dir = directory
+    for index in range(num_files):
+        track = index % TRACKS_PER_ALBUM
+        if track == 0:
+            album = index // TRACKS_PER_ALBUM
+            album_dir = (
+                directory
+                / f"Artist {album // ALBUMS_PER_ARTIST:05}"
+                / f"Album {album % ALBUMS_PER_ARTIST:02}"
+            )
+            album_dir.mkdir(parents=True)
+        (album_dir / f"{track + 1:02} Track.flac").write_bytes(headers[track])
+
+
+def rss_mb() -> float:
+    """Current resident set size, or the peak if the current one is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def quiet() -> Iterator[None]:
+    """Discard the per-job output of flacmirror while still formatting it"""
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        yield
+
+
+def measure(num_files: int, tmp_dir: Path, overrides: Dict[str, Any]) -> Dict[str, Any]:
+    src_dir = tmp_dir / "src"
+    dst_dir = tmp_dir / "dst"
+    start = time.perf_counter()
+    generate_tree(src_dir, num_files)
+    result: Dict[str, Any] = {
+        "files": num_files,
+        "tree_seconds": time.perf_counter() - start,
+    }
+
+    start = time.perf_counter()
+    scan_files(src_dir, extensions=["flac"])
+    result["scan_seconds"] = time.perf_counter() - start
+
+    options = make_options(src_dir, dst_dir, **overrides)
+    rss_before = rss_mb()
+    metrics.reset()
+    with quiet():
+        start = time.perf_counter()
+        queue = JobQueue(options)
+        result["generate_jobs_seconds"] = time.perf_counter() - start
+    result["jobs"] = len(queue.jobs)
+    result["rss_growth_mb"] = rss_mb() - rss_before
+    result["rss_bytes_per_file"] = result["rss_growth_mb"] * 1e6 / num_files
+
+    # Without running processes, only scheduling, bookkeeping and printing remain.
+    dry_options = make_options(src_dir, dst_dir, **overrides, dry_run=True)
+    queue.options = dry_options
+    with quiet():
+        start = time.perf_counter()
+        queue.run()
+        dry_seconds = time.perf_counter() - start
+    result["dry_run_seconds"] = dry_seconds
+    result["scheduler_us_per_job"] = dry_seconds * 1e6 / max(len(queue.jobs), 1)
+
+    metrics.reset()
+    with quiet():
+        queue = JobQueue(options)
+        start = time.perf_counter()
+        queue.run()
+        run_seconds = time.perf_counter() - start
+    result["stub_run_seconds"] = run_seconds
+    result["stub_us_per_job"] = run_seconds * 1e6 / max(len(queue.jobs), 1)
+    result["processes_spawned"] = metrics.counters.get("processes_spawned", 0)
+
+    # The common case: everything is up to date
+    with quiet():
+        start = time.perf_counter()
+        queue = JobQueue(options)
+        result["resync_seconds"] = time.perf_counter() - start
+    result["resync_jobs"] = len(queue.jobs)
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument(
+        "--files", type=int, nargs="+", default=[10_000, 100_000], help="Tree sizes"
+    )
+    argparser.add_argument("--codec", choices=["opus", "vorbis", "aac", "mp3"])
+    argparser.add_argument("--schedule", choices=["fifo", "lpt"])
+    argparser.add_argument("--engine", choices=["threads", "asyncio"])
+    argparser.add_argument("--num-threads", type=int)
+    argparser.add_argument(
+        "--tmp-dir",
+        help="Where to create the trees, defaults to /dev/shm if available",
+    )
+    argparser.add_argument("--output", help="Write results to this json file")
+    args = argparser.parse_args()
+
+    tmp_root: Optional[str] = args.tmp_dir
+    if tmp_root is None and os.path.isdir("/dev/shm"):
+        tmp_root = "/dev/shm"
+    overrides: Dict[str, Any] = {"delete": True}
+    for name in ["codec", "schedule", "num_threads", "engine"]:
+        if getattr(args, name) is not None:
+            overrides[name] = getattr(args, name)
+
+    results: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory(prefix="flacmirror-bench-", dir=tmp_root) as tmp:
+        install_stubs(Path(tmp) / "bin")
+        with redirect_stdout(io.StringIO()):
+            fulfilled = check_requirements(make_options(Path(tmp), Path(tmp)))
+        if not fulfilled:
+            sys.exit("Stub executables are not found on PATH")
+        for num_files in args.files:
+            tree_dir = Path(tmp) / f"tree-{num_files}"
+            result = measure(num_files, tree_dir, overrides)
+            shutil.rmtree(tree_dir)
+            print(
+                f"{num_files} files: scan {result['scan_seconds']:.2f} s,"
+                f" jobs {result['generate_jobs_seconds']:.2f} s,"
+                f" scheduler {result['scheduler_us_per_job']:.0f} us/job,"
+                f" stub run {result['stub_us_per_job']:.0f} us/job,"
+                f" resync {result['resync_seconds']:.2f} s,"
+                f" {result['rss_bytes_per_file']:.0f} bytes/file"
+            )
+            results.append(result)
+
+    if args.output is not None:
+        write_results(
+            Path(args.output), {"environment": environment(), "results": results}
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import json
+import os
+import platform
+import sys
+from pathlib import Path
+from typing import Any, Dict
+
+from flacmirror.options import Options
+
+
+def make_options(src_dir: Path, dst_dir: Path, **overrides: Any) -> Options:
+    """Options with the same defaults as the command line interface"""
+    values: Dict[str, Any] = dict(
+        src_dir=src_dir,
+        dst_dir=dst_dir,
+        codec="opus",
+        albumart="optimize",
+        albumart_max_width=750,
+        albumart_cache_dir=None,
+        overwrite="old",
+        delete=False,
+        manifest=False,
+        yes=True,
+        copy_file=None,
+        copy_ext=None,
+        link_copies=False,
+        dedup=False,
+        num_threads=None,
+        io_threads=4,
+        schedule="fifo",
+        encoder_backend="process",
+        engine="threads",
+        job_timeout=None,
+        max_memory=None,
+        opus_quality=None,
+        vorbis_quality=None,
+        aac_quality=128,
+        aac_mode=None,
+        aac_samplerate=48000,
+        mp3_quality=None,
+        mp3_mode=None,
+        metrics_json=None,
+        metrics_prom=None,
+        watch=False,
+        watch_debounce=5.0,
+        dry_run=False,
+        debug=False,
+    )
+    values.update(overrides)
+    return Options(**values)
+
+
+def environment() -> Dict[str, Any]:
+    """Information about the machine, stored with the results for comparison"""
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def write_results(file: Path, results: Dict[str, Any]):
+    file.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Results written to {file}")
@@ -0,0 +1,161 @@
+"""Generate a deterministic corpus of flac files for benchmarking.
+
+Audio is synthesized with ffmpeg and cover art with ImageMagick, so no files need
+to be downloaded. The same preset always produces the same files.
+
+    python -m benchmarks.corpus /tmp/flacmirror-corpus --preset small
+"""
+
+import argparse
+import subprocess
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+
+class TrackSpec(NamedTuple):
+    name: str
+    duration: int  # seconds
+    sample_rate: int
+    bit_depth: int
+    art_width: Optional[int]  # None means no embedded picture
+
+
+def _tracks(durations: List[int], formats: List[tuple], arts: List[Optional[int]]):
+    tracks = []
+    for duration in durations:
+        for sample_rate, bit_depth in formats:
+            for art_width in arts:
+                art = f"art{art_width}" if art_width is not None else "noart"
+                name = f"{duration}s_{sample_rate // 1000}k_{bit_depth}bit_{art}"
+                tracks.append(
+                    TrackSpec(name, duration, sample_rate, bit_depth, art_width)
+                )
+    return tracks
+
+
+PRESETS: Dict[str, List[TrackSpec]] = {
+    "tiny": _tracks([10], [(44100, 16)], [None, 500]),
+    "small": _tracks(
+        [30, 120],
+        [(44100, 16), (96000, 24)],
+        [None, 1000],
+    ),
+    "full": _tracks(
+        [10, 60, 240],
+        [(44100, 16), (48000, 24), (96000, 24), (192000, 24)],
+        [None, 500, 1500, 3000],
+    ),
+}
+
+
+def generate_cover(file: Path, width: int, seed: int):
+    # plasma is random, but reproducible with a fixed seed
+    args = [
+        "convert",
+        "-seed",
+        str(seed),
+        "-size",
+        f"{width}x{width}",
+        "plasma:fractal",
+        "-quality",
+        "95",
+        str(file),
+    ]
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def generate_track(file: Path, track: TrackSpec, seed: int, cover: Optional[Path]):
+    # Mix of tones, a sweep and noise so that encoders have something to do
+    expression = (
+        "0.3*sin(2*PI*220*t)+0.2*sin(2*PI*(300+200*sin(0.1*t))*t)"
+        "|0.3*sin(2*PI*330*t)+0.2*sin(2*PI*(500+100*sin(0.07*t))*t)"
+    )
+    args = [
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-nostdin",
+        "-f",
+        "lavfi",
+        "-i",
+        f"aevalsrc={expression}:s={track.sample_rate}:d={track.duration}",
+        "-f",
+        "lavfi",
+        "-i",
+        f"anoisesrc=c=pink:a=0.05:r={track.sample_rate}:d={track.duration}"
+        f":seed={seed}",
+    ]
+    if cover is not None:
+        args.extend(["-i", str(cover)])
+    args.extend(
+        [
+            "-filter_complex",
+            "[1:a]aformat=channel_layouts=stereo[n];[0:a][n]amix=inputs=2[a]",
+            "-map",
+            "[a]",
+        ]
+    )
+    if cover is not None:
+        args.extend(["-map", "2:v", "-c:v", "copy", "-disposition:v", "attached_pic"])
+    if track.bit_depth == 16:
+        args.extend(["-sample_fmt", "s16"])
+    else:
+        args.extend(
+            ["-sample_fmt", "s32", "-bits_per_raw_sample", str(track.bit_depth)]
+        )
+    args.extend(
+        [
+            "-c:a",
+            "flac",
+            "-metadata",
+            f"TITLE={track.name}",
+            "-metadata",
+            "ARTIST=flacmirror benchmark",
+            "-metadata",
+            "ALBUM=Synthetic corpus",
+            "-fflags",
+            "+bitexact",
+            "-flags:a",
+            "+bitexact",
+            str(file),
+        ]
+    )
+    subprocess.run(args, check=True, capture_output=True)
+
+
+def generate_corpus(directory: Path, preset: str) -> List[Path]:
+    covers_dir = directory / "covers"
+    covers_dir.mkdir(parents=True, exist_ok=True)
+    covers: Dict[int, Path] = {}
+    files = []
+    for seed, track in enumerate(PRESETS[preset], start=1):
+        cover = None
+        if track.art_width is not None:
+            cover = covers.get(track.art_width)
+            if cover is None:
+                cover = covers_dir / f"cover_{track.art_width}.jpg"
+                generate_cover(cover, track.art_width, seed=track.art_width)
+                covers[track.art_width] = cover
+        file = directory / "flac" / f"{track.name}.flac"
+        file.parent.mkdir(parents=True, exist_ok=True)
+        if not file.exists():
+            print(f"Generating {file}")
+            generate_track(file, track, seed, cover)
+        files.append(file)
+    return files
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument("directory", help="Output directory of the corpus")
+    argparser.add_argument(
+        "--preset", choices=sorted(PRESETS), default="small", help="Corpus size"
+    )
+    args = argparser.parse_args()
+    files = generate_corpus(Path(args.directory), args.preset)
+    print(f"{len(files)} files in {Path(args.directory) / 'flac'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    TypeVar,
+)
+
+from .memory import MemoryBudget
+from .processes import running_processes
+
+if TYPE_CHECKING:
+    from .queue import Job
+
+T = TypeVar("T")
+
+# Thread pools of the running engine, for jobs that have no coroutine
+_executors: Dict[str, ThreadPoolExecutor] = {}
+
+
+class JobTimeoutError(Exception):
+    pass
+
+
+async def run_in_thread(lane: str, fn: Callable[..., T], *args: Any) -> T:
+    """Call fn(*args) in a worker thread of lane, for jobs that have no coroutine.
+
+    If the caller is cancelled (a timeout or the run was stopped), the processes fn
+    started are stopped and the thread is waited for.
+    """
+    loop = asyncio.get_running_loop()
+    lock = threading.Lock()
+    state: Dict[str, Any] = {"thread": None, "cancelled": False}
+
+    def run() -> T:
+        with lock:
+            if state["cancelled"]:
+                raise CancelledError()
+            state["thread"] = threading.get_ident()
+        return fn(*args)
+
+    future = loop.run_in_executor(_executors[lane], run)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        with lock:
+            state["cancelled"] = True
+            thread = state["thread"]
+        if thread is not None:
+            running_processes.terminate_thread(thread)
+        # The thread gives up once its processes failed.
+        await asyncio.wait([future])
+        if not future.cancelled():
+            future.exception()
+        if thread is not None:
+            running_processes.release_thread(thread)
+        raise
+
+
+class Engine:
+    """Runs jobs as asyncio tasks, with a semaphore limiting the jobs of each lane.
+
+    Jobs that implement Job.run_async start their processes with the event loop and
+    need no thread, the others run in a thread pool per lane. A job that takes
+    longer than timeout fails with JobTimeoutError and its processes are stopped.
+    """
+
+    def __init__(
+        self,
+        lane_sizes: Dict[str, int],
+        timeout: Optional[float] = None,
+        budget: Optional[MemoryBudget] = None,
+        job_memory: Optional[Callable[["Job"], int]] = None,
+    ):
+        self.lane_sizes = lane_sizes
+        self.timeout = timeout
+        self.budget = budget
+        self.job_memory = job_memory
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._running: Set["asyncio.Future[None]"] = set()
+        self._cancelled = False
+
+    def run(
+        self,
+        jobs: List["Job"],
+        run_job: Callable[["Job", int], Awaitable[None]],
+        on_done: Callable[["Job"], None],
+        on_error: Callable[["Job", BaseException], None],
+    ):
+        """Run every job with run_job(job, slot) and report how it ended.
+
+        slot is the number of the concurrency slot in the lane of the job.
+        """
+        if (3, 9) <= sys.version_info < (3, 12) and hasattr(os, "pidfd_open"):
+            # The default watcher starts a thread for every process. Newer versions
+            # use pidfds by default.
+            asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
+        asyncio.run(self._run(jobs, run_job, on_done, on_error))
+
+    def cancel(self):
+        """Stop all jobs, may be called from signal handlers and other threads"""
+        # Set right away, so that no other job reports an error or gets started
+        self._cancelled = True
+        if self.budget is not None:
+            self.budget.cancel()
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._cancel)
+
+    def _cancel(self):
+        for task in self._running:
+            task.cancel()
+
+    def _admit(self, amount: int) -> bool:
+        """Wait until amount fits into the budget, False if it was cancelled"""
+        assert self.budget is not None
+        try:
+            self.budget.acquire(amount)
+        except CancelledError:
+            return False
+        return True
+
+    async def _run(
+        self,
+        jobs: List["Job"],
+        run_job: Callable[["Job", int], Awaitable[None]],
+        on_done: Callable[["Job"], None],
+        on_error: Callable[["Job", BaseException], None],
+    ):
+        global _executors
+        loop = asyncio.get_running_loop()
+        lane_jobs: Dict[str, List["Job"]] = {lane: [] for lane in self.lane_sizes}
+        for job in jobs:
+            lane_jobs[job.lane].append(job)
+
+        async def run_slot(job: "Job", free_slots: List[int]):
+            slot = free_slots.pop()
+            try:
+                await asyncio.wait_for(run_job(job, slot), self.timeout)
+            except asyncio.TimeoutError:
+                raise JobTimeoutError(
+                    f"Job did not finish within {self.timeout} seconds"
+                ) from None
+            finally:
+                free_slots.append(slot)
+
+        def finished(
+            job: "Job",
+            semaphore: asyncio.Semaphore,
+            amount: int,
+            task: "asyncio.Future[None]",
+        ):
+            semaphore.release()
+            if amount:
+                assert self.budget is not None
+                self.budget.remove(amount)
+            self._running.discard(task)
+            if task.cancelled() or self._cancelled:
+                return
+            error = task.exception()
+            if error is None:
+                on_done(job)
+            else:
+                on_error(job, error)
+
+        async def dispatch(lane: str, admission: ThreadPoolExecutor):
+            # Tasks are only created once they can start, so that millions of jobs
+            # do not need millions of tasks.
+            semaphore = asyncio.Semaphore(self.lane_sizes[lane])
+            free_slots = list(range(self.lane_sizes[lane]))
+            for job in lane_jobs[lane]:
+                await semaphore.acquire()
+                amount = 0
+                if self.budget is not None and self.job_memory is not None:
+                    amount = self.job_memory(job)
+                if amount and not await loop.run_in_executor(
+                    admission, self._admit, amount
+                ):
+                    amount = 0
+                if self._cancelled:
+                    if amount:
+                        assert self.budget is not None
+                        self.budget.remove(amount)
+                    semaphore.release()
+                    return
+                task = asyncio.ensure_future(run_slot(job, free_slots))
+                self._running.add(task)
+                task.add_done_callback(partial(finished, job, semaphore, amount))
+
+        self._loop = loop
+        with ExitStack() as stack:
+            _executors = {
+                lane: stack.enter_context(ThreadPoolExecutor(max_workers=size))
+                for lane, size in self.lane_sizes.items()
+            }
+            # Waits for --max-memory, one job of each lane at a time
+            admission = stack.enter_context(
+                ThreadPoolExecutor(max_workers=len(self.lane_sizes))
+            )
+            try:
+                if self._cancelled:
+                    return
+                await asyncio.gather(
+                    *(dispatch(lane, admission) for lane in self.lane_sizes)
+                )
+                while self._running:
+                    await asyncio.wait(set(self._running))
+            finally:
+                self._loop = None
+                _executors = {}
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+
+class AlbumArtCache:
+    """Thread-safe cache for processed album art.
+
+    Entries are addressed by a hash of the raw picture and the processing settings,
+    so all tracks of an album share the result of a single conversion. Processed
+    pictures are kept in an in-memory LRU and optionally in cache_dir, which persists
+    them across runs. If several threads ask for the same picture at the same time,
+    only one of them does the conversion while the others wait for the result. Jobs
+    of the asyncio engine use get_async, which waits without blocking the event loop.
+    """
+
+    def __init__(self, max_entries: int = 128, cache_dir: Optional[Path] = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._in_flight: Dict[str, "Future[bytes]"] = {}
+
+    @staticmethod
+    def key(image: bytes, albumart: str, max_width: int) -> str:
+        digest = hashlib.sha256(image).hexdigest()
+        if albumart == "resize":
+            return f"{digest}-{albumart}-{max_width}"
+        return f"{digest}-{albumart}"
+
+    def get(
+        self,
+        image: bytes,
+        albumart: str,
+        max_width: int,
+        process: Callable[[bytes], bytes],
+    ) -> bytes:
+        """Return the processed picture, calling process(image) on a cache miss"""
+        key = self.key(image, albumart, max_width)
+        result, future, owner = self._claim(key)
+        if result is not None:
+            return result
+        assert future is not None
+        if not owner:
+            return future.result()
+
+        try:
+            result = self._load_counted(key)
+            if result is None:
+                result = process(image)
+                self._store(key, result)
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def get_async(
+        self,
+        image: bytes,
+        albumart: str,
+        max_width: int,
+        process: Callable[[bytes], Awaitable[bytes]],
+    ) -> bytes:
+        """Like get, with a coroutine function to process the picture"""
+        key = self.key(image, albumart, max_width)
+        while True:
+            result, future, owner = self._claim(key)
+            if result is not None:
+                return result
+            assert future is not None
+            if owner:
+                break
+            try:
+                # Shielded, the future is shared with the other waiters.
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except (CancelledError, asyncio.CancelledError):
+                if not future.done() or future.cancelled():
+                    raise
+                # The job that processed the picture was cancelled, take over.
+
+        try:
+            result = self._load_counted(key)
+            if result is None:
+                result = await process(image)
+                self._store(key, result)
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def _claim(
+        self, key: str
+    ) -> Tuple[Optional[bytes], Optional["Future[bytes]"], bool]:
+        """The cached picture, or the future of its conversion and if that is new.
+
+        The caller owns a new future, processes the picture and calls _finish or _fail.
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result, None, False
+            future = self._in_flight.get(key)
+            if future is not None:
+                # Somebody else is already processing this picture.
+                self.hits += 1
+                return None, future, False
+            future = Future()
+            self._in_flight[key] = future
+            return None, future, True
+
+    def _load_counted(self, key: str) -> Optional[bytes]:
+        result = self._load(key)
+        with self._lock:
+            if result is not None:
+                self.disk_hits += 1
+                self.hits += 1
+            else:
+                self.misses += 1
+        return result
+
+    def _fail(self, key: str, future: "Future[bytes]", error: BaseException):
+        with self._lock:
+            del self._in_flight[key]
+        future.set_exception(error)
+
+    def _finish(self, key: str, future: "Future[bytes]", result: bytes):
+        with self._lock:
+            del self._in_flight[key]
+            self._entries[key] = result
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        future.set_result(result)
+
+    def _path(self, key: str) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / key[:2] / f"{key}.jpg"
+
+    def _load(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key: str, data: bytes):
+        path = self._path(key)
+        if path is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so other runs never see partial files.
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        tmp_path.write_bytes(data)
+        os.replace(str(tmp_path), str(path))
+
+    def summary(self) -> str:
+        return (
+            f"Album art cache: {self.hits} hits ({self.disk_hits} from disk),"
+            f" {self.misses} misses."
+        )
@@ -0,0 +1,560 @@
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import fields, replace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from . import __version__
+from .albumart import AlbumArtCache
+from .files import atomic_output
+from .metrics import metrics
+from .options import Options
+from .queue import JobEncode, JobQueue, output_suffix
+
+# Every frame is a JSON header with this length prefix, followed by "size" bytes of
+# payload (a source file or an encoded file).
+FRAME_LENGTH = struct.Struct(">I")
+MAX_HEADER_LENGTH = 1024 * 1024
+# Workers send a heartbeat this often (in seconds) on every connection, and are
+# considered dead if nothing was heard from them for HEARTBEAT_TIMEOUT.
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+# Workers ask again after this many seconds if all jobs are handed out
+WAIT_INTERVAL = 1.0
+# Payloads are sent in chunks of this size. The socket timeout applies to each
+# chunk, so that large files can take longer than HEARTBEAT_TIMEOUT to send.
+SEND_CHUNK_SIZE = 1024 * 1024
+# Address the coordinator listens on if only a port is given, see --token
+DEFAULT_HOST = "127.0.0.1"
+PATH_FIELDS = {
+    "src_dir",
+    "dst_dir",
+    "albumart_cache_dir",
+    "metrics_json",
+    "metrics_prom",
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def parse_address(address: str, default_host: str = "") -> Tuple[str, int]:
+    """Split [HOST:]PORT, raises ValueError if it is invalid"""
+    host, _, port = address.rpartition(":")
+    return host or default_host, int(port)
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def join_inside(base: Path, relative: str) -> Path:
+    """base / relative, raises ValueError if the result is not inside base"""
+    path = Path(os.path.normpath(base / relative))
+    if base not in path.parents:
+        raise ValueError(f"{relative} is not inside {base}")
+    return path
+
+
+def options_to_dict(options: Options) -> Dict[str, Any]:
+    return {
+        field.name: (
+            str(getattr(options, field.name))
+            if isinstance(getattr(options, field.name), Path)
+            else getattr(options, field.name)
+        )
+        for field in fields(options)
+    }
+
+
+def options_from_dict(values: Dict[str, Any]) -> Options:
+    converted: Dict[str, Any] = {
+        name: Path(value) if name in PATH_FIELDS and value is not None else value
+        for name, value in values.items()
+    }
+    return Options(**converted)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray(size)
+    view = memoryview(data)
+    pos = 0
+    while pos < size:
+        received = sock.recv_into(view[pos:])
+        if received == 0:
+            raise ConnectionError("Connection closed")
+        pos += received
+    return bytes(data)
+
+
+def send_frame(
+    sock: socket.socket,
+    message: Dict[str, Any],
+    payload: bytes = b"",
+    lock: Optional[threading.Lock] = None,
+):
+    header = json.dumps({**message, "size": len(payload)}).encode()
+    data = FRAME_LENGTH.pack(len(header)) + header
+    if lock is None:
+        lock = threading.Lock()
+    with lock:
+        sock.sendall(data)
+        view = memoryview(payload)
+        for pos in range(0, len(view), SEND_CHUNK_SIZE):
+            sock.sendall(view[pos : pos + SEND_CHUNK_SIZE])
+
+
+def recv_frame(sock: socket.socket) -> Tuple[Dict[str, Any], bytes]:
+    (length,) = FRAME_LENGTH.unpack(_recv_exactly(sock, FRAME_LENGTH.size))
+    if length > MAX_HEADER_LENGTH:
+        raise ProtocolError(f"Frame header too large ({length} bytes)")
+    try:
+        message = json.loads(_recv_exactly(sock, length))
+    except ValueError:
+        raise ProtocolError("Invalid frame header") from None
+    if not isinstance(message, dict) or "type" not in message:
+        raise ProtocolError("Invalid frame header")
+    payload = _recv_exactly(sock, message.get("size", 0))
+    return message, payload
+
+
+class WorkerStats:
+    """Throughput of one worker machine, over all its connections"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.jobs = 0
+        self.audio_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.requeued_jobs = 0
+        self.first_job: Optional[float] = None
+        self.last_result: Optional[float] = None
+
+    def summary(self) -> str:
+        duration = 0.0
+        if self.first_job is not None and self.last_result is not None:
+            duration = self.last_result - self.first_job
+        realtime = self.audio_seconds / duration if duration > 0 else 0.0
+        summary = (
+            f"{self.name}: {self.jobs} jobs, {realtime:.1f}x realtime,"
+            f" {self.bytes_sent / 1e6:.1f} MB sent,"
+            f" {self.bytes_received / 1e6:.1f} MB received"
+        )
+        if self.requeued_jobs:
+            summary += f", {self.requeued_jobs} jobs handed out again"
+        return summary
+
+
+class Coordinator:
+    """Hands out the encode jobs of a JobQueue to workers connecting over TCP.
+
+    Copies and deletions are run here. Jobs of workers that disconnect or miss
+    their heartbeats are handed out again. If token is given, only workers that
+    know it are accepted.
+    """
+
+    def __init__(
+        self, job_queue: JobQueue, host: str, port: int, token: Optional[str] = None
+    ):
+        self.job_queue = job_queue
+        self.token = token
+        self.options = job_queue.options
+        self.lock = threading.Lock()
+        self.pending: Deque[JobEncode] = deque()
+        # Number of jobs that are handed out and not finished yet
+        self.outstanding = 0
+        self.next_id = 0
+        self.finished = threading.Event()
+        self.cancelled = False
+        self.stats: Dict[str, WorkerStats] = {}
+        # Number of open worker connections
+        self.connections = 0
+        self.server = _Server((host, port), _Handler)
+        self.server.coordinator = self
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        host, port = self.server.server_address[:2]
+        return str(host), int(port)
+
+    def run(self):
+        encode_jobs = [job for job in self.job_queue.jobs if isinstance(job, JobEncode)]
+        self.job_queue.jobs = [
+            job for job in self.job_queue.jobs if not isinstance(job, JobEncode)
+        ]
+        try:
+            # Deletions, copies and leftovers of interrupted runs
+            self.job_queue.run()
+            if encode_jobs and not self.cancelled and not self.job_queue.cancelled:
+                self.pending.extend(encode_jobs)
+                self._serve()
+        finally:
+            self.server.server_close()
+            self.job_queue.save_manifest()
+            self.job_queue.write_metrics()
+
+    def _serve(self):
+        host, port = self.address
+        print(
+            f"Waiting for workers on {host or '*'}:{port} to encode"
+            f" {len(self.pending)} files..."
+        )
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        start = time.perf_counter()
+        try:
+            # Wake up regularly, so that signal handlers can run
+            while not self.finished.wait(1.0):
+                pass
+            # Workers that are waiting for jobs ask again soon and are told that
+            # everything is done.
+            deadline = time.monotonic() + 2 * WAIT_INTERVAL + 1.0
+            while self.connections and time.monotonic() < deadline:
+                time.sleep(0.1)
+        finally:
+            self.server.shutdown()
+            thread.join()
+        metrics.observe("run", time.perf_counter() - start)
+        print(f"Encoding done. Took {time.perf_counter() - start:.0f} seconds.")
+        for stats in self.stats.values():
+            print(f"    {stats.summary()}")
+
+    def cancel(self):
+        print("Stopping, jobs that are running on workers are abandoned...")
+        with self.lock:
+            self.cancelled = True
+        self.job_queue.stop()
+        self.finished.set()
+
+    def _next_job(self) -> Tuple[str, Optional[JobEncode], int]:
+        with self.lock:
+            if self.cancelled:
+                return "done", None, 0
+            if self.pending:
+                self.outstanding += 1
+                self.next_id += 1
+                return "job", self.pending.popleft(), self.next_id
+            if self.outstanding > 0:
+                # Jobs of workers that are lost might be handed out again.
+                return "wait", None, 0
+            return "done", None, 0
+
+    def _job_message(
+        self, job: JobEncode, job_id: int, has_src: bool, has_dst: bool
+    ) -> Tuple[Dict[str, Any], bytes]:
+        options = job.target or self.options
+        message: Dict[str, Any] = {
+            "type": "job",
+            "id": job_id,
+            "options": options_to_dict(options),
+            "src": str(job.src_file.relative_to(options.src_dir.absolute())),
+            "dst": None,
+        }
+        # Workers only share the mount of the main destination
+        if has_dst and job.target is None:
+            message["dst"] = str(job.dst_file.relative_to(options.dst_dir.absolute()))
+        payload = b"" if has_src else job.src_file.read_bytes()
+        return message, payload
+
+    def _finish(
+        self,
+        job: JobEncode,
+        message: Dict[str, Any],
+        payload: bytes,
+        stats: WorkerStats,
+    ):
+        if message.get("ok") and not message.get("written"):
+            try:
+                job.dst_file.parent.mkdir(parents=True, exist_ok=True)
+                with atomic_output(job.dst_file) as tmp_file:
+                    tmp_file.write_bytes(payload)
+            except OSError as e:
+                message = {"ok": False, "error": f"Writing the output failed: {e}"}
+        if message.get("ok"):
+            job.count_metrics(job.target or self.options)
+            duration = job.duration()
+            with self.lock:
+                self.job_queue.record(job)
+                stats.jobs += 1
+                stats.audio_seconds += duration
+                stats.bytes_received += len(payload)
+                stats.last_result = time.perf_counter()
+                self.outstanding -= 1
+                if self.outstanding == 0 and not self.pending:
+                    self.finished.set()
+            return
+        metrics.count("failed_jobs")
+        print(f"\nError processing file {job.job_info()} on {stats.name}:")
+        print(message.get("error", ""))
+        with self.lock:
+            self.outstanding -= 1
+        self.cancel()
+
+    def serve(self, sock: socket.socket):
+        """Talk to one connection of a worker until it is done or lost"""
+        sock.settimeout(HEARTBEAT_TIMEOUT)
+        assigned: Dict[int, JobEncode] = {}
+        name = "unknown worker"
+        with self.lock:
+            self.connections += 1
+        try:
+            hello, _ = recv_frame(sock)
+            if hello["type"] != "hello":
+                raise ProtocolError("Expected hello")
+            name = str(hello.get("name", name))
+            rejection = self._check_hello(hello)
+            if rejection is not None:
+                print(f"Rejected {name}: {rejection}")
+                send_frame(sock, {"type": "rejected", "reason": rejection})
+                return
+            has_src = bool(hello.get("has_src"))
+            has_dst = bool(hello.get("has_dst"))
+            with self.lock:
+                stats = self.stats.setdefault(name, WorkerStats(name))
+            while True:
+                message, payload = recv_frame(sock)
+                if message["type"] == "heartbeat":
+                    continue
+                elif message["type"] == "request":
+                    reply, job, job_id = self._next_job()
+                    if job is None:
+                        send_frame(sock, {"type": reply})
+                        if reply == "done":
+                            return
+                        continue
+                    assigned[job_id] = job
+                    job_message, job_payload = self._job_message(
+                        job, job_id, has_src, has_dst
+                    )
+                    print(f"Encoding on {name}: {job.src_file}")
+                    send_frame(sock, job_message, job_payload)
+                    with self.lock:
+                        stats.bytes_sent += len(job_payload)
+                        if stats.first_job is None:
+                            stats.first_job = time.perf_counter()
+                elif message["type"] == "result":
+                    job = assigned.pop(message["id"])
+                    self._finish(job, message, payload, stats)
+                else:
+                    raise ProtocolError(f"Unexpected message {message['type']}")
+        except (OSError, ProtocolError, KeyError, ValueError) as e:
+            if assigned:
+                print(f"Lost {name} ({e}), handing out {len(assigned)} jobs again.")
+            with self.lock:
+                self.pending.extendleft(assigned.values())
+                self.outstanding -= len(assigned)
+                if name in self.stats:
+                    self.stats[name].requeued_jobs += len(assigned)
+            metrics.count("requeued_jobs", len(assigned))
+        finally:
+            with self.lock:
+                self.connections -= 1
+
+    def _check_hello(self, hello: Dict[str, Any]) -> Optional[str]:
+        """Why the worker that sent hello is not accepted, None if it is"""
+        if self.token is not None and not hmac.compare_digest(
+            str(hello.get("token", "")).encode(), self.token.encode()
+        ):
+            return "wrong token"
+        # The options of the jobs are only understood by the same version.
+        if hello.get("version") != __version__:
+            return (
+                f"flacmirror {hello.get('version')} of the worker does not match"
+                f" {__version__}"
+            )
+        return None
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    coordinator: Coordinator
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    server: _Server
+
+    def handle(self):
+        self.server.coordinator.serve(self.request)
+
+
+class Worker:
+    """Encodes jobs of a coordinator with num_threads connections in parallel.
+
+    Source files are read from src_dir and outputs written to dst_dir if they are
+    given (shared mounts), otherwise they are transferred over the connection.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        src_dir: Optional[Path],
+        dst_dir: Optional[Path],
+        num_threads: int,
+        debug: bool = False,
+        token: Optional[str] = None,
+    ):
+        self.host = host
+        self.port = port
+        # Normalized, so that join_inside can check paths of the coordinator
+        self.src_dir = (
+            Path(os.path.normpath(src_dir.absolute())) if src_dir is not None else None
+        )
+        self.dst_dir = (
+            Path(os.path.normpath(dst_dir.absolute())) if dst_dir is not None else None
+        )
+        self.num_threads = num_threads
+        self.token = token
+        self.debug = debug
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self.art_cache = AlbumArtCache()
+        self.connections: List[Tuple[socket.socket, threading.Lock]] = []
+        self.connections_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.errors: List[str] = []
+
+    def run(self):
+        print(f"Worker {self.name} connecting to {self.host}:{self.port}...")
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        threads = [
+            threading.Thread(target=self._run_connection, daemon=True)
+            for _ in range(self.num_threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # Wake up regularly, so that signal handlers can run
+            while thread.is_alive():
+                thread.join(1.0)
+        self.stop()
+        # Every connection may have seen the same error
+        for error in dict.fromkeys(self.errors):
+            print(error)
+
+    def stop(self):
+        self.stopped.set()
+        with self.connections_lock:
+            for sock, _ in self.connections:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _heartbeat(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            with self.connections_lock:
+                connections = list(self.connections)
+            for sock, lock in connections:
+                try:
+                    send_frame(sock, {"type": "heartbeat"}, lock=lock)
+                except OSError:
+                    pass
+
+    def _run_connection(self):
+        try:
+            sock = socket.create_connection((self.host, self.port))
+        except OSError as e:
+            self.errors.append(f"Could not connect to {self.host}:{self.port}: {e}")
+            return
+        sock.settimeout(HEARTBEAT_TIMEOUT)
+        lock = threading.Lock()
+        with self.connections_lock:
+            self.connections.append((sock, lock))
+        try:
+            send_frame(
+                sock,
+                {
+                    "type": "hello",
+                    "name": self.name,
+                    "version": __version__,
+                    "token": self.token,
+                    "has_src": self.src_dir is not None,
+                    "has_dst": self.dst_dir is not None,
+                },
+                lock=lock,
+            )
+            while not self.stopped.is_set():
+                send_frame(sock, {"type": "request"}, lock=lock)
+                message, payload = recv_frame(sock)
+                if message["type"] == "done":
+                    return
+                elif message["type"] == "rejected":
+                    self.errors.append(
+                        f"Rejected by the coordinator: {message.get('reason')}"
+                    )
+                    self.stop()
+                    return
+                elif message["type"] == "wait":
+                    self.stopped.wait(WAIT_INTERVAL)
+                    continue
+                reply, reply_payload = self._encode(message, payload)
+                send_frame(sock, reply, reply_payload, lock=lock)
+        except (OSError, ProtocolError) as e:
+            if not self.stopped.is_set():
+                self.errors.append(f"Lost connection to the coordinator: {e}")
+        finally:
+            with self.connections_lock:
+                self.connections.remove((sock, lock))
+            sock.close()
+
+    def _encode(
+        self, message: Dict[str, Any], payload: bytes
+    ) -> Tuple[Dict[str, Any], bytes]:
+        reply: Dict[str, Any] = {"type": "result", "id": message["id"], "ok": False}
+        with TemporaryDirectory(prefix="flacmirror-worker-") as tmp:
+            tmp_dir = Path(tmp)
+            try:
+                options = replace(
+                    options_from_dict(message["options"]), debug=self.debug
+                )
+                # Only files inside the mounts are read and written.
+                if self.src_dir is not None:
+                    src_file = join_inside(self.src_dir, message["src"])
+                else:
+                    src_file = tmp_dir / "source.flac"
+                if self.dst_dir is not None and message["dst"] is not None:
+                    dst_file = join_inside(self.dst_dir, message["dst"])
+                else:
+                    dst_file = tmp_dir / f"output{output_suffix(options)}"
+            except (TypeError, ValueError) as e:
+                reply["error"] = f"Invalid job: {e}"
+                return reply, b""
+            if self.src_dir is None:
+                src_file.write_bytes(payload)
+            try:
+                JobEncode(src_file, dst_file, self.art_cache).run(options)
+            except subprocess.CalledProcessError as err:
+                reply["error"] = (
+                    f"Error when calling: {err.cmd}\n"
+                    f"Process returned code: {err.returncode}\n"
+                    f"stderr:\n{err.stderr.decode()}"
+                )
+                return reply, b""
+            except Exception:
+                reply["error"] = traceback.format_exc()
+                return reply, b""
+            reply["ok"] = True
+            if dst_file.parent == tmp_dir:
+                return reply, dst_file.read_bytes()
+            reply["written"] = True
+            return reply, b""
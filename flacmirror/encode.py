@@ -1,134 +1,588 @@
-from contextlib import ExitStack
+import base64
+import json
+import os
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from subprocess import CalledProcessError
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 from flacmirror.misc import generate_metadata_block_picture_ogg
 
+from . import native, ogg
+from .albumart import AlbumArtCache
+from .files import TEMP_PREFIX
+from .metadata import (
+    FlacMetadata,
+    Picture,
+    build_picture,
+    extract_picture,
+    read_metadata,
+)
+from .metrics import metrics
 from .options import Options
 from .processes import (
+    FDKAAC_SAMPLERATES,
     FFMPEG,
     AtomicParsley,
     Fdkaac,
     FdkaacUnsupportedSamplerateError,
+    Flac,
     ImageMagick,
-    Metaflac,
     Oggenc,
     Opusenc,
     VorbisComment,
+    run_tee,
 )
 
+# Longest single command line argument on Linux (MAX_ARG_STRLEN)
+MAX_ARG_LENGTH = 128 * 1024 - 1
+# Codecs whose outputs can get new tags and album art without encoding again
+RETAG_CODECS = {"opus", "vorbis", "mp3"}
+# Codecs whose encoders can share a decoded source, see encode_flac_tee
+TEE_CODECS = {"opus", "vorbis", "aac", "mp3"}
+
+
+def encode_flac(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    if options.codec == "opus":
+        encode_flac_to_opus(input_f, output_f, options, art_cache)
+    elif options.codec == "vorbis":
+        encode_flac_to_vorbis(input_f, output_f, options, art_cache)
+    elif options.codec == "aac":
+        encode_flac_to_aac(input_f, output_f, options, art_cache)
+    elif options.codec == "mp3":
+        encode_flac_to_mp3(input_f, output_f, options, art_cache)
+    else:
+        raise ValueError("Unknown codec")
+
 
-def encode_flac(input_f: Path, output_f: Path, options: Options):
+async def encode_flac_async(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    """Like encode_flac, with the processes run by the event loop of aio.Engine"""
     if options.codec == "opus":
-        encode_flac_to_opus(input_f, output_f, options)
+        await encode_flac_to_opus_async(input_f, output_f, options, art_cache)
     elif options.codec == "vorbis":
-        encode_flac_to_vorbis(input_f, output_f, options)
+        await encode_flac_to_vorbis_async(input_f, output_f, options, art_cache)
     elif options.codec == "aac":
-        encode_flac_to_aac(input_f, output_f, options)
+        await encode_flac_to_aac_async(input_f, output_f, options, art_cache)
     elif options.codec == "mp3":
-        encode_flac_to_mp3(input_f, output_f, options)
+        await encode_flac_to_mp3_async(input_f, output_f, options, art_cache)
     else:
         raise ValueError("Unknown codec")
 
 
-def encode_flac_to_opus(input_f: Path, output_f: Path, options: Options):
-    metaflac = Metaflac(options.debug)
+def encode_async_supported(options: Options) -> bool:
+    """Whether encode_flac_async can encode for options"""
+    # The native backend waits for its worker processes, which needs a thread.
+    return not (
+        options.codec == "opus"
+        and options.encoder_backend == "native"
+        and native.available("opus")
+    )
+
+
+def encode_flacs(
+    files: Sequence[Tuple[Path, Path]],
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    """Encode several (input, output) pairs of files, in one go if possible"""
+    if options.codec == "vorbis":
+        encode_flacs_to_vorbis(files, options, art_cache)
+    else:
+        for input_f, output_f in files:
+            encode_flac(input_f, output_f, options, art_cache)
+
+
+def tee_supported(options: Options) -> bool:
+    """Whether encode_flac_tee can encode for options"""
+    if options.codec == "opus" and options.encoder_backend == "native":
+        # The native backend decodes in its worker processes anyway.
+        return not native.available("opus")
+    return options.codec in TEE_CODECS
+
+
+def encode_flac_tee(
+    input_f: Path,
+    outputs: Sequence[Tuple[Path, Options]],
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    """Encode input_f to several (output, options) pairs, decoding it only once.
+
+    flac decodes the file and its audio is written to the encoders of all outputs at
+    the same time. The encoders only get the audio, the tags and album art are added
+    afterwards like when retagging, so the outputs are the same as with encode_flac.
+    fdkaac can not be retagged, it reads the tags from a json file instead.
+    """
+    metadata = read_metadata(input_f, pictures=False)
+    tee_outputs = []
+    for output_f, options in outputs:
+        if (
+            options.codec == "aac"
+            and metadata.streaminfo.sample_rate not in FDKAAC_SAMPLERATES
+        ):
+            # Needs resampling, which encode_flac_to_aac leaves to ffmpeg
+            encode_flac(input_f, output_f, options, art_cache)
+        else:
+            tee_outputs.append((output_f, options))
+    if len(tee_outputs) < 2:
+        for output_f, options in tee_outputs:
+            encode_flac(input_f, output_f, options, art_cache)
+        return
+
+    with ExitStack() as stack:
+        audio_files = []
+        commands = []
+        tags_file: Optional[Path] = None
+        for output_f, options in tee_outputs:
+            if options.codec == "aac":
+                # The tags can not be added afterwards, so fdkaac writes the output.
+                audio_f = output_f
+                if tags_file is None:
+                    tags_file = Path(stack.enter_context(_tags_json(metadata)))
+            else:
+                tmp_dir = stack.enter_context(
+                    TemporaryDirectory(prefix=TEMP_PREFIX, dir=output_f.parent)
+                )
+                audio_f = Path(tmp_dir) / f"audio{output_f.suffix}"
+            audio_files.append(audio_f)
+            commands.append(_tee_encode_args(audio_f, options, tags_file))
+        flac = Flac(any(options.debug for _, options in tee_outputs))
+        source_args = flac.decode_args(input_f)
+        flac.print_debug_info(source_args)
+        for args in commands:
+            flac.print_debug_info(args)
+        with metrics.stage("process.tee"):
+            errors = run_tee(source_args, commands)
+
+        for (output_f, options), audio_f, error in zip(
+            tee_outputs, audio_files, errors
+        ):
+            if error is not None:
+                if options.codec == "aac" and b"unsupported sample rate" in (
+                    error.stderr or b""
+                ):
+                    encode_flac(input_f, output_f, options, art_cache)
+                    continue
+                raise error
+            if options.codec == "aac":
+                add_aac_artwork(output_f, input_f, options, art_cache)
+            else:
+                retag_flac(input_f, audio_f, output_f, options, art_cache)
+
+
+@contextmanager
+def _tags_json(metadata: FlacMetadata) -> Iterator[str]:
+    """Temporary file with the tags of metadata for fdkaac --tag-from-json"""
+    with NamedTemporaryFile("w", encoding="utf-8", suffix=".json") as tags_file:
+        json.dump(metadata.tags_dict(), tags_file)
+        tags_file.flush()
+        yield tags_file.name
+
+
+def _tee_encode_args(
+    audio_f: Path, options: Options, tags_file: Optional[Path] = None
+) -> List[str]:
+    """Arguments to encode wav from stdin to audio_f for encode_flac_tee"""
+    if options.codec == "opus":
+        return Opusenc(options.opus_quality, options.debug).encode_args(audio_f)
+    elif options.codec == "vorbis":
+        return Oggenc(options.vorbis_quality, options.debug).encode_args(audio_f)
+    elif options.codec == "aac":
+        fdkaac = Fdkaac(options.aac_mode, options.aac_quality, options.debug)
+        return fdkaac.encode_args(audio_f, tags_file)
+    elif options.codec == "mp3":
+        return FFMPEG(options.debug).encode_lame_args(
+            audio_f, options.mp3_mode, options.mp3_quality
+        )
+    raise ValueError(f"Can not encode {options.codec} from a pipe")
+
+
+def retag_flac(
+    input_f: Path,
+    existing_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    """Write existing_f with the tags and album art of input_f to output_f.
+
+    existing_f was encoded from a version of input_f with the same audio, so only
+    the metadata is written, the audio is copied as it is.
+    """
+    if options.codec in ["opus", "vorbis"]:
+        retag_ogg(input_f, existing_f, output_f, options, art_cache)
+    elif options.codec == "mp3":
+        retag_mp3(input_f, existing_f, output_f, options, art_cache)
+    else:
+        raise ValueError(f"Can not retag {options.codec} files")
+
+
+def process_picture(
+    image: bytes, options: Options, art_cache: Optional[AlbumArtCache]
+) -> bytes:
+    """Optimize or resize the picture according to options.albumart"""
     imagemagick = ImageMagick(options.debug)
-    opusenc = Opusenc(options.opus_quality, options.debug)
-    pictures_bytes = None
-    discard = False
+
+    def convert(data: bytes) -> bytes:
+        if options.albumart == "resize":
+            return imagemagick.optimize_and_resize_picture(
+                data, options.albumart_max_width
+            )
+        elif options.albumart == "optimize":
+            return imagemagick.optimize_picture(data)
+        return data
+
+    with metrics.stage("albumart"):
+        if art_cache is None or options.albumart not in ["optimize", "resize"]:
+            return convert(image)
+        return art_cache.get(
+            image, options.albumart, options.albumart_max_width, convert
+        )
+
+
+async def process_picture_async(
+    image: bytes, options: Options, art_cache: Optional[AlbumArtCache]
+) -> bytes:
+    """Like process_picture, for the asyncio engine"""
+    if options.albumart not in ["optimize", "resize"]:
+        return image
+    imagemagick = ImageMagick(options.debug)
+    max_width = options.albumart_max_width if options.albumart == "resize" else None
+
+    async def convert(data: bytes) -> bytes:
+        results = await imagemagick.run_async(imagemagick.picture_args(max_width), data)
+        return results.stdout
+
+    with metrics.stage("albumart"):
+        if art_cache is None:
+            return await convert(image)
+        return await art_cache.get_async(
+            image, options.albumart, options.albumart_max_width, convert
+        )
+
+
+def _replaced_picture(input_f: Path, options: Options) -> Tuple[bool, Optional[bytes]]:
+    """Whether the encoder discards the pictures of input_f and the one to add instead
+
+    The picture to add still has to go through process_picture.
+    """
     if options.albumart == "discard":
-        discard = True
-    elif options.albumart == "keep":
-        # We do not need to extract the picture and just let opusenc take
-        # them over. This sacrifices a bit of modularity but avoids the
-        # extra step of extracting the picture and then reattaching it.
-        discard = False
-        pictures = None
+        return True, None
     elif options.albumart == "optimize" or options.albumart == "resize":
-        discard = True
-        pictures = None
-        image = metaflac.extract_picture(input_f)
-
+        image = extract_picture(input_f)
         if image is not None:
-            if options.albumart == "resize":
-                image = imagemagick.optimize_and_resize_picture(
-                    image, options.albumart_max_width
-                )
-            elif options.albumart == "optimize":
-                image = imagemagick.optimize_picture(image)
+            return True, image
+    # We do not need to extract the picture and just let the encoder take
+    # them over. This sacrifices a bit of modularity but avoids the
+    # extra step of extracting the picture and then reattaching it.
+    return False, None
 
-            pictures_bytes = [image]
-        else:
-            discard = False
 
+def _picture_file(stack: ExitStack, image: bytes) -> Path:
+    """Temporary file with image that is deleted when stack is closed.
+
+    opusenc only accepts pictures as paths.
+    """
+    tempfile = stack.enter_context(NamedTemporaryFile("wb"))
+    tempfile.write(image)
+    tempfile.flush()
+    return Path(tempfile.name)
+
+
+def encode_flac_to_opus(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    if options.encoder_backend == "native" and native.available("opus"):
+        try:
+            encode_flac_to_opus_native(input_f, output_f, options, art_cache)
+            return
+        except native.NativeUnsupportedError:
+            pass
+    opusenc = Opusenc(options.opus_quality, options.debug)
+    discard, image = _replaced_picture(input_f, options)
     with ExitStack() as stack:
-        if pictures_bytes is not None:
-            # Create temporary files since opusenc only accepts pictures
-            # as paths. The tempfiles are automaticlly deleted when going
-            # out of context.
-            tempfiles = []
-            for picture in pictures_bytes:
-                tempfile = stack.enter_context(NamedTemporaryFile("wb"))
-                tempfile.write(picture)
-                tempfile.flush()
-                tempfiles.append(tempfile)
-            pictures = [Path(tempfile.name) for tempfile in tempfiles]
-        else:
-            pictures = None
+        pictures = None
+        if image is not None:
+            image = process_picture(image, options, art_cache)
+            pictures = [_picture_file(stack, image)]
         opusenc.encode(input_f, output_f, discard, pictures)
 
 
-def encode_flac_to_vorbis(input_f: Path, output_f: Path, options: Options):
-    metaflac = Metaflac(options.debug)
-    imagemagick = ImageMagick(options.debug)
+async def encode_flac_to_opus_async(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    opusenc = Opusenc(options.opus_quality, options.debug)
+    discard, image = _replaced_picture(input_f, options)
+    with ExitStack() as stack:
+        pictures = None
+        if image is not None:
+            image = await process_picture_async(image, options, art_cache)
+            pictures = [_picture_file(stack, image)]
+        await opusenc.run_async(
+            opusenc.encode_file_args(input_f, output_f, discard, pictures)
+        )
+
+
+def encode_flac_to_opus_native(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    """Encode with libopusenc in a worker process, with the same result as opusenc"""
+    metadata = read_metadata(input_f, pictures=options.albumart != "discard")
+    if not native.supports(metadata.streaminfo):
+        raise native.NativeUnsupportedError
+    pictures = metadata.pictures
+    if options.albumart in ["optimize", "resize"] and pictures:
+        image = process_picture(pictures[0].data, options, art_cache)
+        # Like opusenc --picture without type and description
+        pictures = [Picture(3, "", "", 0, 0, 0, 0, image)]
+    bitrate = None
+    if options.opus_quality is not None:
+        bitrate = int(options.opus_quality * 1000)
+    native.run(
+        native.encode_flac_to_opus,
+        input_f,
+        output_f,
+        metadata.streaminfo,
+        metadata.tags,
+        pictures,
+        bitrate,
+    )
+
+
+def encode_flac_to_vorbis(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    encode_flacs_to_vorbis([(input_f, output_f)], options, art_cache)
+
+
+def encode_flacs_to_vorbis(
+    files: Sequence[Tuple[Path, Path]],
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    """Encode (input, output) pairs of files with as few oggenc calls as possible.
+
+    Files with the same album art are encoded by a single oggenc process that also
+    adds the picture comment, so the outputs do not need to be rewritten afterwards.
+    """
     oggenc = Oggenc(options.vorbis_quality, options.debug)
     vorbiscomment = VorbisComment(options.debug)
-    oggenc.encode(input_f, output_f)
-    if options.albumart == "discard":
-        return
+    groups: Dict[Optional[str], List[Tuple[Path, Path]]] = {}
+    for input_f, output_f in files:
+        block_picture = None
+        if options.albumart != "discard":
+            image = extract_picture(input_f)
+            if image is not None:
+                image = process_picture(image, options, art_cache)
+                block_picture = generate_metadata_block_picture_ogg(image)
+        groups.setdefault(block_picture, []).append((input_f, output_f))
 
-    image = metaflac.extract_picture(input_f)
-    if image is None:
+    for block_picture, group in groups.items():
+        comments, block_picture = _picture_comments(block_picture)
+        _encode_vorbis_group(oggenc, group, comments)
+        if block_picture is not None:
+            # Too large for the command line, add it in a second pass
+            for _, output_f in group:
+                vorbiscomment.add_comment(
+                    output_f, "METADATA_BLOCK_PICTURE", block_picture
+                )
+
+
+async def encode_flac_to_vorbis_async(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    oggenc = Oggenc(options.vorbis_quality, options.debug)
+    block_picture = None
+    if options.albumart != "discard":
+        image = extract_picture(input_f)
+        if image is not None:
+            image = await process_picture_async(image, options, art_cache)
+            block_picture = generate_metadata_block_picture_ogg(image)
+    comments, block_picture = _picture_comments(block_picture)
+    await oggenc.run_async(oggenc.encode_file_args(input_f, output_f, comments))
+    if block_picture is not None:
+        vorbiscomment = VorbisComment(options.debug)
+        await vorbiscomment.run_async(
+            vorbiscomment.add_comment_args(output_f),
+            f"METADATA_BLOCK_PICTURE={block_picture}".encode(),
+        )
+
+
+def _picture_comments(block_picture: Optional[str]) -> Tuple[List[str], Optional[str]]:
+    """oggenc comments that add block_picture and the block picture that is left.
+
+    A picture that is too large for the command line is left to vorbiscomment.
+    """
+    if block_picture is not None:
+        comment = f"METADATA_BLOCK_PICTURE={block_picture}"
+        if len(comment) < MAX_ARG_LENGTH:
+            return [comment], None
+    return [], block_picture
+
+
+def _encode_vorbis_group(
+    oggenc: Oggenc, group: List[Tuple[Path, Path]], comments: List[str]
+):
+    if len(group) == 1:
+        oggenc.encode(*group[0], comments)
         return
-    if options.albumart == "resize":
-        image = imagemagick.optimize_and_resize_picture(
-            image, options.albumart_max_width
+    # oggenc names the outputs after the inputs, so it gets symlinks to the inputs
+    # in a directory next to the outputs.
+    with TemporaryDirectory(prefix=TEMP_PREFIX, dir=group[0][1].parent) as tmp_dir:
+        links = []
+        try:
+            for index, (input_f, _) in enumerate(group):
+                link = Path(tmp_dir) / f"{index}.flac"
+                link.symlink_to(input_f.absolute())
+                links.append(link)
+        except OSError:
+            # No symlinks on this file system (e.g. FAT)
+            links = []
+        batch_failed = not links
+        if links:
+            try:
+                oggenc.encode_many(links, comments)
+            except CalledProcessError:
+                batch_failed = True
+        for index, (input_f, output_f) in enumerate(group):
+            output = Path(tmp_dir) / f"{index}.ogg"
+            if batch_failed or not output.exists():
+                # Encode the files one by one, so that an error shows which file
+                # caused it.
+                oggenc.encode(input_f, output_f, comments)
+            else:
+                os.replace(str(output), str(output_f))
+
+
+def retag_ogg(
+    input_f: Path,
+    existing_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    metadata = read_metadata(input_f, pictures=options.albumart != "discard")
+    pictures: List[str] = []
+    if options.codec == "opus" and options.albumart == "keep":
+        # opusenc takes over all pictures as they are
+        pictures = [
+            base64.b64encode(build_picture(picture)).decode()
+            for picture in metadata.pictures
+        ]
+    elif options.albumart != "discard" and metadata.pictures:
+        image = process_picture(metadata.pictures[0].data, options, art_cache)
+        pictures = [generate_metadata_block_picture_ogg(image)]
+    with metrics.stage("ogg.retag"):
+        ogg.replace_tags(existing_f, output_f, metadata.tags, pictures)
+
+
+def encode_flac_to_aac(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    ffmpeg = FFMPEG(options.debug)
+    fdkaac = Fdkaac(options.aac_mode, options.aac_quality, options.debug)
+
+    # Look at the stream parameters first, so that audio with a sample rate that is
+    # not supported by fdkaac is resampled right away instead of failing first.
+    metadata = read_metadata(input_f, pictures=options.albumart != "discard")
+    fs = None
+    if metadata.streaminfo.sample_rate not in FDKAAC_SAMPLERATES:
+        fs = options.aac_samplerate
+    # Stream the decoded audio directly from ffmpeg into fdkaac
+    try:
+        fdkaac.encode_from_process(ffmpeg.decode_caf_args(input_f, fs), output_f, None)
+    except FdkaacUnsupportedSamplerateError:
+        if fs is not None:
+            raise
+        # fdkaac rejected a sample rate that looked supported, resample after all.
+        fdkaac.encode_from_process(
+            ffmpeg.decode_caf_args(input_f, options.aac_samplerate), output_f, None
         )
-    elif options.albumart == "optimize":
-        image = imagemagick.optimize_picture(image)
 
-    block_picture = generate_metadata_block_picture_ogg(image)
-    vorbiscomment.add_comment(output_f, "METADATA_BLOCK_PICTURE", block_picture)
+    add_aac_artwork(output_f, input_f, options, art_cache, metadata)
 
 
-def encode_flac_to_aac(input_f: Path, output_f: Path, options: Options):
-    metaflac = Metaflac(options.debug)
-    imagemagick = ImageMagick(options.debug)
+async def encode_flac_to_aac_async(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
     ffmpeg = FFMPEG(options.debug)
     fdkaac = Fdkaac(options.aac_mode, options.aac_quality, options.debug)
-    atomicparsley = AtomicParsley(options.debug)
 
-    caf_content = ffmpeg.encode_caf(input_f)
+    metadata = read_metadata(input_f, pictures=options.albumart != "discard")
+    fs = None
+    if metadata.streaminfo.sample_rate not in FDKAAC_SAMPLERATES:
+        fs = options.aac_samplerate
     try:
-        fdkaac.encode_from_mem(caf_content, output_f, None)
+        await fdkaac.encode_from_process_async(
+            ffmpeg.decode_caf_args(input_f, fs), output_f, None
+        )
     except FdkaacUnsupportedSamplerateError:
-        # if we have an unsupported samplerate, resample to 48000 kHz
-        caf_content = ffmpeg.resample_caf(caf_content, 48000)
-        fdkaac.encode_from_mem(caf_content, output_f, None)
+        if fs is not None:
+            raise
+        await fdkaac.encode_from_process_async(
+            ffmpeg.decode_caf_args(input_f, options.aac_samplerate), output_f, None
+        )
 
-    if options.albumart == "discard":
+    image = metadata.picture_data() if options.albumart != "discard" else None
+    if image is None:
         return
+    image = await process_picture_async(image, options, art_cache)
+    atomicparsley = AtomicParsley(options.debug)
+    with ExitStack() as stack:
+        await atomicparsley.run_async(
+            atomicparsley.add_artwork_args(output_f, _picture_file(stack, image))
+        )
 
-    image = metaflac.extract_picture(input_f)
+
+def add_aac_artwork(
+    output_f: Path,
+    input_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+    metadata: Optional[FlacMetadata] = None,
+):
+    """Add the album art of input_f to the aac file output_f"""
+    if options.albumart == "discard":
+        return
+    if metadata is None:
+        image = extract_picture(input_f)
+    else:
+        image = metadata.picture_data()
     if image is None:
         return
-    if options.albumart == "resize":
-        image = imagemagick.optimize_and_resize_picture(
-            image, options.albumart_max_width
-        )
-    elif options.albumart == "optimize":
-        image = imagemagick.optimize_picture(image)
+    image = process_picture(image, options, art_cache)
+    atomicparsley = AtomicParsley(options.debug)
 
     with NamedTemporaryFile("wb") as image_file:
         image_file.write(image)
@@ -136,33 +590,55 @@ def encode_flac_to_aac(input_f: Path, output_f: Path, options: Options):
         atomicparsley.add_artwork(output_f, Path(image_file.name))
 
 
-def encode_flac_to_mp3(input_f: Path, output_f: Path, options: Options):
-    metaflac = Metaflac(options.debug)
-    imagemagick = ImageMagick(options.debug)
+def encode_flac_to_mp3(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
     ffmpeg = FFMPEG(options.debug)
-    discard = False
-    image = None
-    if options.albumart == "discard":
-        discard = True
-    elif options.albumart == "keep":
-        # We do not need to extract the picture and just let opusenc take
-        # them over. This sacrifices a bit of modularity but avoids the
-        # extra step of extracting the picture and then reattaching it.
-        discard = False
-    elif options.albumart == "optimize" or options.albumart == "resize":
-        discard = True
-        image = metaflac.extract_picture(input_f)
-
-        if image is not None:
-            if options.albumart == "resize":
-                image = imagemagick.optimize_and_resize_picture(
-                    image, options.albumart_max_width
-                )
-            elif options.albumart == "optimize":
-                image = imagemagick.optimize_picture(image)
-        else:
-            discard = False
-
+    discard, image = _replaced_picture(input_f, options)
+    if image is not None:
+        image = process_picture(image, options, art_cache)
     ffmpeg.encode_lame(
         input_f, output_f, image, discard, options.mp3_mode, options.mp3_quality
     )
+
+
+async def encode_flac_to_mp3_async(
+    input_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    ffmpeg = FFMPEG(options.debug)
+    discard, image = _replaced_picture(input_f, options)
+    if image is not None:
+        image = await process_picture_async(image, options, art_cache)
+    args = ffmpeg.encode_lame_file_args(
+        input_f,
+        output_f,
+        image is not None,
+        discard,
+        options.mp3_mode,
+        options.mp3_quality,
+    )
+    await ffmpeg.run_async(args, image)
+
+
+def retag_mp3(
+    input_f: Path,
+    existing_f: Path,
+    output_f: Path,
+    options: Options,
+    art_cache: Optional[AlbumArtCache] = None,
+):
+    ffmpeg = FFMPEG(options.debug)
+    image = None
+    if options.albumart in ["optimize", "resize"]:
+        image = extract_picture(input_f)
+        if image is not None:
+            image = process_picture(image, options, art_cache)
+    ffmpeg.retag_mp3(
+        existing_f, input_f, output_f, image, discard=options.albumart == "discard"
+    )
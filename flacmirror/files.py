@@ -1,5 +1,14 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional
+from stat import S_ISLNK, S_ISREG
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+# Outputs are written to files with this prefix next to the destination file and
+# only renamed to the destination file once they are complete.
+TEMP_PREFIX = ".flacmirror-tmp."
 
 
 def get_files(directory: Path) -> List[Path]:
@@ -8,26 +17,153 @@ def get_files(directory: Path) -> List[Path]:
     return list(files_filtered)
 
 
+class ScanResult(NamedTuple):
+    files: List[Path]
+    # lstat results keyed by str(file), only filled if requested
+    stats: Dict[str, os.stat_result]
+    directories: int
+    duration: float
+
+
+def name_matches(
+    name: str, extensions: Optional[Set[str]], allowed_names: Optional[Set[str]]
+) -> bool:
+    """Whether a file name has one of the extensions or is one of allowed_names"""
+    if extensions is None:
+        return True
+    # same rules as for Path.suffix
+    i = name.rfind(".")
+    if 0 < i < len(name) - 1 and name[i + 1 :] in extensions:
+        return True
+    return allowed_names is not None and name in allowed_names
+
+
+def _scan_directory(
+    path: str,
+    extensions: Optional[Set[str]],
+    allowed_names: Optional[Set[str]],
+    stat: bool,
+) -> Tuple[List[Tuple[str, Optional[os.stat_result]]], List[str]]:
+    files: List[Tuple[str, Optional[os.stat_result]]] = []
+    subdirs: List[str] = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    # Like rglob, do not descend into symlinked directories.
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    # The type info is cached by the DirEntry, but symlinks still need
+                    # to be followed to see if they point to a file.
+                    if not entry.is_file():
+                        continue
+                    if not name_matches(entry.name, extensions, allowed_names):
+                        continue
+                    files.append(
+                        (
+                            entry.path,
+                            entry.stat(follow_symlinks=False) if stat else None,
+                        )
+                    )
+                except OSError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return files, subdirs
+
+
+def scan_files(
+    directory: Path,
+    extensions: Optional[Iterable[str]],
+    allowed_names: Optional[Iterable[str]] = None,
+    stat: bool = False,
+    num_threads: Optional[int] = None,
+) -> ScanResult:
+    """Recursively find all files in directory using a pool of threads.
+
+    Subdirectories are scanned concurrently which helps a lot on high-latency network
+    mounts. If stat is set, lstat results of all found files are returned as well.
+    """
+    start_time = time.perf_counter()
+    extensions_set = set(extensions) if extensions is not None else None
+    allowed_names_set = set(allowed_names) if allowed_names is not None else None
+    found: List[Tuple[str, Optional[os.stat_result]]] = []
+    directories = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as ex:
+        pending = {
+            ex.submit(
+                _scan_directory,
+                str(directory.absolute()),
+                extensions_set,
+                allowed_names_set,
+                stat,
+            )
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                directories += 1
+                found.extend(files)
+                for subdir in subdirs:
+                    pending.add(
+                        ex.submit(
+                            _scan_directory,
+                            subdir,
+                            extensions_set,
+                            allowed_names_set,
+                            stat,
+                        )
+                    )
+    # Directories finish in random order, sort to get reproducible results.
+    found.sort(key=lambda item: item[0])
+    stats: Dict[str, os.stat_result] = {}
+    if stat:
+        stats = {file: file_stat for file, file_stat in found if file_stat is not None}
+    return ScanResult(
+        files=[Path(file) for file, _ in found],
+        stats=stats,
+        directories=directories,
+        duration=time.perf_counter() - start_time,
+    )
+
+
+def find_temp_files(
+    directories: Iterable[Path], num_threads: Optional[int] = None
+) -> List[Path]:
+    """Temporary files in directories, without descending into their subdirectories.
+
+    Only the temporary directories of batch encodes are looked into.
+    """
+    temp_files: List[Path] = []
+    with ThreadPoolExecutor(max_workers=num_threads) as ex:
+        for files, subdirs in ex.map(
+            lambda path: _scan_directory(path, None, None, False),
+            [str(directory) for directory in directories],
+        ):
+            temp_files.extend(
+                Path(file)
+                for file, _ in files
+                if os.path.basename(file).startswith(TEMP_PREFIX)
+            )
+            for subdir in subdirs:
+                if os.path.basename(subdir).startswith(TEMP_PREFIX):
+                    temp_files.extend(
+                        Path(file)
+                        for file, _ in _scan_directory(subdir, None, None, False)[0]
+                    )
+    temp_files.sort()
+    return temp_files
+
+
 def get_all_files(
     directory: Path,
     extensions: Optional[List[str]],
     allowed_names: Optional[List[str]] = None,
 ) -> List[Path]:
     # return one list with files to be converted and files to be copied interleaved
-    matches = directory.rglob("*")
-    # is_file() is what makes this slow since it needs to check symlinks too
-    files = [match for match in matches if match.is_file()]
-    files_filtered: List[Path] = []
-    for file in files:
-        if extensions is None:
-            files_filtered.append(file)
-        elif file.suffix and file.suffix[1:] in extensions:
-            files_filtered.append(file)
-        elif allowed_names is not None and file.name in allowed_names:
-            files_filtered.append(file)
-    files_absolute = [file.absolute() for file in files_filtered]
-
-    return list(files_absolute)
+    return scan_files(directory, extensions, allowed_names).files
 
 
 def generate_output_path(base: Path, input_suffix: str, suffix: str, file: Path):
@@ -39,5 +175,49 @@ def generate_output_path(base: Path, input_suffix: str, suffix: str, file: Path)
         return base / file.parent / (file.name)
 
 
-def source_is_newer(src_file: Path, dst_file: Path) -> bool:
-    return src_file.lstat().st_mtime >= dst_file.lstat().st_mtime
+def file_lstat(file: Path) -> Optional[os.stat_result]:
+    """lstat result of file like scan_files returns it, None if it is not a file"""
+    try:
+        file_stat = file.lstat()
+    except OSError:
+        return None
+    if S_ISREG(file_stat.st_mode):
+        return file_stat
+    # Like scan_files, symlinks count if they point to a file.
+    if S_ISLNK(file_stat.st_mode) and file.is_file():
+        return file_stat
+    return None
+
+
+def temp_path(dst_file: Path) -> Path:
+    # Keep the suffix, some tools choose the output format based on it.
+    return dst_file.with_name(TEMP_PREFIX + dst_file.name)
+
+
+def is_temp_file(file: Path) -> bool:
+    # Files in temporary directories (of batch encodes) are temporary as well.
+    return file.name.startswith(TEMP_PREFIX) or file.parent.name.startswith(TEMP_PREFIX)
+
+
+@contextmanager
+def atomic_output(dst_file: Path) -> Iterator[Path]:
+    """Yield a temporary path that is moved to dst_file if no exception occurs.
+
+    This makes sure that dst_file never exists in an incomplete state, even if the
+    program is killed while writing the output.
+    """
+    tmp_file = temp_path(dst_file)
+    try:
+        # leftover of an earlier run that was killed
+        tmp_file.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        yield tmp_file
+        os.replace(str(tmp_file), str(dst_file))
+    except BaseException:
+        try:
+            tmp_file.unlink()
+        except FileNotFoundError:
+            pass
+        raise
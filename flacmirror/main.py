@@ -1,12 +1,107 @@
 import argparse
+import os
 import signal
+from dataclasses import replace
 from pathlib import Path
+from typing import List
 
-from flacmirror.processes import check_requirements
+from flacmirror.processes import FDKAAC_SAMPLERATES, check_requirements
 
 from . import __version__
+from .distributed import (
+    DEFAULT_HOST,
+    Coordinator,
+    Worker,
+    is_loopback,
+    parse_address,
+)
 from .options import Options
 from .queue import JobQueue
+from .watch import Watcher, WatchError, watch
+
+ALBUMART_CHOICES = ["optimize", "resize", "keep", "discard"]
+
+
+def parse_target(spec: str, options: Options, codecs: List[str]) -> Options:
+    """Options for a --target DST_DIR,CODEC[,QUALITY[,ALBUMART]] specification.
+
+    Everything that is not part of spec is taken from options.
+    """
+    parts = spec.split(",")
+    # dst_dir may contain commas itself
+    codec_indices = [i for i, part in enumerate(parts) if i > 0 and part in codecs]
+    if not codec_indices:
+        raise ValueError(f"No codec in --target {spec}, available: {codecs}")
+    index = codec_indices[-1]
+    dst_dir = ",".join(parts[:index])
+    codec = parts[index]
+    rest = parts[index + 1 :]
+    if len(rest) > 2:
+        raise ValueError(f"Too many values in --target {spec}")
+    quality = rest[0] if rest and rest[0] else None
+    albumart = rest[1] if len(rest) > 1 and rest[1] else options.albumart
+    if albumart not in ALBUMART_CHOICES:
+        raise ValueError(f"Album art mode must be one of {ALBUMART_CHOICES}")
+    target = replace(options, dst_dir=Path(dst_dir), codec=codec, albumart=albumart)
+    try:
+        if quality is None:
+            pass
+        elif codec == "opus":
+            target.opus_quality = float(quality)
+        elif codec == "vorbis":
+            target.vorbis_quality = int(quality)
+        elif codec == "aac":
+            target.aac_mode = 0
+            target.aac_quality = int(quality)
+        else:  # codec == "mp3"
+            target.mp3_mode = "vbr"
+            target.mp3_quality = int(quality)
+    except ValueError:
+        raise ValueError(f"Invalid quality in --target {spec}") from None
+    if codec == "aac" and target.aac_mode not in range(1, 6) and quality is None:
+        target.aac_quality = 128
+    return target
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
+def positive_float(value: str) -> float:
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"must be positive, not {number}")
+    return number
+
+
+def run_worker(arg_results: argparse.Namespace):
+    try:
+        host, port = parse_address(arg_results.worker)
+    except ValueError:
+        print(f"Invalid address for --worker: {arg_results.worker}")
+        return
+    if not host:
+        print("--worker requires the host of the coordinator.")
+        return
+    worker = Worker(
+        host,
+        port,
+        Path(arg_results.src_dir) if arg_results.src_dir is not None else None,
+        Path(arg_results.dst_dir) if arg_results.dst_dir is not None else None,
+        arg_results.num_threads or os.cpu_count() or 1,
+        arg_results.debug,
+        arg_results.token,
+    )
+
+    def sig_handler(_signum, _frame):
+        print("\nReceived SIGINT")
+        worker.stop()
+
+    signal.signal(signal.SIGINT, sig_handler)
+    worker.run()
 
 
 def main():
@@ -23,16 +118,20 @@ def main():
     )
     argparser.add_argument(
         "src_dir",
+        nargs="?",
         help=(
             "The source directory. This directory will be recursively scanned for flac"
-            " files to be encoded."
+            " files to be encoded. With --worker, the optional local mount of the"
+            " coordinator's src_dir."
         ),
     )
     argparser.add_argument(
         "dst_dir",
+        nargs="?",
         help=(
             "The destination directory. Encoded files will be saved here using the same"
-            " directory structure as in src_dir."
+            " directory structure as in src_dir. With --worker, the optional local"
+            " mount of the coordinator's dst_dir."
         ),
     )
     argparser.add_argument(
@@ -41,6 +140,21 @@ def main():
         choices=codecs,
         help="Specify which target codec to use.",
     )
+    argparser.add_argument(
+        "--target",
+        type=str,
+        action="append",
+        help=(
+            "Mirror src_dir to another destination in the same run, given as"
+            " DST_DIR,CODEC[,QUALITY[,ALBUMART]]. QUALITY is the opus bitrate in"
+            " kbit/s, the vorbis quality, the aac CBR bitrate or the mp3 VBR level."
+            " Settings that are not given are the same as for dst_dir. src_dir is"
+            " scanned once for all targets, cover art is only processed once and,"
+            " if flac is installed, every file is only decoded once."
+            " This option can be used multiple times. For example --target"
+            " /mnt/car,mp3,2 --target /mnt/phone,opus,96,resize"
+        ),
+    )
     argparser.add_argument(
         "--opus-quality",
         type=float,
@@ -81,6 +195,16 @@ def main():
             " passed to the --bitrate-mode argument of fdkaac."
         ),
     )
+    argparser.add_argument(
+        "--aac-samplerate",
+        type=int,
+        default=48000,
+        help=(
+            "If aac encoding is selected, audio with a sample rate that is not"
+            " supported by fdkaac is resampled to AAC_SAMPLERATE (in Hz) before"
+            " encoding. Defaults to 48000."
+        ),
+    )
     argparser.add_argument(
         "--mp3-quality",
         type=int,
@@ -107,7 +231,7 @@ def main():
         "--albumart",
         type=str,
         default="optimize",
-        choices=["optimize", "resize", "keep", "discard"],
+        choices=ALBUMART_CHOICES,
         help=(
             "Specify what to do with album covers. Defaults to 'optimize'. 'optimize'"
             " will try to optimize the picture for better size, while 'resize' will"
@@ -126,17 +250,42 @@ def main():
             " greater). Defaults to 750. Only used when --albumart is set to resize."
         ),
     )
+    argparser.add_argument(
+        "--albumart-cache-dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory in which optimized or resized album art is cached across runs."
+            " Pictures are always cached in memory for the duration of a run."
+        ),
+    )
     argparser.add_argument(
         "--overwrite",
         type=str,
         default="old",
-        choices=["all", "none", "old"],
+        choices=["all", "none", "old", "changed"],
         help=(
             "Specify if or when existing files should be overwritten. 'all' means that"
             " files are always overwritten, 'none' means that files are never"
             " overwritten and 'old' means that files are only overwritten if the source"
             " file has changed since (the source file's modification date is newer)."
-            " Defaults to 'old'."
+            " 'changed' (requires --manifest) only overwrites files if the audio (the"
+            " MD5 in STREAMINFO), tags or pictures of the source changed, no matter"
+            " how the modification dates moved. Files without an MD5 and copied files"
+            " are handled like with 'old'. Defaults to 'old'."
+        ),
+    )
+    argparser.add_argument(
+        "--manifest",
+        action="store_true",
+        help=(
+            "Keep a manifest of all mirrored files and the settings they were encoded"
+            " with in dst_dir. Unchanged source files are then skipped without looking"
+            " at the destination, and files encoded with different settings are"
+            " re-encoded. If only the tags or album art of a source changed, the"
+            " existing opus, vorbis or mp3 file only gets the new metadata instead of"
+            " being encoded again. Output files that were deleted by hand are not"
+            " restored while their source is unchanged (use --overwrite all)."
         ),
     )
     argparser.add_argument(
@@ -170,12 +319,176 @@ def main():
             " m3u --copy-ext log --copy-ext jpg. This will not copy flac files."
         ),
     )
+    argparser.add_argument(
+        "--link-copies",
+        action="store_true",
+        help=(
+            "Create hardlinks instead of copies for files selected by --copy-file and"
+            " --copy-ext if src_dir and dst_dir are on the same file system. Note that"
+            " changing a linked file in dst_dir also changes it in src_dir."
+        ),
+    )
+    argparser.add_argument(
+        "--dedup",
+        action="store_true",
+        help=(
+            "Encode flac files with identical audio (the same MD5 in STREAMINFO) and"
+            " album art only once per run, e.g. tracks that are also on a"
+            " compilation. The other outputs are hardlinked to the encoded file if"
+            " possible, or copied with their own tags (opus and vorbis only, mp3 and"
+            " aac files with different tags are encoded again). Note that changing a"
+            " linked output also changes the others."
+        ),
+    )
     argparser.add_argument(
         "--num-threads",
         type=int,
         default=None,
         help=(
-            "Number of threads to use. Defaults to the number of threads in the system."
+            "Number of threads to use for encoding. Defaults to the number of threads"
+            " in the system."
+        ),
+    )
+    argparser.add_argument(
+        "--io-threads",
+        type=positive_int,
+        default=4,
+        help=(
+            "Number of threads to use for copying and deleting files. These run"
+            " separately from the encoding threads. Defaults to 4."
+        ),
+    )
+    argparser.add_argument(
+        "--schedule",
+        type=str,
+        default="fifo",
+        choices=["fifo", "lpt"],
+        help=(
+            "Order in which jobs are run. 'fifo' runs jobs in the order in which the"
+            " files were found, 'lpt' runs the jobs with the longest estimated"
+            " duration first, which keeps all threads busy until the end."
+            " Defaults to 'fifo'."
+        ),
+    )
+    argparser.add_argument(
+        "--encoder-backend",
+        type=str,
+        default="process",
+        choices=["process", "native"],
+        help=(
+            "'process' runs the encoder programs for every file. 'native' encodes"
+            " opus in worker processes with libFLAC and libopusenc (if installed)"
+            " instead, which saves starting several processes per file. Files the"
+            " libraries can not handle and other codecs still use the programs."
+            " Defaults to 'process'."
+        ),
+    )
+    argparser.add_argument(
+        "--engine",
+        type=str,
+        default="threads",
+        choices=["threads", "asyncio"],
+        help=(
+            "'threads' runs every job in a thread of a thread pool. 'asyncio' runs"
+            " jobs on an event loop that starts the encoder processes and reads their"
+            " output, so that encodes, copies and deletions need no thread of their"
+            " own. Jobs that combine several files (vorbis batches, --target,"
+            " --dedup), retagging and --encoder-backend native still run in threads."
+            " Defaults to 'threads'."
+        ),
+    )
+    argparser.add_argument(
+        "--job-timeout",
+        type=positive_float,
+        default=None,
+        help=(
+            "Give up on a job that takes longer than JOB_TIMEOUT seconds. Its"
+            " encoder processes are stopped, the file is reported as failed and"
+            " the other jobs keep running."
+        ),
+    )
+    argparser.add_argument(
+        "--max-memory",
+        type=int,
+        default=None,
+        metavar="MB",
+        help=(
+            "Only start encode jobs while the sum of their estimated peak memory"
+            " (encoder processes and decoded album art) stays below MB megabytes. A"
+            " job that needs more than that runs on its own. The actual peak memory"
+            " of the run is reported at the end."
+        ),
+    )
+    argparser.add_argument(
+        "--coordinator",
+        type=str,
+        default=None,
+        metavar="[HOST:]PORT",
+        help=(
+            "Do not encode here, but listen on PORT for workers started with --worker"
+            " on other machines and let them encode the files. Copies and deletions"
+            " are still done here. Jobs of workers that stop responding are given to"
+            f" other workers. HOST defaults to {DEFAULT_HOST}, listening on other"
+            " addresses (e.g. 0.0.0.0) requires --token."
+        ),
+    )
+    argparser.add_argument(
+        "--worker",
+        type=str,
+        default=None,
+        metavar="HOST:PORT",
+        help=(
+            "Encode files for the coordinator at HOST:PORT with --num-threads"
+            " threads, using its settings. If src_dir or dst_dir are given, the"
+            " source files are read from and the outputs written to these mounts of"
+            " the coordinator's directories, otherwise they are sent over the network."
+        ),
+    )
+    argparser.add_argument(
+        "--token",
+        type=str,
+        default=os.environ.get("FLACMIRROR_TOKEN"),
+        help=(
+            "Shared secret that workers need to know to be accepted by the"
+            " coordinator. Defaults to the environment variable FLACMIRROR_TOKEN."
+            " It is sent in plain text, so only use this on trusted networks."
+        ),
+    )
+    argparser.add_argument(
+        "--metrics-json",
+        type=str,
+        default=None,
+        help=(
+            "Write a report with timings of every stage of the run, the number of"
+            " jobs, bytes read and written and worker utilization to METRICS_JSON."
+        ),
+    )
+    argparser.add_argument(
+        "--metrics-prom",
+        type=str,
+        default=None,
+        help=(
+            "Write the same report as --metrics-json in the Prometheus text format"
+            " to METRICS_PROM (e.g. for the textfile collector of node_exporter)."
+        ),
+    )
+    argparser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "After synchronizing, keep running and watch src_dir for changes (Linux"
+            " only). Only new, changed or removed files are mirrored, without scanning"
+            " the whole directory again. Requires --yes if --delete is set."
+        ),
+    )
+    argparser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=5.0,
+        help=(
+            "With --watch, wait until there were no changes for WATCH_DEBOUNCE seconds"
+            " before mirroring them, so that albums that are being copied are handled"
+            " at once. Defaults to 5."
         ),
     )
     argparser.add_argument(
@@ -192,24 +505,60 @@ def main():
         "--version", action="version", version=f"%(prog)s {__version__}"
     )
     arg_results = argparser.parse_args()
+    if arg_results.worker is not None:
+        run_worker(arg_results)
+        return
+    if arg_results.src_dir is None or arg_results.dst_dir is None:
+        argparser.error("the following arguments are required: src_dir, dst_dir")
     options = Options(
         src_dir=Path(arg_results.src_dir),
         dst_dir=Path(arg_results.dst_dir),
         codec=arg_results.codec,
         albumart=arg_results.albumart,
         albumart_max_width=arg_results.albumart_max_width,
+        albumart_cache_dir=(
+            Path(arg_results.albumart_cache_dir)
+            if arg_results.albumart_cache_dir is not None
+            else None
+        ),
         overwrite=arg_results.overwrite,
         delete=arg_results.delete,
+        manifest=arg_results.manifest,
         yes=arg_results.yes,
         copy_file=arg_results.copy_file,
         copy_ext=arg_results.copy_ext,
+        link_copies=arg_results.link_copies,
+        dedup=arg_results.dedup,
         num_threads=arg_results.num_threads,
+        io_threads=arg_results.io_threads,
+        schedule=arg_results.schedule,
+        encoder_backend=arg_results.encoder_backend,
+        engine=arg_results.engine,
+        job_timeout=arg_results.job_timeout,
+        max_memory=(
+            arg_results.max_memory * 2**20
+            if arg_results.max_memory is not None
+            else None
+        ),
         opus_quality=arg_results.opus_quality,
         vorbis_quality=arg_results.vorbis_quality,
         aac_quality=arg_results.aac_quality,
         aac_mode=arg_results.aac_mode,
+        aac_samplerate=arg_results.aac_samplerate,
         mp3_quality=arg_results.mp3_quality,
         mp3_mode=arg_results.mp3_mode,
+        metrics_json=(
+            Path(arg_results.metrics_json)
+            if arg_results.metrics_json is not None
+            else None
+        ),
+        metrics_prom=(
+            Path(arg_results.metrics_prom)
+            if arg_results.metrics_prom is not None
+            else None
+        ),
+        watch=arg_results.watch,
+        watch_debounce=arg_results.watch_debounce,
         dry_run=arg_results.dry_run,
         debug=arg_results.debug,
     )
@@ -227,19 +576,99 @@ def main():
             print("--mp3-quality must be specified.")
             return
 
+    targets: List[Options] = []
+    for spec in arg_results.target or []:
+        try:
+            targets.append(parse_target(spec, options, codecs))
+        except ValueError as e:
+            print(e)
+            return
+    if any(
+        target.codec == "aac" and target.aac_samplerate not in FDKAAC_SAMPLERATES
+        for target in [options, *targets]
+    ):
+        print("--aac-samplerate must be one of" f" {sorted(FDKAAC_SAMPLERATES)}.")
+        return
+    dst_dirs = [target.dst_dir.absolute() for target in [options, *targets]]
+    if len(set(dst_dirs)) != len(dst_dirs):
+        print("Every target needs its own destination directory.")
+        return
+
     # make sure we have all the programs installed
-    if not check_requirements(options):
+    if not all(check_requirements(target) for target in [options, *targets]):
         print(
             "Not all requirements are met, make sure that tools marked "
             "as unavailable are installed correctly."
         )
         return
 
-    job_queue = JobQueue(options)
+    coordinator_address = None
+    if arg_results.coordinator is not None:
+        try:
+            coordinator_address = parse_address(arg_results.coordinator, DEFAULT_HOST)
+        except ValueError:
+            print(f"Invalid address for --coordinator: {arg_results.coordinator}")
+            return
+        if not is_loopback(coordinator_address[0]) and arg_results.token is None:
+            # Workers get the source files and send back files that are written
+            # to dst_dir, so only trusted ones may connect.
+            print("--coordinator on a non-loopback address requires --token.")
+            return
+        if options.watch or options.dry_run:
+            print("--coordinator can not be used with --watch or --dry-run.")
+            return
+        if options.delete and not options.yes:
+            print("--coordinator with --delete requires --yes.")
+            return
+        if options.dedup:
+            print("--dedup is not supported with --coordinator.")
+            return
+        if options.max_memory is not None:
+            print("--max-memory is not supported with --coordinator.")
+            return
+
+    if options.max_memory is not None and options.max_memory <= 0:
+        print("--max-memory must be positive.")
+        return
+
+    if options.overwrite == "changed" and not options.manifest:
+        print("--overwrite changed requires --manifest.")
+        return
+
+    if options.watch and options.delete and not options.yes:
+        print("--watch with --delete requires --yes.")
+        return
+
+    watcher = None
+    if options.watch:
+        # Start watching before scanning, so that no change gets lost.
+        try:
+            watcher = Watcher(options.src_dir.absolute())
+        except WatchError as e:
+            print(e)
+            return
+
+    job_queue = JobQueue(options, targets)
+
+    if coordinator_address is not None:
+        try:
+            coordinator = Coordinator(
+                job_queue, *coordinator_address, token=arg_results.token
+            )
+        except OSError as e:
+            print(f"Could not listen on {arg_results.coordinator}: {e}")
+            return
+        signal.signal(signal.SIGINT, lambda _signum, _frame: coordinator.cancel())
+        coordinator.run()
+        return
 
     def sig_handler(_signum, _frame):
         print("\nReceived SIGINT")
         job_queue.cancel()
+        if watcher is not None:
+            watcher.stop()
 
     signal.signal(signal.SIGINT, sig_handler)
     job_queue.run()
+    if watcher is not None:
+        watch(watcher, job_queue)
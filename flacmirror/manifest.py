@@ -0,0 +1,174 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, NamedTuple, Optional, Set, Tuple
+
+from .metadata import FlacError, read_fingerprint
+from .options import Options
+
+# The manifest lives in the root of the destination directory. Files starting with
+# this name are never treated as orphans by --delete.
+MANIFEST_NAME = ".flacmirror.sqlite"
+COLUMNS = "src, src_size, src_mtime_ns, settings, dst, src_inode, fingerprint"
+# Fingerprint of sources without one, so that they are not read again
+NO_FINGERPRINT = "none"
+
+
+class ManifestEntry(NamedTuple):
+    src_size: int
+    src_mtime_ns: int
+    settings: str
+    dst_file: str
+    src_inode: int = 0
+    # See read_fingerprint, empty if it was not looked at
+    fingerprint: str = ""
+
+    def same_source(self, other: "ManifestEntry") -> bool:
+        """Whether the source file and settings did not change, going by the stats"""
+        return self[:4] == other[:4]
+
+    @property
+    def content_known(self) -> bool:
+        """Whether the fingerprint identifies the content of the source"""
+        return self.fingerprint not in ["", NO_FINGERPRINT]
+
+    @property
+    def audio_md5(self) -> str:
+        """The part of the fingerprint that only depends on the audio"""
+        return self.fingerprint.partition("-")[0] if self.content_known else ""
+
+
+class FingerprintCache:
+    """Thread-safe cache of the fingerprints of source files.
+
+    Fingerprints are keyed by the inode, size and mtime of the file, so files that did
+    not change are not read again, even if they were moved.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._fingerprints: Dict[Tuple[int, int, int], Optional[str]] = {}
+
+    def add_manifest(self, manifest: "Manifest"):
+        """Remember the fingerprints recorded in manifest"""
+        with self._lock:
+            for entry in manifest.entries.values():
+                if entry.src_inode and entry.fingerprint:
+                    key = (entry.src_inode, entry.src_size, entry.src_mtime_ns)
+                    self._fingerprints[key] = (
+                        entry.fingerprint if entry.content_known else None
+                    )
+
+    def get(self, file: Path, stat: os.stat_result) -> Optional[str]:
+        """Fingerprint of the flac file, None if it has none or can not be read"""
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key in self._fingerprints:
+                return self._fingerprints[key]
+        try:
+            fingerprint = read_fingerprint(file)
+        except (OSError, FlacError):
+            fingerprint = None
+        with self._lock:
+            self._fingerprints[key] = fingerprint
+        return fingerprint
+
+
+def job_settings(options: Options, src_file: Path) -> str:
+    """Serialized settings that influence the output for src_file.
+
+    If these change, the output has to be regenerated.
+    """
+    if src_file.suffix != ".flac":
+        return "copy"
+    settings: Dict[str, object] = {"codec": options.codec, "albumart": options.albumart}
+    if options.albumart == "resize":
+        settings["albumart_max_width"] = options.albumart_max_width
+    if options.codec == "opus":
+        settings["quality"] = options.opus_quality
+    elif options.codec == "vorbis":
+        settings["quality"] = options.vorbis_quality
+    elif options.codec == "aac":
+        settings["mode"] = options.aac_mode
+        settings["quality"] = options.aac_quality
+        settings["samplerate"] = options.aac_samplerate
+    elif options.codec == "mp3":
+        settings["mode"] = options.mp3_mode
+        settings["quality"] = options.mp3_quality
+    return json.dumps(settings, sort_keys=True)
+
+
+class Manifest:
+    """Records the state of every mirrored file from the last run.
+
+    Entries are keyed by the source path relative to src_dir. Changes are kept in
+    memory and only written to disk when calling save().
+    """
+
+    def __init__(self, path: Path, entries: Dict[str, ManifestEntry]):
+        self.path = path
+        self.entries = entries
+        self._dirty: Set[str] = set()
+        self._removed: Set[str] = set()
+
+    @classmethod
+    def load(cls, dst_dir: Path) -> "Manifest":
+        path = dst_dir / MANIFEST_NAME
+        entries: Dict[str, ManifestEntry] = {}
+        if path.exists():
+            con = sqlite3.connect(str(path))
+            try:
+                for src, *values in con.execute(f"SELECT {COLUMNS} FROM files"):
+                    entries[src] = ManifestEntry(*values)
+            finally:
+                con.close()
+        return cls(path, entries)
+
+    def get(self, src_file: str) -> Optional[ManifestEntry]:
+        return self.entries.get(src_file)
+
+    def update(self, src_file: str, entry: ManifestEntry):
+        self.entries[src_file] = entry
+        self._dirty.add(src_file)
+        self._removed.discard(src_file)
+
+    def remove(self, src_file: str):
+        if self.entries.pop(src_file, None) is not None:
+            self._dirty.discard(src_file)
+            self._removed.add(src_file)
+
+    def prune(self, keep: Iterable[str]):
+        """Remove all entries whose source file is not in keep"""
+        keep_set = set(keep)
+        for src_file in list(self.entries):
+            if src_file not in keep_set:
+                del self.entries[src_file]
+                self._dirty.discard(src_file)
+                self._removed.add(src_file)
+
+    def save(self):
+        if not self._dirty and not self._removed and self.path.exists():
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(str(self.path))
+        try:
+            with con:
+                con.execute(
+                    "CREATE TABLE IF NOT EXISTS files (src TEXT PRIMARY KEY,"
+                    " src_size INTEGER, src_mtime_ns INTEGER, settings TEXT, dst TEXT,"
+                    " src_inode INTEGER, fingerprint TEXT)"
+                )
+                con.executemany(
+                    "DELETE FROM files WHERE src = ?",
+                    ((src_file,) for src_file in self._removed),
+                )
+                con.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ((src_file, *self.entries[src_file]) for src_file in self._dirty),
+                )
+        finally:
+            con.close()
+        self._dirty = set()
+        self._removed = set()
@@ -0,0 +1,178 @@
+import os
+import resource
+import sys
+import threading
+from collections import deque
+from concurrent.futures import CancelledError
+from pathlib import Path
+from typing import Deque, Dict, List, Optional
+
+from .metadata import FlacError, PictureSize, read_picture_sizes
+from .options import Options
+
+# Rough peak memory of the encoder processes of a job and their pipe buffers. No
+# encoder path holds the decoded audio in memory, every one of them streams it.
+ENCODE_MEMORY = 64 * 2**20
+# ImageMagick works with 16 bits per channel and RGBA, and holds the decoded input
+# and the output picture at the same time.
+DECODED_BYTES_PER_PIXEL = 2 * 8
+# Pixels per byte of compressed picture if the PICTURE block does not tell the size
+PIXELS_PER_PICTURE_BYTE = 10
+# Upper bound of the size of encoded audio, for jobs that rewrite a whole output in
+# memory. 320 kbit/s is the highest bitrate of the supported lossy codecs.
+OUTPUT_BYTES_PER_SECOND = 40_000
+
+
+def picture_memory(picture: PictureSize) -> int:
+    """Peak memory of converting a picture with ImageMagick"""
+    pixels = picture.width * picture.height
+    if pixels == 0:
+        pixels = picture.data_length * PIXELS_PER_PICTURE_BYTE
+    return pixels * DECODED_BYTES_PER_PIXEL + 2 * picture.data_length
+
+
+def estimate_memory(src_file: Path, options: Options, rewrite: bool = False) -> int:
+    """Estimated peak memory of encoding src_file in bytes.
+
+    If rewrite is set, the job also rewrites the whole output in memory.
+    """
+    try:
+        streaminfo, pictures = read_picture_sizes(src_file)
+    except (OSError, FlacError):
+        return ENCODE_MEMORY
+    memory = ENCODE_MEMORY
+    if options.albumart == "keep":
+        # The pictures are read and passed on as they are.
+        memory += sum(2 * picture.data_length for picture in pictures)
+    elif options.albumart != "discard" and pictures:
+        # Only the first picture is converted, like with metaflac.
+        memory += picture_memory(pictures[0])
+    if rewrite:
+        # The output as it is and with the new comments
+        memory += 2 * int(streaminfo.duration * OUTPUT_BYTES_PER_SECOND)
+    return memory
+
+
+class MemoryBudget:
+    """Thread-safe admission of jobs while their estimated memory fits into limit.
+
+    Jobs are admitted in the order they ask. A job that is larger than the whole
+    budget is admitted once nothing else runs, and nothing else is admitted until it
+    finished.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.running = 0
+        self.peak = 0
+        self.cancelled = False
+        self._condition = threading.Condition()
+        self._waiting: Deque[object] = deque()
+
+    def fits(self, amount: int) -> bool:
+        return self.running == 0 or self.used + amount <= self.limit
+
+    def add(self, amount: int):
+        with self._condition:
+            self.used += amount
+            self.running += 1
+            self.peak = max(self.peak, self.used)
+
+    def remove(self, amount: int):
+        with self._condition:
+            self.used -= amount
+            self.running -= 1
+            self._condition.notify_all()
+
+    def acquire(self, amount: int):
+        """Wait until a job of amount bytes can start.
+
+        Raises CancelledError if the budget is cancelled while waiting.
+        """
+        with self._condition:
+            ticket = object()
+            self._waiting.append(ticket)
+            try:
+                self._condition.wait_for(
+                    lambda: self.cancelled
+                    or (self._waiting[0] is ticket and self.fits(amount))
+                )
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+            if self.cancelled:
+                raise CancelledError()
+            self.add(amount)
+
+    def cancel(self):
+        """Let no more jobs start, waiting ones raise CancelledError"""
+        with self._condition:
+            self.cancelled = True
+            self._condition.notify_all()
+
+
+def process_tree_rss() -> int:
+    """Resident memory of this process and all its descendants in bytes"""
+    children: Dict[int, List[int]] = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat") as f:
+                # The command name may contain spaces, the fields after it do not.
+                ppid = int(f.read().rpartition(")")[2].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry.name))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    rss = 0
+    pids = [os.getpid()]
+    while pids:
+        pid = pids.pop()
+        pids += children.get(pid, [])
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                rss += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            pass
+    return rss
+
+
+class PeakRss:
+    """Samples the resident memory of this process and its children in a thread.
+
+    Without /proc, the peak of this process and the peak of its largest child are
+    added up instead.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if os.path.isdir("/proc/self"):
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> int:
+        """Stop sampling and return the peak in bytes"""
+        if self._thread is None:
+            # ru_maxrss is in KiB on Linux and in bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            self.peak = scale * (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            )
+        else:
+            self._stop.set()
+            self._thread.join()
+        return self.peak
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, process_tree_rss())
+            if self._stop.wait(self.interval):
+                return
@@ -0,0 +1,294 @@
+import hashlib
+import struct
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .metrics import metrics
+
+BLOCK_STREAMINFO = 0
+BLOCK_PADDING = 1
+BLOCK_VORBIS_COMMENT = 4
+BLOCK_PICTURE = 6
+# Blocks besides the audio that end up in the encoded files
+FINGERPRINT_BLOCKS = {BLOCK_VORBIS_COMMENT, BLOCK_PICTURE}
+
+
+class FlacError(Exception):
+    pass
+
+
+class StreamInfo(NamedTuple):
+    min_blocksize: int
+    max_blocksize: int
+    min_framesize: int
+    max_framesize: int
+    sample_rate: int
+    channels: int
+    bits_per_sample: int
+    total_samples: int
+    md5: bytes
+
+    @property
+    def duration(self) -> float:
+        """Duration in seconds, 0 if unknown"""
+        if self.sample_rate == 0:
+            return 0.0
+        return self.total_samples / self.sample_rate
+
+
+class Picture(NamedTuple):
+    picture_type: int
+    mime: str
+    description: str
+    width: int
+    height: int
+    depth: int
+    colors: int
+    data: bytes
+
+
+class PictureSize(NamedTuple):
+    width: int
+    height: int
+    data_length: int
+
+
+@dataclass
+class FlacMetadata:
+    streaminfo: StreamInfo
+    vendor: str = ""
+    tags: List[Tuple[str, str]] = field(default_factory=list)
+    pictures: List[Picture] = field(default_factory=list)
+
+    def tags_dict(self) -> Dict[str, str]:
+        # Like metaflac, keep the last value if a key exists multiple times.
+        return {key: value for key, value in self.tags}
+
+    def picture_data(self) -> Optional[bytes]:
+        # metaflac --export-picture-to also exports the first picture
+        if not self.pictures:
+            return None
+        return self.pictures[0].data
+
+
+def _read_exactly(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise FlacError("Unexpected end of file")
+    return data
+
+
+def _skip_id3v2(f: BinaryIO) -> bytes:
+    # Some taggers put an ID3v2 tag in front of the flac stream, skip it.
+    marker = _read_exactly(f, 4)
+    if marker[:3] != b"ID3":
+        return marker
+    header = marker + _read_exactly(f, 6)
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    if header[5] & 0x10:  # footer present
+        size += 10
+    f.seek(size, 1)
+    return _read_exactly(f, 4)
+
+
+def parse_streaminfo(data: bytes) -> StreamInfo:
+    if len(data) < 34:
+        raise FlacError("STREAMINFO block too short")
+    min_blocksize, max_blocksize = struct.unpack(">HH", data[0:4])
+    min_framesize = int.from_bytes(data[4:7], "big")
+    max_framesize = int.from_bytes(data[7:10], "big")
+    (packed,) = struct.unpack(">Q", data[10:18])
+    return StreamInfo(
+        min_blocksize=min_blocksize,
+        max_blocksize=max_blocksize,
+        min_framesize=min_framesize,
+        max_framesize=max_framesize,
+        sample_rate=packed >> 44,
+        channels=((packed >> 41) & 0x7) + 1,
+        bits_per_sample=((packed >> 36) & 0x1F) + 1,
+        total_samples=packed & 0xFFFFFFFFF,
+        md5=data[18:34],
+    )
+
+
+def parse_vorbis_comment(data: bytes) -> Tuple[str, List[Tuple[str, str]]]:
+    try:
+        (vendor_length,) = struct.unpack_from("<I", data, 0)
+        pos = 4
+        vendor = data[pos : pos + vendor_length].decode("utf-8", "replace")
+        pos += vendor_length
+        (count,) = struct.unpack_from("<I", data, pos)
+        pos += 4
+        tags: List[Tuple[str, str]] = []
+        for _ in range(count):
+            (length,) = struct.unpack_from("<I", data, pos)
+            pos += 4
+            comment = data[pos : pos + length].decode("utf-8", "replace")
+            pos += length
+            key, _, value = comment.partition("=")
+            tags.append((key, value))
+    except struct.error:
+        raise FlacError("Invalid VORBIS_COMMENT block") from None
+    return vendor, tags
+
+
+def parse_picture(data: bytes) -> Picture:
+    try:
+        picture_type, mime_length = struct.unpack_from(">II", data, 0)
+        pos = 8
+        mime = data[pos : pos + mime_length].decode("ascii", "replace")
+        pos += mime_length
+        (description_length,) = struct.unpack_from(">I", data, pos)
+        pos += 4
+        description = data[pos : pos + description_length].decode("utf-8", "replace")
+        pos += description_length
+        width, height, depth, colors, data_length = struct.unpack_from(
+            ">IIIII", data, pos
+        )
+        pos += 20
+    except struct.error:
+        raise FlacError("Invalid PICTURE block") from None
+    return Picture(
+        picture_type=picture_type,
+        mime=mime,
+        description=description,
+        width=width,
+        height=height,
+        depth=depth,
+        colors=colors,
+        data=data[pos : pos + data_length],
+    )
+
+
+def build_picture(picture: Picture) -> bytes:
+    """The data of a PICTURE block, which is also used for METADATA_BLOCK_PICTURE"""
+    mime = picture.mime.encode("ascii", "replace")
+    description = picture.description.encode()
+    return b"".join(
+        [
+            struct.pack(">II", picture.picture_type, len(mime)),
+            mime,
+            struct.pack(">I", len(description)),
+            description,
+            struct.pack(
+                ">IIIII",
+                picture.width,
+                picture.height,
+                picture.depth,
+                picture.colors,
+                len(picture.data),
+            ),
+            picture.data,
+        ]
+    )
+
+
+def read_metadata(file: Path, pictures: bool = True) -> FlacMetadata:
+    """Read STREAMINFO, tags and pictures from the head of a flac file.
+
+    Only the metadata blocks are read, blocks that are not needed (padding, seek
+    tables, ...) are skipped. If pictures is False, picture blocks are skipped too.
+    """
+    with metrics.stage("flac.read_metadata"):
+        return _read_metadata(file, pictures)
+
+
+def _blocks(f: BinaryIO, file: Path) -> Iterator[Tuple[int, int]]:
+    """Type and length of every metadata block.
+
+    The caller may read the data of a block, the rest of it is skipped.
+    """
+    if _skip_id3v2(f) != b"fLaC":
+        raise FlacError(f"Not a flac file: {file}")
+    last = False
+    while not last:
+        header = _read_exactly(f, 4)
+        last = bool(header[0] & 0x80)
+        length = int.from_bytes(header[1:4], "big")
+        start = f.tell()
+        yield header[0] & 0x7F, length
+        f.seek(start + length)
+
+
+def _read_metadata(file: Path, pictures: bool) -> FlacMetadata:
+    metadata = None
+    # A single buffered read usually covers STREAMINFO and the tags.
+    with open(file, "rb", buffering=64 * 1024) as f:
+        for block_type, length in _blocks(f, file):
+            if block_type == BLOCK_STREAMINFO:
+                metadata = FlacMetadata(parse_streaminfo(_read_exactly(f, length)))
+            elif metadata is None:
+                raise FlacError(f"STREAMINFO is not the first block: {file}")
+            elif block_type == BLOCK_VORBIS_COMMENT:
+                metadata.vendor, metadata.tags = parse_vorbis_comment(
+                    _read_exactly(f, length)
+                )
+            elif block_type == BLOCK_PICTURE and pictures:
+                metadata.pictures.append(parse_picture(_read_exactly(f, length)))
+    if metadata is None:
+        raise FlacError(f"No STREAMINFO block: {file}")
+    return metadata
+
+
+def read_fingerprint(file: Path) -> Optional[str]:
+    """The audio MD5 from STREAMINFO and a hash of the tags and pictures of a flac file.
+
+    Two files with the same fingerprint give the same output. None if the encoder of
+    the file did not calculate the MD5.
+    """
+    with metrics.stage("flac.fingerprint"):
+        md5 = None
+        blocks_hash = hashlib.sha1()
+        with open(file, "rb", buffering=64 * 1024) as f:
+            for block_type, length in _blocks(f, file):
+                if block_type == BLOCK_STREAMINFO:
+                    md5 = parse_streaminfo(_read_exactly(f, length)).md5
+                elif block_type in FINGERPRINT_BLOCKS:
+                    blocks_hash.update(struct.pack(">BI", block_type, length))
+                    blocks_hash.update(_read_exactly(f, length))
+        if md5 is None:
+            raise FlacError(f"No STREAMINFO block: {file}")
+        if not any(md5):
+            return None
+        return f"{md5.hex()}-{blocks_hash.hexdigest()}"
+
+
+def read_picture_sizes(file: Path) -> Tuple[StreamInfo, List[PictureSize]]:
+    """STREAMINFO and the sizes of the pictures of a flac file.
+
+    Only the first bytes of the picture blocks are read, not the pictures.
+    """
+    streaminfo = None
+    pictures = []
+    with open(file, "rb", buffering=64 * 1024) as f:
+        for block_type, length in _blocks(f, file):
+            if block_type == BLOCK_STREAMINFO:
+                streaminfo = parse_streaminfo(_read_exactly(f, length))
+            elif block_type == BLOCK_PICTURE:
+                try:
+                    _, mime_length = struct.unpack(">II", _read_exactly(f, 8))
+                    f.seek(mime_length, 1)
+                    (description_length,) = struct.unpack(">I", _read_exactly(f, 4))
+                    f.seek(description_length, 1)
+                    width, height, _, _, data_length = struct.unpack(
+                        ">IIIII", _read_exactly(f, 20)
+                    )
+                except FlacError:
+                    raise FlacError(f"Invalid PICTURE block: {file}") from None
+                pictures.append(PictureSize(width, height, data_length))
+    if streaminfo is None:
+        raise FlacError(f"No STREAMINFO block: {file}")
+    return streaminfo, pictures
+
+
+def extract_picture(file: Path) -> Optional[bytes]:
+    """Data of the first picture, the blocks after it are not read"""
+    with metrics.stage("flac.read_metadata"):
+        with open(file, "rb", buffering=64 * 1024) as f:
+            for block_type, length in _blocks(f, file):
+                if block_type == BLOCK_PICTURE:
+                    return parse_picture(_read_exactly(f, length)).data
+    return None
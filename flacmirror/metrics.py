@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not values:
+        return 0.0
+    index = min(int(q * len(values)), len(values) - 1)
+    return values[index]
+
+
+class Metrics:
+    """Thread-safe collection of stage durations, counters and gauges of a run.
+
+    Stages are timed sections of the program (a subprocess call, scanning, ...) of
+    which every single duration is kept to calculate percentiles.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stages: Dict[str, List[float]] = {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+            self.gauges = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self.stages.setdefault(name, []).append(seconds)
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            stages: Dict[str, Any] = {}
+            for name, durations in sorted(self.stages.items()):
+                durations = sorted(durations)
+                stages[name] = {
+                    "count": len(durations),
+                    "total": sum(durations),
+                    "max": durations[-1],
+                    **{f"p{int(q * 100)}": percentile(durations, q) for q in QUANTILES},
+                }
+            return {
+                "stages": stages,
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": dict(sorted(self.gauges.items())),
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2)
+
+    def to_prometheus(self) -> str:
+        report = self.report()
+        lines = [
+            "# HELP flacmirror_stage_seconds Duration of the stages of a run.",
+            "# TYPE flacmirror_stage_seconds summary",
+        ]
+        for name, stage in report["stages"].items():
+            for q in QUANTILES:
+                lines.append(
+                    f'flacmirror_stage_seconds{{stage="{name}",quantile="{q}"}}'
+                    f' {stage[f"p{int(q * 100)}"]}'
+                )
+            lines.append(
+                f'flacmirror_stage_seconds_sum{{stage="{name}"}} {stage["total"]}'
+            )
+            lines.append(
+                f'flacmirror_stage_seconds_count{{stage="{name}"}} {stage["count"]}'
+            )
+        for name, value in report["counters"].items():
+            lines.append(f"# TYPE flacmirror_{name}_total counter")
+            lines.append(f"flacmirror_{name}_total {value}")
+        for name, value in report["gauges"].items():
+            lines.append(f"# TYPE flacmirror_{name} gauge")
+            lines.append(f"flacmirror_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, file: Path, prometheus: bool = False):
+        content = self.to_prometheus() if prometheus else self.to_json()
+        # Replace the file atomically, it might be scraped at any time.
+        tmp_file = file.with_name(f".{file.name}.tmp")
+        tmp_file.write_text(content)
+        os.replace(str(tmp_file), str(file))
+
+
+# Metrics of the current run, used from everywhere in the program
+metrics = Metrics()
@@ -0,0 +1,366 @@
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Set, Tuple, TypeVar
+
+from .metadata import Picture, StreamInfo
+
+# Encoding in worker processes through ctypes bindings to libFLAC and libopusenc
+# avoids starting several processes per track and passing data through pipes and
+# temporary files. Streams that are not supported are left to the encoder programs.
+# Vorbis is not included: libvorbisenc leaves the ogg packaging to the caller, which
+# would need bindings to libogg too, and oggenc already encodes several files per
+# process (see JobEncodeBatch).
+CODECS = {"opus"}
+# from opus_defines.h
+OPUS_SET_BITRATE_REQUEST = 4002
+# from FLAC/stream_decoder.h
+FLAC_WRITE_STATUS_CONTINUE = 0
+FLAC_WRITE_STATUS_ABORT = 1
+# Samples of these sizes are passed to libopusenc as 16 bit integers, which it turns
+# into the same floats as opusenc. Converting 24 and 32 bit samples to floats in
+# Python is too slow, those files are left to opusenc.
+INT16_BITS_PER_SAMPLE = {8, 16}
+
+T = TypeVar("T")
+
+
+class NativeError(Exception):
+    pass
+
+
+class NativeUnsupportedError(NativeError):
+    """The file can not be encoded natively, but by the encoder program"""
+
+
+class _FrameHeader(ctypes.Structure):
+    # Leading fields of FLAC__FrameHeader, the first member of FLAC__Frame
+    _fields_ = [
+        ("blocksize", ctypes.c_uint),
+        ("sample_rate", ctypes.c_uint),
+        ("channels", ctypes.c_uint),
+    ]
+
+
+_WRITE_CALLBACK = ctypes.CFUNCTYPE(
+    ctypes.c_int,
+    ctypes.c_void_p,
+    ctypes.POINTER(_FrameHeader),
+    ctypes.POINTER(ctypes.POINTER(ctypes.c_int32)),
+    ctypes.c_void_p,
+)
+_ERROR_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p)
+
+_libs: Optional[Tuple[ctypes.CDLL, ctypes.CDLL]] = None
+_pool: Optional[ProcessPoolExecutor] = None
+# Workers put their pid into the queue once they started, see terminate_workers
+_pid_queue: Optional["multiprocessing.SimpleQueue[int]"] = None
+_worker_pids: Set[int] = set()
+
+
+def _load() -> Tuple[ctypes.CDLL, ctypes.CDLL]:
+    global _libs
+    if _libs is not None:
+        return _libs
+    flac_name = ctypes.util.find_library("FLAC")
+    opusenc_name = ctypes.util.find_library("opusenc")
+    if flac_name is None or opusenc_name is None:
+        raise NativeError("libFLAC or libopusenc not found")
+    flac = ctypes.CDLL(flac_name)
+    opusenc = ctypes.CDLL(opusenc_name)
+
+    flac.FLAC__stream_decoder_new.argtypes = []
+    flac.FLAC__stream_decoder_new.restype = ctypes.c_void_p
+    flac.FLAC__stream_decoder_init_file.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        _WRITE_CALLBACK,
+        ctypes.c_void_p,  # metadata callback, not needed
+        _ERROR_CALLBACK,
+        ctypes.c_void_p,
+    ]
+    flac.FLAC__stream_decoder_init_file.restype = ctypes.c_int
+    for name in [
+        "FLAC__stream_decoder_process_until_end_of_stream",
+        "FLAC__stream_decoder_finish",
+        "FLAC__stream_decoder_get_state",
+    ]:
+        getattr(flac, name).argtypes = [ctypes.c_void_p]
+        getattr(flac, name).restype = ctypes.c_int
+    flac.FLAC__stream_decoder_delete.argtypes = [ctypes.c_void_p]
+    flac.FLAC__stream_decoder_delete.restype = None
+
+    opusenc.ope_comments_create.argtypes = []
+    opusenc.ope_comments_create.restype = ctypes.c_void_p
+    opusenc.ope_comments_add.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_char_p,
+    ]
+    opusenc.ope_comments_add.restype = ctypes.c_int
+    opusenc.ope_comments_add_picture_from_memory.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_size_t,
+        ctypes.c_int,
+        ctypes.c_char_p,
+    ]
+    opusenc.ope_comments_add_picture_from_memory.restype = ctypes.c_int
+    opusenc.ope_comments_destroy.argtypes = [ctypes.c_void_p]
+    opusenc.ope_comments_destroy.restype = None
+    opusenc.ope_encoder_create_file.argtypes = [
+        ctypes.c_char_p,
+        ctypes.c_void_p,
+        ctypes.c_int32,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int),
+    ]
+    opusenc.ope_encoder_create_file.restype = ctypes.c_void_p
+    # ope_encoder_ctl is variadic, so its arguments are passed as ctypes objects.
+    opusenc.ope_encoder_ctl.restype = ctypes.c_int
+    opusenc.ope_encoder_write.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_int,
+    ]
+    opusenc.ope_encoder_write.restype = ctypes.c_int
+    opusenc.ope_encoder_drain.argtypes = [ctypes.c_void_p]
+    opusenc.ope_encoder_drain.restype = ctypes.c_int
+    opusenc.ope_encoder_destroy.argtypes = [ctypes.c_void_p]
+    opusenc.ope_encoder_destroy.restype = None
+    opusenc.ope_strerror.argtypes = [ctypes.c_int]
+    opusenc.ope_strerror.restype = ctypes.c_char_p
+
+    _libs = (flac, opusenc)
+    return _libs
+
+
+def available(codec: str) -> bool:
+    """Whether the libraries to encode codec are installed"""
+    if codec not in CODECS:
+        return False
+    try:
+        _load()
+    except (NativeError, OSError):
+        return False
+    return True
+
+
+def supports(streaminfo: StreamInfo) -> bool:
+    # Multichannel opus needs a channel mapping, leave that to opusenc.
+    # The 16 bit samples are cut out of the little-endian int32 samples of libFLAC.
+    return (
+        streaminfo.sample_rate > 0
+        and streaminfo.channels in (1, 2)
+        and streaminfo.bits_per_sample in INT16_BITS_PER_SAMPLE
+        and sys.byteorder == "little"
+    )
+
+
+def default_opus_bitrate(streaminfo: StreamInfo) -> int:
+    """The bitrate in bit/s that opusenc uses if none is given"""
+    coupled = 1 if streaminfo.channels == 2 else 0
+    rate = streaminfo.sample_rate if streaminfo.sample_rate < 44100 else 48000
+    factor = min(48, max(8, (rate + 1000) // 1000)) + 16
+    return ((64000 + 32000 * coupled) * factor + 32) >> 6
+
+
+def _init_worker(pid_queue: "multiprocessing.SimpleQueue[int]"):
+    # Like the encoder programs, workers are stopped by the main process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pid_queue.put(os.getpid())
+
+
+def start_workers(num_workers: int):
+    """Start the worker processes used by run()"""
+    global _pool, _pid_queue
+    if _pool is None:
+        context = multiprocessing.get_context("spawn")
+        _pid_queue = context.SimpleQueue()
+        _worker_pids.clear()
+        _pool = ProcessPoolExecutor(
+            num_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(_pid_queue,),
+        )
+
+
+def stop_workers():
+    global _pool, _pid_queue
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+    _pid_queue = None
+
+
+def terminate_workers():
+    """Stop the worker processes right away, calls of run() that wait for them fail"""
+    if _pid_queue is None:
+        return
+    # The pool has no public way to stop running calls, so the workers are
+    # signalled directly.
+    while not _pid_queue.empty():
+        _worker_pids.add(_pid_queue.get())
+    for pid in _worker_pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def run(fn: Callable[..., T], *args: Any) -> T:
+    """Call fn(*args) in a worker process, or here if no workers were started"""
+    if _pool is None:
+        return fn(*args)
+    return _pool.submit(fn, *args).result()
+
+
+def _decode(
+    input_f: Path,
+    streaminfo: StreamInfo,
+    write: Callable[[int, int], None],
+):
+    """Decode input_f and call write(address, samples) with interleaved 16 bit PCM"""
+    flac, _ = _load()
+    channels = streaminfo.channels
+    bits = streaminfo.bits_per_sample
+    step = channels * 2
+    # One buffer that is only replaced by a larger one if a frame does not fit
+    buffer = bytearray(max(streaminfo.max_blocksize, 4096) * step)
+    buffer_c = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+    errors: List[BaseException] = []
+
+    def to_int16(data, blocksize: int) -> int:
+        nonlocal buffer, buffer_c
+        size = blocksize * step
+        if size > len(buffer):
+            buffer = bytearray(size)
+            buffer_c = (ctypes.c_char * size).from_buffer(buffer)
+        view = memoryview(buffer)[:size]
+        for channel in range(channels):
+            # The int32 samples of libFLAC, read in place
+            samples = memoryview(
+                (ctypes.c_char * (blocksize * 4)).from_address(
+                    ctypes.addressof(data[channel].contents)
+                )
+            ).cast("B")
+            if bits == 8:
+                # The low bytes stay zero, the buffer is never written otherwise.
+                view[channel * 2 + 1 :: step] = samples[0::4]
+            else:
+                view[channel * 2 :: step] = samples[0::4]
+                view[channel * 2 + 1 :: step] = samples[1::4]
+            samples.release()
+        view.release()
+        return ctypes.addressof(buffer_c)
+
+    def on_write(_decoder, frame, data, _client_data) -> int:
+        try:
+            blocksize = frame.contents.blocksize
+            write(to_int16(data, blocksize), blocksize)
+        except BaseException as e:
+            errors.append(e)
+            return FLAC_WRITE_STATUS_ABORT
+        return FLAC_WRITE_STATUS_CONTINUE
+
+    def on_error(_decoder, status, _client_data):
+        errors.append(NativeError(f"Error {status} while decoding {input_f}"))
+
+    write_callback = _WRITE_CALLBACK(on_write)
+    error_callback = _ERROR_CALLBACK(on_error)
+    decoder = flac.FLAC__stream_decoder_new()
+    if not decoder:
+        raise MemoryError
+    try:
+        status = flac.FLAC__stream_decoder_init_file(
+            decoder, os.fsencode(input_f), write_callback, None, error_callback, None
+        )
+        if status != 0:
+            raise NativeError(f"Could not open {input_f} (status {status})")
+        ok = flac.FLAC__stream_decoder_process_until_end_of_stream(decoder)
+        flac.FLAC__stream_decoder_finish(decoder)
+        if errors:
+            raise errors[0]
+        if not ok:
+            state = flac.FLAC__stream_decoder_get_state(decoder)
+            raise NativeError(f"Decoding {input_f} failed (state {state})")
+    finally:
+        flac.FLAC__stream_decoder_delete(decoder)
+
+
+def encode_flac_to_opus(
+    input_f: Path,
+    output_f: Path,
+    streaminfo: StreamInfo,
+    tags: List[Tuple[str, str]],
+    pictures: List[Picture],
+    bitrate: Optional[int],
+):
+    """Encode input_f with the given tags and pictures, bitrate in bit/s"""
+    _, opusenc = _load()
+    if bitrate is None:
+        bitrate = default_opus_bitrate(streaminfo)
+
+    def check(result: int, action: str):
+        if result != 0:
+            error = opusenc.ope_strerror(result).decode()
+            raise NativeError(f"{action} failed for {input_f}: {error}")
+
+    comments = opusenc.ope_comments_create()
+    if not comments:
+        raise MemoryError
+    try:
+        for key, value in tags:
+            check(
+                opusenc.ope_comments_add(comments, key.encode(), value.encode()),
+                f"Adding tag {key}",
+            )
+        for picture in pictures:
+            result = opusenc.ope_comments_add_picture_from_memory(
+                comments,
+                picture.data,
+                len(picture.data),
+                picture.picture_type,
+                picture.description.encode(),
+            )
+            if result != 0:
+                # e.g. an image format opusenc can not embed
+                raise NativeUnsupportedError(opusenc.ope_strerror(result).decode())
+        error = ctypes.c_int()
+        encoder = opusenc.ope_encoder_create_file(
+            os.fsencode(output_f),
+            comments,
+            streaminfo.sample_rate,
+            streaminfo.channels,
+            0,
+            ctypes.byref(error),
+        )
+        if not encoder:
+            check(error.value, "Creating the encoder")
+            raise NativeError(f"Creating the encoder failed for {input_f}")
+        try:
+            check(
+                opusenc.ope_encoder_ctl(
+                    ctypes.c_void_p(encoder),
+                    ctypes.c_int(OPUS_SET_BITRATE_REQUEST),
+                    ctypes.c_int32(bitrate),
+                ),
+                "Setting the bitrate",
+            )
+
+            def write(address: int, samples: int):
+                check(opusenc.ope_encoder_write(encoder, address, samples), "Encoding")
+
+            _decode(input_f, streaminfo, write)
+            check(opusenc.ope_encoder_drain(encoder), "Finishing the stream")
+        finally:
+            opusenc.ope_encoder_destroy(encoder)
+    finally:
+        opusenc.ope_comments_destroy(comments)
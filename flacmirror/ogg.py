@@ -0,0 +1,368 @@
+import itertools
+import shutil
+import struct
+import zlib
+from pathlib import Path
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+# Ogg page header up to the segment table, see RFC 3533
+PAGE_HEADER = struct.Struct("<4sBBqIII")
+FLAG_CONTINUED = 0x01
+# Number of header packets and the prefix of the comment packet for each codec
+HEADER_PACKETS: Dict[bytes, Tuple[int, bytes]] = {
+    b"OpusHead": (2, b"OpusTags"),
+    b"\x01vorbis": (3, b"\x03vorbis"),
+}
+
+
+# Comments that encoders add about themselves
+ENCODER_KEYS = {"ENCODER", "ENCODER_OPTIONS"}
+PICTURE_KEY = "METADATA_BLOCK_PICTURE"
+
+
+class OggError(Exception):
+    pass
+
+
+# Every byte with its bits in reverse order
+_REVERSED_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+def page_crc(page: Union[bytes, bytearray]) -> int:
+    """Checksum of a page whose checksum field is zero"""
+    # Ogg uses the polynomial of zlib's CRC-32, but without reflecting the bits and
+    # without inverting the start value and result. zlib computes the reflected
+    # checksum of the reversed bytes, which is the reversed Ogg checksum.
+    crc = zlib.crc32(page.translate(_REVERSED_BITS), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f"{crc:032b}"[::-1], 2)
+
+
+class Page(NamedTuple):
+    flags: int
+    granule: int
+    serial: int
+    sequence: int
+    lacing: bytes
+    body: bytes
+    # Position of the page in the file and its size including the header
+    offset: int
+    size: int
+
+
+def read_page(data: bytes, offset: int) -> Page:
+    try:
+        capture, version, flags, granule, serial, sequence, _ = PAGE_HEADER.unpack_from(
+            data, offset
+        )
+    except struct.error:
+        raise OggError("Unexpected end of file") from None
+    if capture != b"OggS" or version != 0:
+        raise OggError(f"No Ogg page at offset {offset}")
+    pos = offset + PAGE_HEADER.size
+    num_segments = data[pos]
+    lacing = data[pos + 1 : pos + 1 + num_segments]
+    pos += 1 + num_segments
+    body = data[pos : pos + sum(lacing)]
+    if len(lacing) != num_segments or len(body) != sum(lacing):
+        raise OggError("Unexpected end of file")
+    return Page(
+        flags, granule, serial, sequence, lacing, body, offset, pos + len(body) - offset
+    )
+
+
+def read_pages(f: BinaryIO) -> Iterator[Tuple[Page, bytes]]:
+    """Pages of the Ogg file f and their bytes, read one page at a time"""
+    offset = 0
+    while True:
+        header = f.read(PAGE_HEADER.size + 1)
+        if not header:
+            return
+        if len(header) < PAGE_HEADER.size + 1:
+            raise OggError("Unexpected end of file")
+        lacing = f.read(header[-1])
+        data = header + lacing + f.read(sum(lacing))
+        page = read_page(data, 0)._replace(offset=offset)
+        yield page, data
+        offset += page.size
+
+
+def build_page(
+    flags: int, granule: int, serial: int, sequence: int, lacing: bytes, body: bytes
+) -> bytes:
+    header = PAGE_HEADER.pack(b"OggS", 0, flags, granule, serial, sequence, 0)
+    page = bytearray(header + bytes([len(lacing)]) + lacing + body)
+    struct.pack_into("<I", page, 22, page_crc(page))
+    return bytes(page)
+
+
+def paginate(
+    lacing: bytes, body: bytes, serial: int, first_sequence: int, num_pages: int
+) -> List[bytes]:
+    """Pages for the segments of header packets, starting with a new page.
+
+    The segments are spread over num_pages pages if they fit, otherwise over as few
+    pages as possible.
+    """
+    if not num_pages <= len(lacing) <= 255 * num_pages:
+        num_pages = -(-len(lacing) // 255)
+    pages = []
+    pos = 0
+    body_pos = 0
+    flags = 0
+    for index in range(num_pages):
+        # Full pages first, with at least one segment left for every other page
+        count = min(255, len(lacing) - pos - (num_pages - index - 1))
+        page_lacing = lacing[pos : pos + count]
+        size = sum(page_lacing)
+        pages.append(
+            build_page(
+                flags,
+                # Header pages contain no audio, so their granule position is 0, or
+                # -1 if no packet ends on the page.
+                0 if min(page_lacing) < 255 else -1,
+                serial,
+                first_sequence + index,
+                page_lacing,
+                body[body_pos : body_pos + size],
+            )
+        )
+        pos += count
+        body_pos += size
+        flags = FLAG_CONTINUED if page_lacing[-1] == 255 else 0
+    return pages
+
+
+def parse_comments(packet: bytes, prefix: bytes) -> Tuple[bytes, List[bytes], bytes]:
+    """Vendor string, comments and the bytes that follow them in a comment packet"""
+    try:
+        pos = len(prefix)
+        (vendor_length,) = struct.unpack_from("<I", packet, pos)
+        pos += 4
+        vendor = packet[pos : pos + vendor_length]
+        pos += vendor_length
+        (count,) = struct.unpack_from("<I", packet, pos)
+        pos += 4
+        comments = []
+        for _ in range(count):
+            (length,) = struct.unpack_from("<I", packet, pos)
+            pos += 4
+            comments.append(packet[pos : pos + length])
+            pos += length
+    except struct.error:
+        raise OggError("Invalid comment header") from None
+    if pos > len(packet):
+        raise OggError("Invalid comment header")
+    # The framing bit of vorbis or the padding of opus
+    return vendor, comments, packet[pos:]
+
+
+def build_comments(
+    prefix: bytes, vendor: bytes, comments: Sequence[bytes], trailer: bytes
+) -> bytes:
+    parts = [prefix, struct.pack("<I", len(vendor)), vendor]
+    parts.append(struct.pack("<I", len(comments)))
+    for comment in comments:
+        parts += [struct.pack("<I", len(comment)), comment]
+    parts.append(trailer)
+    return b"".join(parts)
+
+
+def _read_headers(
+    pages: Iterator[Tuple[Page, bytes]],
+) -> Tuple[List[bytes], bytes, int, List[Tuple[Page, bytes]]]:
+    """Header packets, comment prefix, serial and the header pages from pages"""
+    packets: List[bytes] = []
+    packet = b""
+    num_packets = 1
+    prefix = b""
+    serial = None
+    header_pages = []
+    while len(packets) < num_packets:
+        page, data = next(pages, (None, b""))
+        if page is None:
+            raise OggError("Unexpected end of file")
+        if serial is None:
+            serial = page.serial
+            for magic, (num_packets, prefix) in HEADER_PACKETS.items():
+                if page.body.startswith(magic):
+                    break
+            else:
+                raise OggError("Not an Opus or Vorbis stream")
+        elif page.serial != serial:
+            raise OggError("Multiplexed streams are not supported")
+        pos = 0
+        for index, size in enumerate(page.lacing):
+            packet += page.body[pos : pos + size]
+            pos += size
+            if size < 255:
+                packets.append(packet)
+                packet = b""
+                if len(packets) == num_packets and index != len(page.lacing) - 1:
+                    # Audio on the last header page would have to be repaginated too
+                    raise OggError("Audio data on a header page")
+        header_pages.append((page, data))
+    assert serial is not None
+    if not packets[1].startswith(prefix):
+        raise OggError("Missing comment header")
+    if len(header_pages[0][0].lacing) != 1:
+        raise OggError("The identification header is not alone on the first page")
+    return packets, prefix, serial, header_pages
+
+
+def _changed_keys(
+    old_tags: Sequence[Tuple[str, str]], new_tags: Sequence[Tuple[str, str]]
+) -> List[str]:
+    def values(tags: Sequence[Tuple[str, str]]) -> Dict[str, List[str]]:
+        result: Dict[str, List[str]] = {}
+        for key, value in tags:
+            result.setdefault(key.upper(), []).append(value)
+        return result
+
+    old_values = values(old_tags)
+    new_values = values(new_tags)
+    return [
+        key
+        for key in {**old_values, **new_values}
+        if old_values.get(key) != new_values.get(key)
+    ]
+
+
+def comment_key(comment: bytes) -> str:
+    return comment.partition(b"=")[0].decode("utf-8", "replace").upper()
+
+
+def rewrite_comments(
+    src_file: Path, dst_file: Path, edit: Callable[[List[bytes]], List[bytes]]
+):
+    """Write a copy of the Opus or Vorbis file src_file with other comments to dst_file.
+
+    edit gets the comments of src_file and returns the new ones. Only the pages of
+    the comment header change if it still fits on them. Otherwise the pages after it
+    are copied with new sequence numbers.
+    """
+    with open(src_file, "rb") as src, open(dst_file, "wb") as f:
+        pages = read_pages(src)
+        packets, prefix, serial, header_pages = _read_headers(pages)
+        vendor, comments, trailer = parse_comments(packets[1], prefix)
+        comment = build_comments(prefix, vendor, edit(comments), trailer)
+
+        # The first page only holds the identification header and stays as it is.
+        # The comment header starts on the second page and may share its last page
+        # with the start of the next header packet, which is moved along.
+        f.write(header_pages[0][1])
+        old_segments = len(packets[1]) // 255 + 1
+        num_pages = 0
+        lacing = b""
+        while len(lacing) < old_segments:
+            num_pages += 1
+            lacing += header_pages[num_pages][0].lacing
+        last_page = header_pages[num_pages][0]
+        next_lacing = lacing[old_segments:]
+        next_body = last_page.body[len(last_page.body) - sum(next_lacing) :]
+        comment_lacing = bytes([255] * (len(comment) // 255) + [len(comment) % 255])
+        comment_pages = paginate(
+            comment_lacing + next_lacing,
+            comment + next_body,
+            serial,
+            header_pages[1][0].sequence,
+            num_pages,
+        )
+        f.write(b"".join(comment_pages))
+
+        shift = len(comment_pages) - num_pages
+        if shift == 0:
+            for _, data in header_pages[num_pages + 1 :]:
+                f.write(data)
+            shutil.copyfileobj(src, f)
+            return
+        for page, data in itertools.chain(header_pages[num_pages + 1 :], pages):
+            if page.serial == serial:
+                f.write(
+                    build_page(
+                        page.flags,
+                        page.granule,
+                        page.serial,
+                        page.sequence + shift,
+                        page.lacing,
+                        page.body,
+                    )
+                )
+            else:
+                f.write(data)
+
+
+def retag(
+    src_file: Path,
+    dst_file: Path,
+    old_tags: Sequence[Tuple[str, str]],
+    new_tags: Sequence[Tuple[str, str]],
+):
+    """Write a copy of the Opus or Vorbis file src_file with different tags to dst_file.
+
+    src_file was encoded from a source with old_tags. Only comments with a key whose
+    values differ in new_tags are replaced, everything the encoder added by itself
+    (picture, encoder settings) stays as it is. Keys the encoder dropped are not
+    added.
+    """
+    old_keys = {key.upper() for key, _ in old_tags}
+
+    def edit(comments: List[bytes]) -> List[bytes]:
+        kept_keys = {comment_key(comment) for comment in comments}
+        replacements: Dict[str, List[bytes]] = {
+            key: [] for key in _changed_keys(old_tags, new_tags)
+        }
+        for key, value in new_tags:
+            upper = key.upper()
+            if upper in replacements and (upper in kept_keys or upper not in old_keys):
+                replacements[upper].append(f"{key}={value}".encode())
+        # New values take the place of the old ones, new keys are appended.
+        new_comments: List[bytes] = []
+        for comment in comments:
+            key = comment_key(comment)
+            if key not in replacements:
+                new_comments.append(comment)
+            else:
+                new_comments += replacements.pop(key, [])
+                replacements[key] = []
+        for values in replacements.values():
+            new_comments += values
+        return new_comments
+
+    rewrite_comments(src_file, dst_file, edit)
+
+
+def replace_tags(
+    src_file: Path,
+    dst_file: Path,
+    tags: Sequence[Tuple[str, str]],
+    pictures: Sequence[str],
+):
+    """Write a copy of the Opus or Vorbis file src_file to dst_file with new tags.
+
+    All comments are replaced by tags and the METADATA_BLOCK_PICTURE comments
+    pictures, except the ones the encoder added about itself.
+    """
+
+    def edit(comments: List[bytes]) -> List[bytes]:
+        new_comments = [
+            comment for comment in comments if comment_key(comment) in ENCODER_KEYS
+        ]
+        new_comments += [
+            f"{key}={value}".encode()
+            for key, value in tags
+            if key.upper() != PICTURE_KEY
+        ]
+        new_comments += [f"{PICTURE_KEY}={picture}".encode() for picture in pictures]
+        return new_comments
+
+    rewrite_comments(src_file, dst_file, edit)
@@ -10,17 +10,33 @@ class Options:
     codec: str
     albumart: str
     albumart_max_width: int
+    albumart_cache_dir: Optional[Path]
     overwrite: str
     delete: bool
+    manifest: bool
     yes: bool
     copy_file: Optional[List[str]]
     copy_ext: Optional[List[str]]
+    link_copies: bool
+    dedup: bool
     num_threads: Optional[int]
+    io_threads: int
+    schedule: str
+    encoder_backend: str
+    engine: str
+    job_timeout: Optional[float]
+    # In bytes
+    max_memory: Optional[int]
     opus_quality: Optional[float]
     vorbis_quality: Optional[int]
     aac_quality: Optional[int]
     aac_mode: Optional[int]
+    aac_samplerate: int
     mp3_quality: Optional[int]
     mp3_mode: Optional[str]
+    metrics_json: Optional[Path]
+    metrics_prom: Optional[Path]
+    watch: bool
+    watch_debounce: float
     dry_run: bool
     debug: bool
@@ -1,10 +1,27 @@
+import asyncio
+import os
 import shutil
+import signal
 import subprocess
+import threading
+from concurrent.futures import CancelledError
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from typing import Dict, List, Optional, Sequence, Tuple
+from tempfile import TemporaryFile
+from typing import IO, Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
+from flacmirror import native
+from flacmirror.metrics import metrics
 from flacmirror.options import Options
 
+# Seconds that stopped processes get to exit after SIGTERM before they get SIGKILL
+TERMINATE_TIMEOUT = 0.5
+# Bytes that run_tee reads from the source at a time
+TEE_CHUNK_SIZE = 64 * 1024
+# The end of stderr is kept for error messages by the asyncio engine, the rest is
+# discarded while reading.
+STDERR_LIMIT = 64 * 1024
+
 
 def check_requirements(options: Options) -> bool:
     print("Checking program requirements:")
@@ -24,11 +41,13 @@ def check_requirements(options: Options) -> bool:
         requirements.append(AtomicParsley(False))
     elif options.codec == "mp3":
         requirements.append(FFMPEG(False))
-    if options.codec != "discard" or (
-        options.codec == "vorbis" and options.albumart == "keep"
-    ):
-        requirements.append(Metaflac(False))
 
+    if options.encoder_backend == "native":
+        if native.available(options.codec):
+            # The programs are still needed for files the libraries can not handle.
+            print(f"    native {options.codec} encoder (libFLAC, libopusenc) [in use]")
+        else:
+            print(f"    no native {options.codec} encoder available, using programs")
     fulfilled = True
     for req in requirements:
         print(f"    {req.executable_status()}")
@@ -38,6 +57,362 @@ def check_requirements(options: Options) -> bool:
     return fulfilled
 
 
+class ProcessRegistry:
+    """Thread-safe set of the running child processes, so that all can be stopped.
+
+    Every child runs in its own session, so that the SIGINT of the terminal does not
+    reach it, and is stopped through its process group instead, which also includes
+    the processes it started itself. The processes started by a single thread can be
+    stopped too, which is how a job that runs too long is stopped.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Every process and the thread that started it
+        self._procs: Dict["subprocess.Popen[bytes]", int] = {}
+        # Threads whose processes were stopped by terminate_thread
+        self._stopped_threads: Set[int] = set()
+        self.terminated = False
+
+    @contextmanager
+    def popen(
+        self, args: List[str], **kwargs: Any
+    ) -> Iterator["subprocess.Popen[bytes]"]:
+        """Start a process and keep it registered until it was waited for.
+
+        The process is killed if the block raises. Raises CancelledError if the
+        processes were terminated, so that no new ones are started.
+        """
+        thread = threading.get_ident()
+        if self.terminated or thread in self._stopped_threads:
+            raise CancelledError()
+        proc = subprocess.Popen(args, start_new_session=True, **kwargs)
+        with self._lock:
+            self._procs[proc] = thread
+            terminated = self.terminated or thread in self._stopped_threads
+        try:
+            if terminated:
+                # terminate() ran while the process was started.
+                _signal_group(proc, signal.SIGKILL)
+            yield proc
+        except BaseException:
+            _signal_group(proc, signal.SIGKILL)
+            proc.wait()
+            raise
+        finally:
+            with self._lock:
+                del self._procs[proc]
+
+    def terminate(self, timeout: float = TERMINATE_TIMEOUT):
+        """Send SIGTERM to all processes and SIGKILL to the ones left after timeout.
+
+        Does not wait, the threads that run the processes see them fail. No more
+        processes are started until reset() is called.
+        """
+        with self._lock:
+            self.terminated = True
+            procs = list(self._procs)
+        self._stop(procs, timeout)
+
+    def terminate_thread(self, thread: int, timeout: float = TERMINATE_TIMEOUT):
+        """Like terminate, for the processes started by thread.
+
+        The thread can not start processes until release_thread(thread) is called.
+        """
+        with self._lock:
+            self._stopped_threads.add(thread)
+            procs = [proc for proc, owner in self._procs.items() if owner == thread]
+        self._stop(procs, timeout)
+
+    def release_thread(self, thread: int) -> bool:
+        """Let thread start processes again, True if they were stopped"""
+        with self._lock:
+            stopped = thread in self._stopped_threads
+            self._stopped_threads.discard(thread)
+        return stopped
+
+    def _stop(self, procs: List["subprocess.Popen[bytes]"], timeout: float):
+        for proc in procs:
+            _signal_group(proc, signal.SIGTERM)
+        if procs:
+            timer = threading.Timer(timeout, self._kill, (procs,))
+            timer.daemon = True
+            timer.start()
+
+    def _kill(self, procs: List["subprocess.Popen[bytes]"]):
+        with self._lock:
+            procs = [proc for proc in procs if proc in self._procs]
+        for proc in procs:
+            _signal_group(proc, signal.SIGKILL)
+
+    def reset(self):
+        self.terminated = False
+        with self._lock:
+            self._stopped_threads.clear()
+
+
+def _signal_group(proc: "subprocess.Popen[bytes]", sig: int):
+    if proc.poll() is not None:
+        return
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+running_processes = ProcessRegistry()
+
+
+def run_pipeline(commands: Sequence[List[str]]):
+    """Run commands with the stdout of each one connected to the stdin of the next.
+
+    Data is streamed through OS pipes, so the commands run concurrently and memory
+    usage is bounded by the pipe buffers. The stdout of the last command is discarded.
+    Raises CalledProcessError for the last command in the pipeline that failed, since
+    failures of earlier commands are usually caused by a broken pipe.
+    """
+    metrics.count("processes_spawned", len(commands))
+    with ExitStack() as stack:
+        procs: List[Tuple[subprocess.Popen, IO[bytes]]] = []
+        stdin: Union[int, IO[bytes], None] = subprocess.DEVNULL
+        for i, args in enumerate(commands):
+            last = i == len(commands) - 1
+            # Use files for stderr so that no pipe can fill up and block
+            stderr = stack.enter_context(TemporaryFile())
+            # Processes that are already started are killed if this fails.
+            proc = stack.enter_context(
+                running_processes.popen(
+                    args,
+                    stdin=stdin,
+                    stdout=subprocess.DEVNULL if last else subprocess.PIPE,
+                    stderr=stderr,
+                )
+            )
+            if proc.stdout is not None:
+                stack.callback(proc.stdout.close)
+            if stdin is not None and not isinstance(stdin, int):
+                # Only the reading process should hold the read end, so that the
+                # writer gets a broken pipe if the reader exits early.
+                stdin.close()
+            procs.append((proc, stderr))
+            stdin = proc.stdout
+        for proc, _ in procs:
+            proc.wait()
+        for proc, stderr in reversed(procs):
+            if proc.returncode != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(
+                    proc.returncode, proc.args, stderr=stderr.read()
+                )
+
+
+def run_tee(
+    source_args: List[str], commands: Sequence[List[str]]
+) -> List[Optional[subprocess.CalledProcessError]]:
+    """Run source_args and write its stdout to the stdin of every command.
+
+    The data is copied through this process, so the commands get the same data
+    while the source runs only once. A command that fails gets no more data and the
+    others go on. Returns the CalledProcessError of every command that failed, None
+    for the others. Raises CalledProcessError if the source failed.
+    """
+    metrics.count("processes_spawned", 1 + len(commands))
+    with ExitStack() as stack:
+        sinks: List[Tuple[subprocess.Popen, IO[bytes]]] = []
+        for args in commands:
+            sink_stderr = stack.enter_context(TemporaryFile())
+            proc = stack.enter_context(
+                running_processes.popen(
+                    args,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=sink_stderr,
+                )
+            )
+            sinks.append((proc, sink_stderr))
+        source_stderr = stack.enter_context(TemporaryFile())
+        source = stack.enter_context(
+            running_processes.popen(
+                source_args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=source_stderr,
+            )
+        )
+        assert source.stdout is not None
+        writers = [proc.stdin for proc, _ in sinks]
+        with source.stdout:
+            while any(writers):
+                chunk = source.stdout.read(TEE_CHUNK_SIZE)
+                for index, writer in enumerate(writers):
+                    if writer is None:
+                        continue
+                    try:
+                        if chunk:
+                            writer.write(chunk)
+                        else:
+                            writer.close()
+                            writers[index] = None
+                    except BrokenPipeError:
+                        writers[index] = None
+                if not chunk:
+                    break
+        source.wait()
+        for proc, _ in sinks:
+            proc.wait()
+        errors: List[Optional[subprocess.CalledProcessError]] = []
+        for proc, stderr in sinks:
+            if proc.stdin is not None and not proc.stdin.closed:
+                # The command exited early, drop what is left in the buffer.
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            error = None
+            if proc.returncode != 0:
+                stderr.seek(0)
+                error = subprocess.CalledProcessError(
+                    proc.returncode, proc.args, stderr=stderr.read()
+                )
+            errors.append(error)
+        # If every command failed, the source was stopped by a broken pipe.
+        if source.returncode != 0 and not all(errors):
+            source_stderr.seek(0)
+            raise subprocess.CalledProcessError(
+                source.returncode, source.args, stderr=source_stderr.read()
+            )
+        return errors
+
+
+async def _read_tail(stream: Optional[asyncio.StreamReader]) -> bytes:
+    data = bytearray()
+    if stream is None:
+        return b""
+    while True:
+        chunk = await stream.read(64 * 1024)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+        if len(data) > STDERR_LIMIT:
+            del data[:-STDERR_LIMIT]
+
+
+async def _write(stream: Optional[asyncio.StreamWriter], data: Optional[bytes]):
+    if stream is None:
+        return
+    try:
+        if data:
+            stream.write(data)
+            await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # Like subprocess.run, let the process decide if that is an error.
+        pass
+    finally:
+        stream.close()
+
+
+async def _read(stream: Optional[asyncio.StreamReader]) -> bytes:
+    if stream is None:
+        return b""
+    return await stream.read()
+
+
+def _signal_session(proc: "asyncio.subprocess.Process", sig: int):
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def _stop_async(procs: Sequence["asyncio.subprocess.Process"]):
+    """Stop processes started by the event loop like ProcessRegistry.terminate"""
+    for proc in procs:
+        _signal_session(proc, signal.SIGTERM)
+    waits = [asyncio.ensure_future(proc.wait()) for proc in procs]
+    if not waits:
+        return
+    _, pending = await asyncio.wait(waits, timeout=TERMINATE_TIMEOUT)
+    if pending:
+        for proc in procs:
+            _signal_session(proc, signal.SIGKILL)
+        await asyncio.wait(pending)
+
+
+async def run_process_async(
+    args: List[str], input: Optional[bytes] = None
+) -> "subprocess.CompletedProcess[bytes]":
+    """Like Process.run, with the process started and waited for by the event loop.
+
+    stderr is read while it is written and only its end is kept. If the calling task
+    is cancelled, the process is stopped.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+    )
+    try:
+        stdout, stderr, _ = await asyncio.gather(
+            _read(proc.stdout), _read_tail(proc.stderr), _write(proc.stdin, input)
+        )
+        await proc.wait()
+    except BaseException:
+        await _stop_async([proc])
+        raise
+    assert proc.returncode is not None
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+async def run_pipeline_async(commands: Sequence[List[str]]):
+    """Like run_pipeline, with the processes started by the event loop"""
+    metrics.count("processes_spawned", len(commands))
+    procs: List[asyncio.subprocess.Process] = []
+    stdin: int = subprocess.DEVNULL
+    try:
+        for i, args in enumerate(commands):
+            last = i == len(commands) - 1
+            read_fd, write_fd = (None, subprocess.DEVNULL) if last else os.pipe()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=stdin,
+                    stdout=write_fd,
+                    stderr=subprocess.PIPE,
+                    start_new_session=True,
+                )
+            except BaseException:
+                if read_fd is not None:
+                    os.close(read_fd)
+                raise
+            finally:
+                # Only the processes should hold the pipes, so that the writer gets a
+                # broken pipe if the reader exits early.
+                if not last:
+                    os.close(write_fd)
+                if stdin != subprocess.DEVNULL:
+                    os.close(stdin)
+                    stdin = subprocess.DEVNULL
+            procs.append(proc)
+            if read_fd is not None:
+                stdin = read_fd
+        stderrs = await asyncio.gather(*(_read_tail(proc.stderr) for proc in procs))
+        for proc in procs:
+            await proc.wait()
+    except BaseException:
+        await _stop_async(procs)
+        raise
+    for args, proc, stderr in reversed(list(zip(commands, procs, stderrs))):
+        assert proc.returncode is not None
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args, stderr=stderr)
+
+
 class Process:
     # TODO: Setting encoding options (see other Process classes) in the constructor
     # is not really optimal; change.
@@ -62,6 +437,35 @@ class Process:
         if self.debug:
             print(f"Calling process: {args}")
 
+    def run(
+        self, args: List[str], input: Optional[bytes] = None
+    ) -> "subprocess.CompletedProcess[bytes]":
+        """Run the process with args, capturing its output"""
+        self.print_debug_info(args)
+        metrics.count("processes_spawned")
+        with metrics.stage(f"process.{type(self).__name__.lower()}"):
+            with running_processes.popen(
+                args,
+                stdin=subprocess.PIPE if input is not None else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            ) as proc:
+                stdout, stderr = proc.communicate(input)
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    proc.returncode, args, stdout, stderr
+                )
+            return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+    async def run_async(
+        self, args: List[str], input: Optional[bytes] = None
+    ) -> "subprocess.CompletedProcess[bytes]":
+        """Like run, for jobs of the asyncio engine"""
+        self.print_debug_info(args)
+        metrics.count("processes_spawned")
+        with metrics.stage(f"process.{type(self).__name__.lower()}"):
+            return await run_process_async(args, input)
+
 
 class FFMPEG(Process):
     def __init__(self, debug: bool):
@@ -87,14 +491,8 @@ class FFMPEG(Process):
             "mjpeg",
             "-",
         ]
-        self.print_debug_info(args)
         try:
-            results = subprocess.run(
-                args,
-                capture_output=True,
-                check=True,
-                start_new_session=True,
-            )
+            results = self.run(args)
         except subprocess.CalledProcessError as e:
             if (
                 b"Output file" in e.stderr
@@ -105,7 +503,8 @@ class FFMPEG(Process):
                 raise e from None
         return results.stdout
 
-    def encode_caf(self, file: Path) -> bytes:
+    def decode_caf_args(self, file: Path, fs: Optional[int] = None) -> List[str]:
+        """Arguments to decode file to caf on stdout, optionally resampling to fs"""
         args = [
             self.executable,
             "-loglevel",
@@ -113,62 +512,37 @@ class FFMPEG(Process):
             "-nostdin",
             "-i",
             str(file),
-            "-f",
-            "caf",
-            "-",
         ]
-        self.print_debug_info(args)
-        results = subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            start_new_session=True,
-        )
-        return results.stdout
+        if fs is not None:
+            args.extend(["-af", "aresample=resampler=soxr", "-ar", str(int(fs))])
+        args.extend(["-f", "caf", "-"])
+        return args
 
-    def resample_caf(
+    def encode_lame(
         self,
-        input: bytes,
-        fs: int,
+        input_f: Path,
+        output_f: Path,
+        image: Optional[bytes],
+        discard: bool,
+        mode: Optional[str],
+        quality: Optional[int],
     ) -> bytes:
-        args = [
-            self.executable,
-            "-loglevel",
-            self.loglevel,
-            "-nostdin",
-            "-fflags",
-            "+discardcorrupt",
-            "-i",
-            "pipe:",
-            "-af",
-            "aresample=resampler=soxr",
-            "-ar",
-            str(int(fs)),
-            "-f",
-            "caf",
-            "-",
-        ]
-        self.print_debug_info(args)
-        results = subprocess.run(
-            args,
-            input=input,
-            capture_output=True,
-            check=True,
-            start_new_session=True,
+        args = self.encode_lame_file_args(
+            input_f, output_f, image is not None, discard, mode, quality
         )
+        results = self.run(args, input=image)
         return results.stdout
 
-    def encode_lame(
+    def encode_lame_file_args(
         self,
         input_f: Path,
         output_f: Path,
-        image: Optional[bytes],
+        image: bool,
         discard: bool,
         mode: Optional[str],
         quality: Optional[int],
-    ) -> bytes:
-        if mode is not None and quality is None:
-            raise ValueError("If mode is specified, quality must also be specified.")
+    ) -> List[str]:
+        """Arguments for encode_lame, image tells if the picture is piped to stdin"""
         args = [
             self.executable,
             "-y",
@@ -193,6 +567,23 @@ class FFMPEG(Process):
         ]
         args_discard = ["-map", "0:a"]
         args_lame = ["-map_metadata", "0", "-id3v2_version", "3"]
+        args_quality = self.lame_quality_args(mode, quality)
+
+        if image:
+            args.extend(args_image)
+        elif discard:
+            args.extend(args_discard)
+        else:
+            args.extend(args_keep)
+        args.extend(args_lame)
+        args.extend(args_quality)
+        args.append(str(output_f))
+        return args
+
+    @staticmethod
+    def lame_quality_args(mode: Optional[str], quality: Optional[int]) -> List[str]:
+        if mode is not None and quality is None:
+            raise ValueError("If mode is specified, quality must also be specified.")
         args_quality = []
         if mode == "cbr" or mode == "abr":
             if mode == "abr":
@@ -205,112 +596,71 @@ class FFMPEG(Process):
             # vbr goes from 0 to 9
             args_quality.append("-q:a")
             args_quality.append(f"{quality}")
+        return args_quality
 
-        if image is not None:
-            args.extend(args_image)
-        elif discard:
-            args.extend(args_discard)
-        else:
-            args.extend(args_keep)
-        args.extend(args_lame)
-        args.extend(args_quality)
-        args.append(str(output_f))
-
-        self.print_debug_info(args)
-        results = subprocess.run(
-            args,
-            input=image,
-            capture_output=True,
-            check=True,
-            start_new_session=True,
-        )
-        return results.stdout
-
-
-class Metaflac(Process):
-    def __init__(self, debug: bool):
-        super().__init__("metaflac", debug)
-
-    def executable_info(self):
-        return 'Part of the package "flac" on most distros'
-
-    def extract_picture(self, file: Path) -> Optional[bytes]:
-        # extract coverart as jpeg and read it in
-        args = [
+    def encode_lame_args(
+        self, output_f: Path, mode: Optional[str], quality: Optional[int]
+    ) -> List[str]:
+        """Arguments to encode wav from stdin to output_f, without tags"""
+        return [
             self.executable,
-            str(file),
-            "--export-picture-to",
-            "-",
+            "-y",
+            "-loglevel",
+            self.loglevel,
+            "-nostdin",
+            "-f",
+            "wav",
+            "-i",
+            "pipe:",
+            "-map",
+            "0:a",
+            *self.lame_quality_args(mode, quality),
+            str(output_f),
         ]
 
-        self.print_debug_info(args)
-        try:
-            results = subprocess.run(
-                args,
-                capture_output=True,
-                check=True,
-                start_new_session=True,
-            )
-        except subprocess.CalledProcessError as e:
-            if b"FLAC file has no PICTURE block" in e.stderr:
-                return None
-            else:
-                raise e from None
-        return results.stdout
+    def retag_mp3(
+        self,
+        audio_f: Path,
+        input_f: Path,
+        output_f: Path,
+        image: Optional[bytes],
+        discard: bool,
+    ):
+        """Copy the audio of audio_f to output_f with the tags and pictures of input_f.
 
-    def extract_tags(self, file: Path) -> Dict[str, str]:
-        # extract tags and return them in a dict
+        The pictures are handled like by encode_lame.
+        """
         args = [
             self.executable,
-            str(file),
-            "--export-tags-to",
-            "-",
+            "-y",
+            "-loglevel",
+            self.loglevel,
+            "-nostdin",
+            "-i",
+            str(audio_f),
+            "-i",
+            str(input_f),
         ]
-
-        self.print_debug_info(args)
-        results = subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            start_new_session=True,
-        )
-        tags_raw = results.stdout.decode()
-        # Workaround since metaflac does not handle multi-line tags well
-        # Newlines in multi-line tags are not escaped so we need to guess if we
-        # actually have the next key pair value or just the next line of the tag.
-        tags: List[Tuple[str, str]] = []
-        line_iter = iter(tags_raw.splitlines(keepends=True))
-        while True:
-            try:
-                line = next(line_iter)
-            except StopIteration:
-                break
-            pair = line.split("=", 1)
-            try:
-                tags.append((pair[0], pair[1]))
-            except IndexError:
-                # Workaround 2
-                # No equal sign, maybe this is the next line of a multi-line tag
-                prev_key, prev_value = tags[-1]
-                # Append this line to the value of the previous line
-                tags[-1] = (prev_key, prev_value + line)
-                continue
-
-            # Workaround 1 - if we are lucky, the multiline tag uses Windows newlines
-            # which means we can distinguish those \r\n from the unix Newlines \n that
-            # come out of Metaflac.
-            while line.endswith("\r\n"):
-                # This seems to be a multiline comment - consume next line too.
-                try:
-                    line = next(line_iter)
-                except StopIteration:
-                    break
-                tags[-1] = (pair[0], pair[1] + line)
-
-        # cleanup newlines and convert to dict
-        tags_dict = {key: value.strip() for key, value in tags}
-
-        return tags_dict
+        if image is not None:
+            args.extend(
+                [
+                    "-i",
+                    "pipe:",
+                    "-map",
+                    "0:a",
+                    "-map",
+                    "2:v",
+                    "-metadata:s:v",
+                    "comment=Cover (front)",
+                ]
+            )
+        elif discard:
+            args.extend(["-map", "0:a"])
+        else:
+            args.extend(["-map", "0:a", "-map", "1:v?"])
+        args.extend(["-c", "copy", "-map_metadata", "1", "-id3v2_version", "3"])
+        args.append(str(output_f))
+        self.run(args, input=image)
 
 
 class ImageMagick(Process):
@@ -321,31 +671,15 @@ class ImageMagick(Process):
         return 'Part of the package "imagemagick" on most distros'
 
     def optimize_picture(self, data: bytes) -> bytes:
-        args = [
-            self.executable,
-            "-",
-            "-strip",
-            "-interlace",
-            "Plane",
-            "-sampling-factor",
-            "4:2:0",
-            "-colorspace",
-            "sRGB",
-            "-quality",
-            "85%",
-            "jpeg:-",
-        ]
-        self.print_debug_info(args)
-        results = subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            input=data,
-            start_new_session=True,
-        )
+        results = self.run(self.picture_args(None), input=data)
         return results.stdout
 
     def optimize_and_resize_picture(self, data: bytes, max_width: int) -> bytes:
+        results = self.run(self.picture_args(max_width), input=data)
+        return results.stdout
+
+    def picture_args(self, max_width: Optional[int]) -> List[str]:
+        """Arguments to optimize the picture on stdin, resized if max_width is set"""
         args = [
             self.executable,
             "-",
@@ -356,21 +690,11 @@ class ImageMagick(Process):
             "4:2:0",
             "-colorspace",
             "sRGB",
-            "-resize",
-            f"{max_width}>",
-            "-quality",
-            "85%",
-            "jpeg:-",
         ]
-        self.print_debug_info(args)
-        results = subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            input=data,
-            start_new_session=True,
-        )
-        return results.stdout
+        if max_width is not None:
+            args.extend(["-resize", f"{max_width}>"])
+        args.extend(["-quality", "85%", "jpeg:-"])
+        return args
 
 
 class Opusenc(Process):
@@ -390,6 +714,18 @@ class Opusenc(Process):
         discard_pictures: bool = False,
         picture_paths: Optional[Sequence[Path]] = None,
     ):
+        self.run(
+            self.encode_file_args(input_f, output_f, discard_pictures, picture_paths)
+        )
+
+    def encode_file_args(
+        self,
+        input_f: Path,
+        output_f: Path,
+        discard_pictures: bool = False,
+        picture_paths: Optional[Sequence[Path]] = None,
+    ) -> List[str]:
+        """Arguments for encode"""
         args = [
             self.executable,
             *self.additional_args,
@@ -401,13 +737,11 @@ class Opusenc(Process):
         if picture_paths is not None:
             for picture in picture_paths:
                 args.extend(["--picture", f"||||{str(picture)}"])
-        self.print_debug_info(args)
-        subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            start_new_session=True,
-        )
+        return args
+
+    def encode_args(self, output_f: Path) -> List[str]:
+        """Arguments to encode wav from stdin to output_f, without tags"""
+        return [self.executable, *self.additional_args, "-", str(output_f)]
 
 
 class Oggenc(Process):
@@ -420,25 +754,43 @@ class Oggenc(Process):
     def executable_info(self):
         return 'Part of the package "vorbis-tools" on most distros'
 
-    def encode(
-        self,
-        input_f: Path,
-        output_f: Path,
-    ):
-        args = [
+    def encode(self, input_f: Path, output_f: Path, comments: Sequence[str] = ()):
+        self.run(self.encode_file_args(input_f, output_f, comments))
+
+    def encode_file_args(
+        self, input_f: Path, output_f: Path, comments: Sequence[str] = ()
+    ) -> List[str]:
+        """Arguments for encode"""
+        return [
             self.executable,
             *self.additional_args,
+            *self.comment_args(comments),
             str(input_f),
             "-o",
             str(output_f),
         ]
-        self.print_debug_info(args)
-        subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            start_new_session=True,
-        )
+
+    def encode_args(self, output_f: Path) -> List[str]:
+        """Arguments to encode wav from stdin to output_f, without tags"""
+        return [self.executable, *self.additional_args, "-", "-o", str(output_f)]
+
+    def encode_many(self, input_files: Sequence[Path], comments: Sequence[str] = ()):
+        """Encode each file to a file with the same name and the suffix .ogg"""
+        args = [
+            self.executable,
+            *self.additional_args,
+            *self.comment_args(comments),
+            *(str(input_f) for input_f in input_files),
+        ]
+        self.run(args)
+
+    @staticmethod
+    def comment_args(comments: Sequence[str]) -> List[str]:
+        """Arguments that add comments (KEY=value) to the outputs"""
+        args = []
+        for comment in comments:
+            args.extend(["-c", comment])
+        return args
 
 
 class VorbisComment(Process):
@@ -449,15 +801,11 @@ class VorbisComment(Process):
         return 'Part of the package "vorbis-tools" on most distros'
 
     def add_comment(self, file: Path, key: str, value: str):
-        args = [self.executable, str(file), "-R", "-a"]
-        self.print_debug_info(args)
-        subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            input=f"{key}={value}".encode(),
-            start_new_session=True,
-        )
+        self.run(self.add_comment_args(file), input=f"{key}={value}".encode())
+
+    def add_comment_args(self, file: Path) -> List[str]:
+        """Arguments to add the comment on stdin (KEY=value) to file"""
+        return [self.executable, str(file), "-R", "-a"]
 
 
 # We need this tool for decoding flac, could also use ffmpeg
@@ -468,22 +816,37 @@ class Flac(Process):
     def executable_info(self):
         return 'Available as "flac" on most distros'
 
+    def decode_args(self, input_f: Path) -> List[str]:
+        """Arguments to decode input_f to wav on stdout"""
+        return [self.executable, "-dcs", str(input_f)]
+
     def decode_to_memory(self, input_f: Path) -> bytes:
         args = [
             self.executable,
             "-dc",
             str(input_f),
         ]
-        self.print_debug_info(args)
-        results = subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            start_new_session=True,
-        )
+        results = self.run(args)
         return results.stdout
 
 
+# Sample rates that can be encoded by fdkaac (AAC-LC)
+FDKAAC_SAMPLERATES = {
+    8000,
+    11025,
+    12000,
+    16000,
+    22050,
+    24000,
+    32000,
+    44100,
+    48000,
+    64000,
+    88200,
+    96000,
+}
+
+
 class FdkaacUnsupportedSamplerateError(Exception):
     pass
 
@@ -511,7 +874,8 @@ class Fdkaac(Process):
     def executable_info(self):
         return 'Available as "fdkaac" on most distros'
 
-    def encode_from_mem(self, input: bytes, output_f: Path, tags_file: Optional[Path]):
+    def encode_args(self, output_f: Path, tags_file: Optional[Path]) -> List[str]:
+        """Arguments to encode audio from stdin"""
         args = [
             self.executable,
             *self.additional_args,
@@ -522,20 +886,41 @@ class Fdkaac(Process):
         if tags_file is not None:
             args.append("--tag-from-json")
             args.append(str(tags_file))
+        return args
+
+    def encode_from_process(
+        self, source_args: List[str], output_f: Path, tags_file: Optional[Path]
+    ):
+        """Encode the stdout of the process given by source_args"""
+        args = self.encode_args(output_f, tags_file)
+        self.print_debug_info(source_args)
         self.print_debug_info(args)
         try:
-            subprocess.run(
-                args,
-                input=input,
-                capture_output=True,
-                check=True,
-                start_new_session=True,
-            )
+            with metrics.stage("process.pipeline"):
+                run_pipeline([source_args, args])
         except subprocess.CalledProcessError as e:
-            if b"unsupported sample rate" in e.stderr:
-                raise FdkaacUnsupportedSamplerateError from None
-            else:
-                raise e from None
+            raise self._encode_error(e, args) from None
+
+    async def encode_from_process_async(
+        self, source_args: List[str], output_f: Path, tags_file: Optional[Path]
+    ):
+        """Like encode_from_process, for jobs of the asyncio engine"""
+        args = self.encode_args(output_f, tags_file)
+        self.print_debug_info(source_args)
+        self.print_debug_info(args)
+        try:
+            with metrics.stage("process.pipeline"):
+                await run_pipeline_async([source_args, args])
+        except subprocess.CalledProcessError as e:
+            raise self._encode_error(e, args) from None
+
+    @staticmethod
+    def _encode_error(
+        error: subprocess.CalledProcessError, args: List[str]
+    ) -> Exception:
+        if error.cmd == args and b"unsupported sample rate" in error.stderr:
+            return FdkaacUnsupportedSamplerateError()
+        return error
 
 
 class AtomicParsley(Process):
@@ -548,17 +933,14 @@ class AtomicParsley(Process):
         return 'Available as "atomicparsley" on most distros'
 
     def add_artwork(self, file: Path, artwork: Path):
-        args = [
+        self.run(self.add_artwork_args(file, artwork))
+
+    def add_artwork_args(self, file: Path, artwork: Path) -> List[str]:
+        """Arguments for add_artwork"""
+        return [
             self.executable,
             str(file),
             "--artwork",
             str(artwork),
             "--overWrite",
         ]
-        self.print_debug_info(args)
-        subprocess.run(
-            args,
-            capture_output=True,
-            check=True,
-            start_new_session=True,
-        )
@@ -1,54 +1,328 @@
 import datetime
+import hashlib
 import os
-import shutil
+import threading
+import time
 import traceback
 from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from pathlib import Path
+from stat import S_ISLNK
 from subprocess import CalledProcessError
-from typing import TYPE_CHECKING, List, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
 
 from flacmirror.misc import format_date
 
-from .encode import encode_flac
-from .files import generate_output_path, get_all_files, source_is_newer
+from . import aio, native, ogg
+from .aio import JobTimeoutError
+from .albumart import AlbumArtCache
+from .encode import (
+    RETAG_CODECS,
+    encode_async_supported,
+    encode_flac,
+    encode_flac_async,
+    encode_flac_tee,
+    encode_flacs,
+    retag_flac,
+    tee_supported,
+)
+from .files import (
+    TEMP_PREFIX,
+    ScanResult,
+    atomic_output,
+    file_lstat,
+    find_temp_files,
+    generate_output_path,
+    is_temp_file,
+    scan_files,
+)
+from .manifest import (
+    MANIFEST_NAME,
+    NO_FINGERPRINT,
+    FingerprintCache,
+    Manifest,
+    ManifestEntry,
+    job_settings,
+)
+from .memory import MemoryBudget, PeakRss, estimate_memory
+from .metadata import FlacError, StreamInfo, read_metadata
+from .metrics import metrics
 from .options import Options
+from .processes import Flac, running_processes
+from .transfer import TransferStats, transfer_file, transfer_file_async
 
 if TYPE_CHECKING:
     from concurrent.futures import Future
 
+# Rough relative encoding cost per second of audio for each codec, used to schedule
+# expensive jobs first. Only the ratios between these numbers matter.
+CODEC_COST_FACTORS = {"opus": 1.0, "vorbis": 1.3, "aac": 0.9, "mp3": 1.0}
+# Used to estimate the duration of flac files without STREAMINFO (~900 kbit/s)
+FLAC_BYTES_PER_SECOND = 110_000
+# Copying a file costs roughly as much as encoding one second of audio per COPY_BYTES
+COPY_BYTES_PER_COST = 50_000_000
+# Codecs whose encoder can encode several files in one process
+BATCH_CODECS = {"vorbis"}
+# Largest number of files of a directory that are encoded by a single process
+MAX_BATCH_SIZE = 32
+# Codecs whose outputs are Ogg streams, see ogg.retag
+OGG_CODECS = {"opus", "vorbis"}
 
-def job_required(src_file: Path, dst_file: Path, options: Options) -> bool:
-    if not dst_file.exists():
+
+def job_required(
+    src_file: Path,
+    dst_stat: Optional[os.stat_result],
+    options: Options,
+    src_stat: Optional[os.stat_result] = None,
+) -> bool:
+    """Whether the output with lstat result dst_stat (None if missing) is outdated"""
+    if dst_stat is None:
         return True
     else:
         if options.overwrite == "all":
             return True
-        elif options.overwrite == "old":
-            if source_is_newer(src_file, dst_file):
+        elif options.overwrite in ["old", "changed"]:
+            if src_stat is None:
+                src_stat = src_file.lstat()
+            # Without fingerprints, "changed" falls back to the modification time.
+            # Hardlinks created by --link-copies have the same mtime as the source
+            if src_stat.st_mtime >= dst_stat.st_mtime and not (
+                options.link_copies and same_file(src_file, src_stat, dst_stat)
+            ):
                 return True
     return False
 
 
-def generate_jobs(options: Options) -> Tuple[List["Job"], List["JobDelete"]]:
+def same_file(
+    src_file: Path, src_stat: os.stat_result, dst_stat: os.stat_result
+) -> bool:
+    """Whether the output is a hardlink of src_file"""
+    if S_ISLNK(src_stat.st_mode):
+        # Hardlinks are made to the file the symlink points to.
+        src_stat = src_file.stat()
+    return os.path.samestat(src_stat, dst_stat)
+
+
+def metrics_requested(options: Options) -> bool:
+    """Whether a metrics report is written, which needs sizes and durations"""
+    return options.metrics_json is not None or options.metrics_prom is not None
+
+
+def source_extensions(options: Options) -> List[str]:
+    """Extensions of the source files that are encoded or copied"""
     extensions = ["flac"]
     if options.copy_ext is not None:
         for ext in options.copy_ext:
             if ext.startswith("."):
                 ext = ext[1:]
             extensions.append(ext)
-    src_files = get_all_files(
-        options.src_dir, extensions=extensions, allowed_names=options.copy_file
-    )
+    return extensions
+
+
+def output_suffix(options: Options) -> str:
     # Select output extension depending on which codec is used
     # .ogg also works for opus but some players don't like that so we just use opus
     if options.codec == "opus":
-        out_suffix = ".opus"
+        return ".opus"
     elif options.codec == "vorbis":
-        out_suffix = ".ogg"
+        return ".ogg"
     elif options.codec == "aac":
-        out_suffix = ".m4a"
+        return ".m4a"
     else:  # if options.codec == "mp3"
-        out_suffix = ".mp3"
+        return ".mp3"
+
+
+def file_job(
+    src_file: Path,
+    options: Options,
+    manifest: Optional[Manifest] = None,
+    src_stat: Optional[os.stat_result] = None,
+    art_cache: Optional[AlbumArtCache] = None,
+    transfer_stats: Optional[TransferStats] = None,
+    fingerprints: Optional[FingerprintCache] = None,
+    dst_stats: Optional[Dict[str, os.stat_result]] = None,
+) -> Tuple[Path, Optional["Job"]]:
+    """Return the output path of the absolute src_file and the job that creates it.
+
+    The job is None if the output is up to date. src_stat is required if a manifest
+    is used, fingerprints for --overwrite changed. dst_stats are the lstat results of
+    a scan of dst_dir, without them the output is looked at on disk.
+    """
+    src_file_relative = src_file.relative_to(options.src_dir.absolute())
+    dst_file = generate_output_path(
+        base=options.dst_dir.absolute(),
+        input_suffix=".flac",
+        suffix=output_suffix(options),
+        file=src_file_relative,
+    )
+    record: Optional[Tuple[str, ManifestEntry]] = None
+    old_entry: Optional[ManifestEntry] = None
+    if manifest is not None:
+        # With a manifest, only the source needs to be looked at if nothing
+        # changed since the last run.
+        assert src_stat is not None
+        src_key = str(src_file_relative)
+        new_entry = ManifestEntry(
+            src_size=src_stat.st_size,
+            src_mtime_ns=src_stat.st_mtime_ns,
+            settings=job_settings(options, src_file),
+            dst_file=str(dst_file.relative_to(options.dst_dir.absolute())),
+            src_inode=src_stat.st_ino,
+        )
+        old_entry = manifest.get(src_key)
+        use_fingerprint = (
+            options.overwrite == "changed"
+            and fingerprints is not None
+            and src_file.suffix == ".flac"
+        )
+        if old_entry is not None and options.overwrite != "all":
+            if old_entry.same_source(new_entry):
+                if use_fingerprint and not old_entry.fingerprint:
+                    # Recorded without a fingerprint, which is needed once the
+                    # timestamps change.
+                    assert fingerprints is not None
+                    fingerprint = fingerprints.get(src_file, src_stat)
+                    manifest.update(
+                        src_key,
+                        new_entry._replace(fingerprint=fingerprint or NO_FINGERPRINT),
+                    )
+                elif old_entry.src_inode != new_entry.src_inode:
+                    # Same file, but restored or recorded by an older version
+                    manifest.update(
+                        src_key,
+                        new_entry._replace(fingerprint=old_entry.fingerprint),
+                    )
+                return dst_file, None
+        if (
+            fingerprints is not None
+            and src_file.suffix == ".flac"
+            and options.overwrite in ["old", "changed"]
+        ):
+            # Only read for sources that changed going by the stats
+            fingerprint = fingerprints.get(src_file, src_stat)
+            new_entry = new_entry._replace(fingerprint=fingerprint or NO_FINGERPRINT)
+        record = (src_key, new_entry)
+        if old_entry is not None and options.overwrite != "all":
+            if old_entry.settings != new_entry.settings and options.overwrite != "none":
+                # Encoder settings changed, the existing output is outdated.
+                return dst_file, create_job(
+                    src_file, dst_file, record, art_cache, transfer_stats, src_stat
+                )
+            if (
+                options.overwrite == "changed"
+                and old_entry.content_known
+                and new_entry.content_known
+            ):
+                # The content decides, no matter how the timestamps moved.
+                if (
+                    old_entry.dst_file != new_entry.dst_file
+                    or output_stat(dst_file, dst_stats) is None
+                ):
+                    return dst_file, create_job(
+                        src_file, dst_file, record, art_cache, transfer_stats, src_stat
+                    )
+                if old_entry.fingerprint != new_entry.fingerprint:
+                    return dst_file, create_job(
+                        src_file,
+                        dst_file,
+                        record,
+                        art_cache,
+                        transfer_stats,
+                        src_stat,
+                        metadata_only(old_entry, new_entry, options),
+                    )
+                manifest.update(*record)
+                return dst_file, None
+    dst_stat = output_stat(dst_file, dst_stats)
+    if job_required(src_file, dst_stat, options, src_stat):
+        retag = (
+            old_entry is not None
+            and record is not None
+            and metadata_only(old_entry, record[1], options)
+            and dst_stat is not None
+        )
+        return dst_file, create_job(
+            src_file, dst_file, record, art_cache, transfer_stats, src_stat, retag
+        )
+    if manifest is not None and record is not None:
+        src_key, new_entry = record
+        if old_entry is not None:
+            # Not encoded again (--overwrite none), so the output keeps the settings
+            # it was encoded with and is outdated once overwriting is allowed.
+            new_entry = new_entry._replace(settings=old_entry.settings)
+        manifest.update(src_key, new_entry)
+    return dst_file, None
+
+
+def output_stat(
+    dst_file: Path, dst_stats: Optional[Dict[str, os.stat_result]]
+) -> Optional[os.stat_result]:
+    """lstat result of dst_file from the scan of dst_dir if there is one"""
+    if dst_stats is not None:
+        return dst_stats.get(str(dst_file))
+    return file_lstat(dst_file)
+
+
+def metadata_only(
+    old_entry: ManifestEntry, new_entry: ManifestEntry, options: Options
+) -> bool:
+    """Whether only the tags or pictures of the output need to be rewritten"""
+    return (
+        options.codec in RETAG_CODECS
+        and new_entry.audio_md5 != ""
+        and old_entry.audio_md5 == new_entry.audio_md5
+        and old_entry.settings == new_entry.settings
+        and old_entry.dst_file == new_entry.dst_file
+    )
+
+
+def scan_sources(options: Options, stat: bool = False) -> ScanResult:
+    with metrics.stage("scan.src"):
+        src_scan = scan_files(
+            options.src_dir,
+            extensions=source_extensions(options),
+            allowed_names=options.copy_file,
+            stat=stat,
+        )
+    print(
+        f"Found {len(src_scan.files)} files in {src_scan.directories} directories"
+        f" ({src_scan.duration:.2f} seconds)."
+    )
+    return src_scan
+
+
+def scan_destination(options: Options, stat: bool = False) -> ScanResult:
+    """All files of dst_dir, with their lstat results if stat is set"""
+    with metrics.stage("scan.dst"):
+        return scan_files(options.dst_dir, extensions=None, stat=stat)
+
+
+def generate_jobs(
+    options: Options,
+    manifest: Optional[Manifest] = None,
+    art_cache: Optional[AlbumArtCache] = None,
+    dst_scan: Optional[ScanResult] = None,
+    transfer_stats: Optional[TransferStats] = None,
+    src_scan: Optional[ScanResult] = None,
+    fingerprints: Optional[FingerprintCache] = None,
+) -> Tuple[List["Job"], List["JobDelete"]]:
+    """Calculate the jobs that mirror src_dir to dst_dir.
+
+    src_scan is scanned if it is not given, it needs stats if a manifest is used.
+    dst_scan (see scan_destination) finds the files to delete and, if it has stats
+    and no manifest is used, tells which outputs exist and are up to date. Without
+    it, dst_dir is only scanned if files are deleted.
+    """
+    if src_scan is None:
+        src_scan = scan_sources(options, stat=manifest is not None)
+    src_files = src_scan.files
+    if dst_scan is None and options.delete:
+        dst_scan = scan_destination(options, stat=manifest is None)
+    # With a manifest, only the outputs of changed sources are looked at, which is
+    # cheaper than getting the stats of every output.
+    dst_stats = None
+    if dst_scan is not None and manifest is None:
+        dst_stats = dst_scan.stats
 
     # Keep list of valid dst files even if there is no encode or copy job for them.
     # This list is used to check which files need to be deleted.
@@ -57,78 +331,563 @@ def generate_jobs(options: Options) -> Tuple[List["Job"], List["JobDelete"]]:
     # Deletion jobs should get their own joblist.
     jobs: List["Job"] = []
     for src_file in src_files:
-        src_file_relative = src_file.relative_to(options.src_dir.absolute())
-        dst_file = generate_output_path(
-            base=options.dst_dir.absolute(),
-            input_suffix=".flac",
-            suffix=out_suffix,
-            file=src_file_relative,
+        dst_file, job = file_job(
+            src_file,
+            options,
+            manifest,
+            src_scan.stats.get(str(src_file)),
+            art_cache,
+            transfer_stats,
+            fingerprints,
+            dst_stats,
         )
         dst_files.append(dst_file)
-        if job_required(src_file, dst_file, options):
-            # copy or encode?
-            if src_file.suffix == ".flac":
-                jobs.append(JobEncode(src_file, dst_file))
-            else:
-                jobs.append(JobCopy(src_file, dst_file))
+        if job is not None:
+            jobs.append(job)
+
+    if manifest is not None:
+        src_dir = options.src_dir.absolute()
+        manifest.prune(str(src_file.relative_to(src_dir)) for src_file in src_files)
+    metrics.count("skipped_jobs", len(src_files) - len(jobs))
 
     if not options.delete:
         return jobs, []
 
     jobs_delete = []
-    # Get a dst_files list that we can match against src_files
-    dst_files_found = get_all_files(options.dst_dir, extensions=None)
+    assert dst_scan is not None
     dst_files_set = set(bytes(dst_file) for dst_file in dst_files)
-    for dst_file_found in dst_files_found:
+    for dst_file_found in dst_scan.files:
         # If the found dst_file does not exist in the output list, delete it.
-        if bytes(dst_file_found) not in dst_files_set:
+        # Temporary files are removed before running any jobs.
+        if (
+            bytes(dst_file_found) not in dst_files_set
+            and not is_temp_file(dst_file_found)
+            and not is_manifest_file(dst_file_found, options)
+        ):
             jobs_delete.append(JobDelete(dst_file_found))
 
     return jobs, jobs_delete
 
 
+def create_job(
+    src_file: Path,
+    dst_file: Path,
+    manifest_record: Optional[Tuple[str, ManifestEntry]] = None,
+    art_cache: Optional[AlbumArtCache] = None,
+    transfer_stats: Optional[TransferStats] = None,
+    src_stat: Optional[os.stat_result] = None,
+    retag: bool = False,
+) -> "Job":
+    # copy, encode or only rewrite the tags?
+    job: Job
+    if src_file.suffix == ".flac" and retag:
+        job = JobRetag(src_file, dst_file, art_cache)
+    elif src_file.suffix == ".flac":
+        job = JobEncode(src_file, dst_file, art_cache)
+    else:
+        job = JobCopy(src_file, dst_file, transfer_stats)
+    job.manifest_record = manifest_record
+    job.src_stat = src_stat
+    return job
+
+
+def file_size(file: Path, file_stat: Optional[os.stat_result] = None) -> int:
+    """Size of file, from its lstat result if there is one, 0 if it is gone"""
+    if file_stat is not None and not S_ISLNK(file_stat.st_mode):
+        return file_stat.st_size
+    try:
+        return file.stat().st_size
+    except OSError:
+        return 0
+
+
+def estimate_costs(jobs: List["Job"], options: Options) -> Dict["Job", float]:
+    """Estimated cost of every job.
+
+    The headers of the sources are read by a pool of threads, which matters on
+    network mounts.
+    """
+    with ThreadPoolExecutor() as executor:
+        return dict(
+            zip(jobs, executor.map(lambda job: job.cost(job.target or options), jobs))
+        )
+
+
+def is_manifest_file(file: Path, options: Options) -> bool:
+    return file.parent == options.dst_dir.absolute() and file.name.startswith(
+        MANIFEST_NAME
+    )
+
+
 class Job:
+    # Name of the worker pool the job runs in, "cpu" or "io"
+    lane = "cpu"
+    # Name of the job type in metrics
+    kind = "job"
+    # Manifest key and entry that are recorded once the job finished successfully
+    manifest_record: Optional[Tuple[str, ManifestEntry]] = None
+    # Options of the target the job belongs to and the manifest it records to
+    target: Optional[Options] = None
+    manifest: Optional[Manifest] = None
+    # lstat result of the source from the scan, if the scan got stats
+    src_stat: Optional[os.stat_result] = None
+
     def run(self, options: Options):
         pass
 
+    async def run_async(self, options: Options):
+        """Run the job for the asyncio engine, by default in a worker thread"""
+        await aio.run_in_thread(self.lane, self.run, options)
+
+    def parts(self) -> List["Job"]:
+        """The single jobs this job consists of, recorded once it finished"""
+        return [self]
+
     def job_info(self) -> str:
         """Info that identifies the job in case of error"""
         return ""
 
+    def cost(self, options: Options) -> float:
+        """Estimated cost of the job, used for scheduling"""
+        return 0.0
+
+    def memory(self, options: Options) -> int:
+        """Estimated peak memory of the job in bytes, used for --max-memory"""
+        return 0
+
 
 class JobEncode(Job):
-    def __init__(self, src_file: Path, dst_file: Path):
+    kind = "encode"
+
+    def __init__(
+        self,
+        src_file: Path,
+        dst_file: Path,
+        art_cache: Optional[AlbumArtCache] = None,
+    ):
         self.src_file = src_file
         self.dst_file = dst_file
+        self.art_cache = art_cache
+        # STREAMINFO of src_file once it was read
+        self.streaminfo: Optional[StreamInfo] = None
 
     def run(self, options: Options):
         print(f"Encoding: {str(self.src_file)}\nOutput  : {str(self.dst_file)}")
         if not options.dry_run:
             self.dst_file.parent.mkdir(parents=True, exist_ok=True)
-            encode_flac(self.src_file, self.dst_file, options)
+            with atomic_output(self.dst_file) as tmp_file:
+                encode_flac(self.src_file, tmp_file, options, self.art_cache)
+            self.count_metrics(options)
+
+    async def run_async(self, options: Options):
+        if not encode_async_supported(options):
+            await super().run_async(options)
+            return
+        print(f"Encoding: {str(self.src_file)}\nOutput  : {str(self.dst_file)}")
+        if not options.dry_run:
+            self.dst_file.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_output(self.dst_file) as tmp_file:
+                await encode_flac_async(
+                    self.src_file, tmp_file, options, self.art_cache
+                )
+            self.count_metrics(options)
+
+    def count_metrics(self, options: Options):
+        # Only looked up for the report, the duration is usually known already.
+        if metrics_requested(options):
+            metrics.count("audio_seconds", self.duration())
+            metrics.count("bytes_read", file_size(self.src_file, self.src_stat))
+            metrics.count("bytes_written", file_size(self.dst_file))
+
+    def job_info(self) -> str:
+        """Info that identifies the job in case of error"""
+        return str(self.src_file)
+
+    def duration(self) -> float:
+        """Duration of the source in seconds, 0 if unknown"""
+        if self.streaminfo is None:
+            try:
+                self.streaminfo = read_metadata(
+                    self.src_file, pictures=False
+                ).streaminfo
+            except (OSError, FlacError):
+                return 0.0
+        return self.streaminfo.duration
+
+    def cost(self, options: Options) -> float:
+        duration = self.duration()
+        if duration == 0.0:
+            duration = file_size(self.src_file, self.src_stat) / FLAC_BYTES_PER_SECOND
+        return duration * CODEC_COST_FACTORS.get(options.codec, 1.0)
+
+    def memory(self, options: Options) -> int:
+        return estimate_memory(self.src_file, options)
+
+
+class JobEncodeBatch(Job):
+    """Encode jobs of files of one directory that are encoded together.
+
+    This saves process starts, which matters for libraries of short tracks.
+    """
+
+    kind = "encode_batch"
+
+    def __init__(self, jobs: List[JobEncode]):
+        self.jobs = jobs
+
+    def run(self, options: Options):
+        for job in self.jobs:
+            print(f"Encoding: {str(job.src_file)}\nOutput  : {str(job.dst_file)}")
+        if not options.dry_run:
+            self.jobs[0].dst_file.parent.mkdir(parents=True, exist_ok=True)
+            with ExitStack() as stack:
+                files = [
+                    (job.src_file, stack.enter_context(atomic_output(job.dst_file)))
+                    for job in self.jobs
+                ]
+                encode_flacs(files, options, self.jobs[0].art_cache)
+            for job in self.jobs:
+                job.count_metrics(options)
+
+    def parts(self) -> List[Job]:
+        return list(self.jobs)
+
+    def job_info(self) -> str:
+        """Info that identifies the job in case of error"""
+        return str(self.jobs[0].src_file.parent)
+
+    def cost(self, options: Options) -> float:
+        return sum(job.cost(options) for job in self.jobs)
+
+    def memory(self, options: Options) -> int:
+        # The files are encoded one after the other.
+        return max(job.memory(options) for job in self.jobs)
+
+
+def batch_jobs(jobs: List[Job], options: Options, num_threads: int) -> List[Job]:
+    """Combine encode jobs of the same directory if the encoder supports it.
+
+    Batches are only made as large as possible while still leaving enough jobs to
+    keep all threads busy.
+    """
+
+    def batchable(job: Job) -> bool:
+        return (
+            isinstance(job, JobEncode) and (job.target or options).codec in BATCH_CODECS
+        )
+
+    num_encode_jobs = sum(1 for job in jobs if batchable(job))
+    batch_size = min(MAX_BATCH_SIZE, num_encode_jobs // (num_threads * 4))
+    if batch_size < 2:
+        return jobs
+    batched: List[Job] = []
+    # Only jobs of the same target can be encoded together.
+    open_batches: Dict[Tuple[int, Path], JobEncodeBatch] = {}
+    for job in jobs:
+        if not isinstance(job, JobEncode) or not batchable(job):
+            batched.append(job)
+            continue
+        key = (id(job.target), job.src_file.parent)
+        batch = open_batches.get(key)
+        if batch is None or len(batch.jobs) >= batch_size:
+            batch = JobEncodeBatch([])
+            batch.target = job.target
+            open_batches[key] = batch
+            batched.append(batch)
+        batch.jobs.append(job)
+    return [
+        job.jobs[0] if isinstance(job, JobEncodeBatch) and len(job.jobs) == 1 else job
+        for job in batched
+    ]
+
+
+class JobEncodeTee(Job):
+    """Encode jobs of several targets for the same source.
+
+    The source is decoded once and the audio goes to the encoders of all targets.
+    """
+
+    kind = "encode_tee"
+
+    def __init__(self, jobs: List[JobEncode]):
+        self.jobs = jobs
+
+    def run(self, options: Options):
+        for job in self.jobs:
+            print(f"Encoding: {str(job.src_file)}\nOutput  : {str(job.dst_file)}")
+        if not options.dry_run:
+            with ExitStack() as stack:
+                outputs = []
+                for job in self.jobs:
+                    job.dst_file.parent.mkdir(parents=True, exist_ok=True)
+                    tmp_file = stack.enter_context(atomic_output(job.dst_file))
+                    outputs.append((tmp_file, job.target or options))
+                encode_flac_tee(self.jobs[0].src_file, outputs, self.jobs[0].art_cache)
+            for job in self.jobs:
+                job.count_metrics(job.target or options)
+
+    def parts(self) -> List[Job]:
+        return list(self.jobs)
+
+    def job_info(self) -> str:
+        """Info that identifies the job in case of error"""
+        return str(self.jobs[0].src_file)
+
+    def cost(self, options: Options) -> float:
+        return sum(job.cost(job.target or options) for job in self.jobs)
+
+    def memory(self, options: Options) -> int:
+        # The encoders of all targets run at the same time.
+        return sum(job.memory(job.target or options) for job in self.jobs)
+
+
+def tee_jobs(jobs: List[Job], options: Options) -> List[Job]:
+    """Combine the encode jobs of different targets for the same source.
+
+    Only jobs whose encoders can read the decoded audio from a pipe are combined,
+    and only if flac is installed to decode it.
+    """
+
+    def teeable(job: Job) -> bool:
+        return isinstance(job, JobEncode) and tee_supported(job.target or options)
+
+    if not any(teeable(job) and job.target is not None for job in jobs):
+        return jobs
+    if not Flac(False).available():
+        return jobs
+    groups: Dict[Path, List[JobEncode]] = {}
+    for job in jobs:
+        if isinstance(job, JobEncode) and teeable(job):
+            groups.setdefault(job.src_file, []).append(job)
+
+    result: List[Job] = []
+    for job in jobs:
+        group = groups.get(job.src_file) if isinstance(job, JobEncode) else None
+        if group is None or len(group) == 1 or not teeable(job):
+            result.append(job)
+        elif group[0] is job:
+            result.append(JobEncodeTee(group))
+    return result
+
+
+class JobEncodeDedup(Job):
+    """Encode jobs of sources with identical audio, only the first one is encoded.
+
+    The others get a hardlink to its output, or a copy with their own tags if their
+    tags differ.
+    """
+
+    kind = "encode_dedup"
+
+    def __init__(
+        self, jobs: List[JobEncode], transfer_stats: Optional[TransferStats] = None
+    ):
+        self.jobs = jobs
+        self.transfer_stats = transfer_stats
+        # Number of outputs that were not encoded and the wall time of the encodes
+        # that this saved
+        self.linked = 0
+        self.saved_seconds = 0.0
+
+    def run(self, options: Options):
+        first = self.jobs[0]
+        start = time.perf_counter()
+        first.run(options)
+        encode_seconds = time.perf_counter() - start
+        tags = read_metadata(first.src_file, pictures=False).tags
+        for job in self.jobs[1:]:
+            print(f"Linking : {str(job.src_file)}\nOutput  : {str(job.dst_file)}")
+            if options.dry_run:
+                continue
+            job.dst_file.parent.mkdir(parents=True, exist_ok=True)
+            job_tags = read_metadata(job.src_file, pictures=False).tags
+            try:
+                with atomic_output(job.dst_file) as tmp_file:
+                    if job_tags == tags:
+                        transfer_file(
+                            first.dst_file,
+                            tmp_file,
+                            link=True,
+                            stats=self.transfer_stats,
+                        )
+                    else:
+                        ogg.retag(first.dst_file, tmp_file, tags, job_tags)
+            except ogg.OggError:
+                # Not a stream ogg.retag can handle, encode it after all.
+                job.run(options)
+                continue
+            self.linked += 1
+            self.saved_seconds += encode_seconds
+            metrics.count("dedup_files")
+            metrics.count("dedup_saved_wall_seconds", encode_seconds)
+            if metrics_requested(options):
+                metrics.count("bytes_written", file_size(job.dst_file))
+
+    def parts(self) -> List[Job]:
+        return list(self.jobs)
+
+    def job_info(self) -> str:
+        """Info that identifies the job in case of error"""
+        return str(self.jobs[0].src_file)
+
+    def cost(self, options: Options) -> float:
+        return self.jobs[0].cost(options)
+
+    def memory(self, options: Options) -> int:
+        return estimate_memory(self.jobs[0].src_file, options, rewrite=True)
+
+
+def dedup_key(job: JobEncode, options: Options) -> Optional[Tuple[Any, ...]]:
+    """Key of the encode job that is equal for jobs that give the same output"""
+    target = job.target or options
+    try:
+        metadata = read_metadata(job.src_file, pictures=target.albumart != "discard")
+    except (OSError, FlacError):
+        return None
+    # Keep the STREAMINFO for scheduling and metrics
+    job.streaminfo = metadata.streaminfo
+    if not any(metadata.streaminfo.md5):
+        # The encoder of the flac file did not calculate the MD5
+        return None
+    pictures = hashlib.sha1()
+    for picture in metadata.pictures:
+        pictures.update(picture.data)
+    return (
+        id(job.target),
+        job_settings(target, job.src_file),
+        metadata.streaminfo.md5,
+        pictures.digest(),
+        None if target.codec in OGG_CODECS else tuple(metadata.tags),
+    )
+
+
+def dedup_jobs(
+    jobs: List[Job], options: Options, transfer_stats: Optional[TransferStats] = None
+) -> List[Job]:
+    """Combine encode jobs of sources with the same audio and encoder settings.
+
+    Sources are the same if the MD5 of the decoded audio in STREAMINFO is the same.
+    The pictures must be the same too, unless album art is discarded, and so must the
+    tags if they can not be rewritten for the codec.
+    """
+    encode_jobs = [job for job in jobs if isinstance(job, JobEncode)]
+    # The headers are read by a pool of threads, which matters on network mounts.
+    with ThreadPoolExecutor() as executor:
+        keys = executor.map(lambda job: dedup_key(job, options), encode_jobs)
+        groups: Dict[Tuple[Any, ...], List[JobEncode]] = {}
+        job_keys: Dict[Job, Tuple[Any, ...]] = {}
+        for encode_job, key in zip(encode_jobs, keys):
+            if key is not None:
+                groups.setdefault(key, []).append(encode_job)
+                job_keys[encode_job] = key
+
+    result: List[Job] = []
+    for job in jobs:
+        group = groups.get(job_keys[job]) if job in job_keys else None
+        if group is None or len(group) == 1:
+            result.append(job)
+        elif group[0] is job:
+            dedup = JobEncodeDedup(group, transfer_stats)
+            dedup.target = job.target
+            result.append(dedup)
+    return result
+
+
+class JobRetag(Job):
+    """Rewrite the tags and album art of an output whose source audio is unchanged"""
+
+    lane = "io"
+    kind = "retag"
+
+    def __init__(
+        self,
+        src_file: Path,
+        dst_file: Path,
+        art_cache: Optional[AlbumArtCache] = None,
+    ):
+        self.src_file = src_file
+        self.dst_file = dst_file
+        self.art_cache = art_cache
+
+    def run(self, options: Options):
+        print(f"Tagging : {str(self.src_file)}\nOutput  : {str(self.dst_file)}")
+        if not options.dry_run:
+            with atomic_output(self.dst_file) as tmp_file:
+                retag_flac(
+                    self.src_file, self.dst_file, tmp_file, options, self.art_cache
+                )
+            if metrics_requested(options):
+                metrics.count("bytes_written", file_size(self.dst_file))
 
     def job_info(self) -> str:
         """Info that identifies the job in case of error"""
         return str(self.src_file)
 
+    def cost(self, options: Options) -> float:
+        return file_size(self.dst_file) / COPY_BYTES_PER_COST
+
+    def memory(self, options: Options) -> int:
+        return estimate_memory(self.src_file, options, rewrite=True)
+
 
 class JobCopy(Job):
-    def __init__(self, src_file: Path, dst_file: Path):
+    lane = "io"
+    kind = "copy"
+
+    def __init__(
+        self,
+        src_file: Path,
+        dst_file: Path,
+        transfer_stats: Optional[TransferStats] = None,
+    ):
         self.src_file = src_file
         self.dst_file = dst_file
+        self.transfer_stats = transfer_stats
 
     def run(self, options: Options):
         print(f"Copying {str(self.src_file)}\n    to {str(self.dst_file)}")
         if not options.dry_run:
             self.dst_file.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy(str(self.src_file), str(self.dst_file))
+            with atomic_output(self.dst_file) as tmp_file:
+                transfer_file(
+                    self.src_file,
+                    tmp_file,
+                    link=options.link_copies,
+                    stats=self.transfer_stats,
+                )
+            self.count_metrics(options)
+
+    async def run_async(self, options: Options):
+        print(f"Copying {str(self.src_file)}\n    to {str(self.dst_file)}")
+        if not options.dry_run:
+            self.dst_file.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_output(self.dst_file) as tmp_file:
+                await transfer_file_async(
+                    self.src_file,
+                    tmp_file,
+                    link=options.link_copies,
+                    stats=self.transfer_stats,
+                )
+            self.count_metrics(options)
+
+    def count_metrics(self, options: Options):
+        if metrics_requested(options):
+            size = file_size(self.src_file, self.src_stat)
+            metrics.count("bytes_read", size)
+            metrics.count("bytes_written", size)
 
     def job_info(self) -> str:
         """Info that identifies the job in case of error"""
         return str(self.src_file)
 
+    def cost(self, options: Options) -> float:
+        return file_size(self.src_file, self.src_stat) / COPY_BYTES_PER_COST
+
 
 class JobDelete(Job):
+    lane = "io"
+    kind = "delete"
+
     def __init__(self, file: Path):
         self.file = file
 
@@ -138,24 +897,246 @@ class JobDelete(Job):
         if not options.dry_run:
             self.file.unlink()
 
+    async def run_async(self, options: Options):
+        # Too quick to be worth a thread
+        self.run(options)
+
     def job_info(self) -> str:
         """Info that identifies the job in case of error"""
         return str(self.file)
 
 
+class WorkerTimes:
+    """Records when the workers of a thread pool are busy to report utilization"""
+
+    def __init__(self, num_workers: int):
+        self.num_workers = num_workers
+        self.start = time.perf_counter()
+        self.stop = self.start
+        # (worker id, start, stop) for each job that ran
+        self.intervals: List[Tuple[int, float, float]] = []
+
+    def run(self, job: "Job", options: Options):
+        start = time.perf_counter()
+        try:
+            with metrics.stage(f"job.{job.kind}"):
+                job.run(options)
+        finally:
+            self.record(threading.get_ident(), start, time.perf_counter())
+
+    async def run_async(self, job: "Job", options: Options, worker: int):
+        start = time.perf_counter()
+        try:
+            with metrics.stage(f"job.{job.kind}"):
+                await job.run_async(options)
+        finally:
+            self.record(worker, start, time.perf_counter())
+
+    def record(self, worker: int, start: float, stop: float):
+        self.intervals.append((worker, start, stop))
+
+    def finish(self):
+        self.stop = time.perf_counter()
+
+    def utilization(self) -> float:
+        capacity = self.num_workers * (self.stop - self.start)
+        if capacity <= 0:
+            return 0.0
+        busy = sum(stop - start for _, start, stop in self.intervals)
+        return busy / capacity
+
+    def tail_idle_time(self) -> float:
+        """Sum of the time each worker was idle after finishing its last job"""
+        last_stop: Dict[int, float] = {}
+        for worker, _, stop in self.intervals:
+            last_stop[worker] = max(stop, last_stop.get(worker, stop))
+        unused_workers = max(self.num_workers - len(last_stop), 0)
+        return sum(self.stop - stop for stop in last_stop.values()) + unused_workers * (
+            self.stop - self.start
+        )
+
+    def summary(self) -> str:
+        return (
+            f"{self.num_workers} workers busy {self.utilization():.1%} of the time,"
+            f" idle core time at the tail: {self.tail_idle_time():.1f} seconds."
+        )
+
+
+def output_directories(jobs: List[Job]) -> Set[Path]:
+    """Directories the jobs write their outputs to"""
+    return {
+        job.dst_file.parent
+        for job in jobs
+        if isinstance(job, (JobEncode, JobRetag, JobCopy))
+    }
+
+
 class JobQueue:
-    def __init__(self, options: Options):
+    def __init__(self, options: Options, extra_targets: Optional[List[Options]] = None):
         self.options = options
-        print("Scanning files and calculating jobs...")
-        self.jobs, self.jobs_delete = generate_jobs(options)
+        # Every target mirrors src_dir to its own dst_dir with its own codec
+        # settings, src_dir is only scanned once for all of them.
+        self.targets = [options, *(extra_targets or [])]
+        self.manifests: List[Optional[Manifest]] = [
+            Manifest.load(target.dst_dir.absolute()) if target.manifest else None
+            for target in self.targets
+        ]
+        self.manifest = self.manifests[0]
+        # Shared by all targets, so cover art is only converted once per setting
+        self.art_cache = AlbumArtCache(cache_dir=options.albumart_cache_dir)
+        self.transfer_stats = TransferStats()
+        # Shared by all targets too, every source file is only read once
+        self.fingerprints = FingerprintCache()
+        for manifest in self.manifests:
+            if manifest is not None:
+                self.fingerprints.add_manifest(manifest)
+        self.temp_files: List[Path] = []
+        self.jobs: List[Job] = []
+        self.jobs_delete: List[JobDelete] = []
         self.futures: List["Future[None]"] = []
+        self.memory_budget: Optional[MemoryBudget] = None
+        self.engine: Optional[aio.Engine] = None
+        self.cancelled = False
+        self.generate()
+
+    def generate(self):
+        """Scan src_dir and every dst_dir and calculate the jobs of a full sync"""
+        print("Scanning files and calculating jobs...")
+        # Every destination is walked once, at the same time as the source. The scan
+        # finds the files to delete and, without a manifest, answers which outputs
+        # exist and are up to date, so they are not looked at one by one. With a
+        # manifest and without --delete, the destination is not walked at all.
+        with ThreadPoolExecutor(max_workers=len(self.targets)) as executor:
+            dst_futures = [
+                (
+                    executor.submit(scan_destination, target, manifest is None)
+                    if manifest is None or target.delete
+                    else None
+                )
+                for target, manifest in zip(self.targets, self.manifests)
+            ]
+            src_scan = scan_sources(
+                self.options,
+                stat=any(manifest is not None for manifest in self.manifests),
+            )
+            dst_scans = [
+                future.result() if future is not None else None
+                for future in dst_futures
+            ]
+        target_jobs = []
+        for target, manifest, dst_scan in zip(self.targets, self.manifests, dst_scans):
+            target_jobs.append(
+                generate_jobs(
+                    target,
+                    manifest,
+                    self.art_cache,
+                    dst_scan,
+                    self.transfer_stats,
+                    src_scan,
+                    self.fingerprints,
+                )
+            )
+        # Leftovers of interrupted runs are removed before running any jobs. If the
+        # destination was not walked, only the directories jobs write to are looked
+        # at, which are the ones where an interrupted run left something behind
+        # unless the source was removed since.
+        self.temp_files = []
+        for dst_scan, (jobs, _) in zip(dst_scans, target_jobs):
+            if dst_scan is not None:
+                self.temp_files.extend(
+                    file for file in dst_scan.files if is_temp_file(file)
+                )
+            else:
+                self.temp_files.extend(find_temp_files(output_directories(jobs)))
+        self.set_jobs(target_jobs)
+
+    def set_jobs(self, target_jobs: List[Tuple[List[Job], List[JobDelete]]]):
+        """Set the jobs and deletions to run, one pair for each target"""
+        self.jobs_delete = []
+        by_source: Dict[str, List[Job]] = {}
+        for target, manifest, (jobs, jobs_delete) in zip(
+            self.targets, self.manifests, target_jobs
+        ):
+            for job in [*jobs, *jobs_delete]:
+                # Jobs of the main target run with self.options
+                job.target = target if target is not self.options else None
+                job.manifest = manifest
+            self.jobs_delete.extend(jobs_delete)
+            for job in jobs:
+                by_source.setdefault(job.job_info(), []).append(job)
+        # The jobs of all targets for a source run next to each other, so that the
+        # source is read from disk once and from the page cache for the others.
+        self.jobs = [job for jobs in by_source.values() for job in jobs]
 
     def run_singlethreaded(self):
+        self.remove_temp_files()
         for job in self.jobs:
-            job.run(self.options)
+            job.run(job.target or self.options)
+            self.record(job)
+        self.save_manifest()
+
+    def record(self, job: Job):
+        for part in job.parts():
+            metrics.count(f"{part.kind}_jobs")
+            if part.manifest is not None and part.manifest_record is not None:
+                part.manifest.update(*part.manifest_record)
+
+    def save_manifest(self):
+        if self.options.dry_run:
+            return
+        for manifest in self.manifests:
+            if manifest is not None:
+                manifest.save()
 
     def run(self):
+        try:
+            with metrics.stage("run"):
+                self._run()
+        finally:
+            self.save_manifest()
+            self.write_metrics()
+
+    def write_metrics(self):
+        if not metrics_requested(self.options):
+            return
+        run_seconds = sum(metrics.stages.get("run", []))
+        metrics.set("run_seconds", run_seconds)
+        if run_seconds > 0:
+            metrics.set(
+                "realtime_factor",
+                metrics.counters.get("audio_seconds", 0) / run_seconds,
+            )
+        if self.options.metrics_json is not None:
+            metrics.write(self.options.metrics_json)
+        if self.options.metrics_prom is not None:
+            metrics.write(self.options.metrics_prom, prometheus=True)
+
+    def remove_temp_files(self):
+        if not self.temp_files:
+            return
+        print(f"Removing {len(self.temp_files)} temporary files of interrupted runs")
+        if self.options.dry_run:
+            return
+        temp_dirs = set()
+        for file in self.temp_files:
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+            if file.parent.name.startswith(TEMP_PREFIX):
+                temp_dirs.add(file.parent)
+        for directory in temp_dirs:
+            try:
+                directory.rmdir()
+            except OSError:
+                pass
+        self.temp_files = []
+
+    def _run(self):
         start_time = datetime.datetime.now()
+        self.cancelled = False
+        running_processes.reset()
+        self.remove_temp_files()
         if self.jobs_delete:
             for job in self.jobs_delete:
                 print(f"Marked for deletion: {job.file}")
@@ -171,42 +1152,243 @@ class JobQueue:
                     elif inp == "n" or inp == "":
                         return
             print("Deleting...")
-            for job in self.jobs_delete:
-                job.run(self.options)
+            # Like before the io lane, deletions finish before anything else
+            # starts, so that their space is free for the new outputs.
+            if not self.run_deletions():
+                return
 
         if self.options.num_threads is not None:
             num_threads = self.options.num_threads
         else:
-            num_threads = os.cpu_count()
+            num_threads = os.cpu_count() or 1
+        # Encoders run in the cpu lane, copies and deletions in the io lane, so that
+        # slow copies never block encoder slots and vice versa.
+        lane_sizes = {"cpu": num_threads, "io": self.options.io_threads}
+
+        jobs = self.jobs
+        if self.options.dedup:
+            with metrics.stage("dedup"):
+                jobs = dedup_jobs(jobs, self.options, self.transfer_stats)
+        if len(self.targets) > 1:
+            jobs = tee_jobs(jobs, self.options)
+        jobs = batch_jobs(jobs, self.options, num_threads)
+        if self.options.schedule == "lpt":
+            # Longest processing time first: start the most expensive jobs first so
+            # that the cheap ones fill the gaps at the end.
+            with metrics.stage("schedule"):
+                costs = estimate_costs(jobs, self.options)
+            jobs = sorted(jobs, key=lambda job: costs[job], reverse=True)
 
         print("Running copy/encode jobs...")
-        with ThreadPoolExecutor(max_workers=num_threads) as ex:
-            self.futures = [ex.submit(job.run, self.options) for job in self.jobs]
-            for future in as_completed(self.futures):
-                try:
-                    future.result()
-                except CancelledError:
-                    pass
-                except CalledProcessError as err:
-                    print(f"\nError when calling: {err.cmd}")
-                    print(f"Process returned code: {err.returncode}")
-                    # print(f"stdout:\n{e.stdout}")
-                    print(f"stderr:\n{err.stderr.decode()}")
-                    self.cancel()
-                    # do not check all the other futures and print their errors
-                    break
-                except Exception:
-                    job = self.jobs[self.futures.index(future)]  # lookup job
-                    print(f"\nError processing file {job.job_info()}:")
-                    print(traceback.format_exc())
-                    self.cancel()
-                    # do not check all the other futures and print their errors
-                    break
+        worker_times = {lane: WorkerTimes(size) for lane, size in lane_sizes.items()}
+        peak_rss = None
+        self.memory_budget = None
+        if self.options.max_memory is not None and not self.options.dry_run:
+            self.memory_budget = MemoryBudget(self.options.max_memory)
+            peak_rss = PeakRss()
+            peak_rss.start()
+        with ExitStack() as stack:
+            if peak_rss is not None:
+                stack.callback(peak_rss.stop)
+            if self.options.encoder_backend == "native" and any(
+                native.available(target.codec) for target in self.targets
+            ):
+                native.start_workers(num_threads)
+                stack.callback(native.stop_workers)
+            if self.options.engine == "asyncio":
+                self._run_engine(jobs, lane_sizes, worker_times)
+            else:
+                self._run_threads(jobs, lane_sizes, worker_times, stack)
+        for lane, lane_times in worker_times.items():
+            lane_times.finish()
+            if lane_times.intervals:
+                metrics.set(f"{lane}_lane_utilization", lane_times.utilization())
+                metrics.set(
+                    f"{lane}_lane_tail_idle_seconds", lane_times.tail_idle_time()
+                )
         stop_time = datetime.datetime.now()
         print(f"All jobs done. Took {format_date(stop_time - start_time)}.")
+        if jobs:
+            print(f"Scheduling ({self.options.schedule}):")
+            for lane, lane_times in worker_times.items():
+                if lane_times.intervals:
+                    print(f"    {lane} lane: {lane_times.summary()}")
+        if self.art_cache.hits or self.art_cache.misses:
+            print(self.art_cache.summary())
+        if self.transfer_stats.strategies:
+            print(self.transfer_stats.summary())
+        if peak_rss is not None:
+            self.report_memory(peak_rss)
+        deduplicated = [job for job in jobs if isinstance(job, JobEncodeDedup)]
+        if any(job.linked for job in deduplicated):
+            print(
+                f"Deduplicated {sum(job.linked for job in deduplicated)} files with"
+                " identical audio, saving encodes that took"
+                f" {sum(job.saved_seconds for job in deduplicated):.1f} seconds"
+                " (wall time)."
+            )
+
+    def run_deletions(self) -> bool:
+        """Delete the files of jobs_delete one by one, False if that failed"""
+        for job in self.jobs_delete:
+            if self.cancelled:
+                return False
+            try:
+                with metrics.stage(f"job.{job.kind}"):
+                    job.run(job.target or self.options)
+            except Exception as err:
+                self.job_failed(job, err)
+                return False
+            self.record(job)
+        return True
+
+    def _run_threads(
+        self,
+        jobs: List[Job],
+        lane_sizes: Dict[str, int],
+        worker_times: Dict[str, WorkerTimes],
+        stack: ExitStack,
+    ):
+        executors = {
+            lane: stack.enter_context(ThreadPoolExecutor(max_workers=size))
+            for lane, size in lane_sizes.items()
+        }
+        self.futures = [
+            executors[job.lane].submit(
+                self._run_admitted,
+                job,
+                job.target or self.options,
+                worker_times[job.lane],
+            )
+            for job in jobs
+        ]
+        future_jobs: Dict["Future[None]", Job] = dict(zip(self.futures, jobs))
+        for future in as_completed(self.futures):
+            try:
+                future.result()
+                self.record(future_jobs[future])
+            except CancelledError:
+                pass
+            except JobTimeoutError as err:
+                # Only this job is given up, the others keep running.
+                self.job_failed(future_jobs[future], err)
+            except Exception as err:
+                if self.cancelled:
+                    # Jobs whose processes were stopped
+                    continue
+                self.job_failed(future_jobs[future], err)
+                # do not check all the other futures and print their errors
+                break
+
+    def _run_engine(
+        self,
+        jobs: List[Job],
+        lane_sizes: Dict[str, int],
+        worker_times: Dict[str, WorkerTimes],
+    ):
+        self.engine = aio.Engine(
+            lane_sizes,
+            self.options.job_timeout,
+            self.memory_budget,
+            lambda job: job.memory(job.target or self.options),
+        )
+        if self.cancelled:
+            return
+        try:
+            self.engine.run(
+                jobs,
+                lambda job, worker: worker_times[job.lane].run_async(
+                    job, job.target or self.options, worker
+                ),
+                self.record,
+                self.job_failed,
+            )
+        finally:
+            self.engine = None
+
+    def _run_admitted(self, job: Job, options: Options, worker_times: WorkerTimes):
+        """Run job once its estimated memory fits into the budget of --max-memory"""
+        budget = self.memory_budget
+        amount = job.memory(options) if budget is not None else 0
+        if budget is None or amount == 0:
+            self._run_timed(job, options, worker_times)
+            return
+        budget.acquire(amount)
+        try:
+            self._run_timed(job, options, worker_times)
+        finally:
+            budget.remove(amount)
+
+    def _run_timed(self, job: Job, options: Options, worker_times: WorkerTimes):
+        """Run job, stopping its processes once it took longer than --job-timeout"""
+        timeout = self.options.job_timeout
+        if timeout is None:
+            worker_times.run(job, options)
+            return
+        thread = threading.get_ident()
+        timer = threading.Timer(timeout, running_processes.terminate_thread, (thread,))
+        timer.daemon = True
+        timer.start()
+        try:
+            worker_times.run(job, options)
+        except Exception as err:
+            timer.cancel()
+            timer.join()
+            if running_processes.release_thread(thread):
+                raise JobTimeoutError(
+                    f"Job did not finish within {timeout} seconds"
+                ) from err
+            raise
+        timer.cancel()
+        timer.join()
+        # A job that finished although it was stopped did not need the processes.
+        running_processes.release_thread(thread)
+
+    def report_memory(self, peak_rss: PeakRss):
+        assert self.memory_budget is not None
+        peak = peak_rss.peak
+        metrics.set("peak_rss_bytes", peak)
+        metrics.set("peak_estimated_memory_bytes", self.memory_budget.peak)
+        print(
+            f"Peak memory: {peak / 2**20:.0f} MB resident, jobs estimated at"
+            f" {self.memory_budget.peak / 2**20:.0f} MB of the"
+            f" {self.memory_budget.limit / 2**20:.0f} MB budget."
+        )
+
+    def job_failed(self, job: Job, err: BaseException):
+        metrics.count("failed_jobs")
+        if isinstance(err, CalledProcessError):
+            print(f"\nError when calling: {err.cmd}")
+            print(f"Process returned code: {err.returncode}")
+            # print(f"stdout:\n{e.stdout}")
+            print(f"stderr:\n{err.stderr.decode()}")
+        elif isinstance(err, JobTimeoutError):
+            print(f"\nError processing file {job.job_info()}: {err}")
+            return
+        else:
+            print(f"\nError processing file {job.job_info()}:")
+            print(
+                "".join(traceback.format_exception(type(err), err, err.__traceback__))
+            )
+        self.cancel()
 
     def cancel(self):
-        print("Stopping pending jobs and finishing running jobs...")
+        """Stop all jobs, the processes of running jobs are terminated.
+
+        Their temporary outputs are removed when the jobs fail.
+        """
+        print("Stopping all jobs...")
+        self.stop()
+
+    def stop(self):
+        """Like cancel, without telling the user"""
+        self.cancelled = True
+        if self.memory_budget is not None:
+            self.memory_budget.cancel()
         for future in self.futures:
             # Cancel still pending Futures if we stop early
             future.cancel()
+        if self.engine is not None:
+            self.engine.cancel()
+        running_processes.terminate()
+        native.terminate_workers()
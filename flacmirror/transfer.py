@@ -0,0 +1,207 @@
+import asyncio
+import errno
+import os
+import threading
+from pathlib import Path
+from typing import BinaryIO, Dict, Generator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None  # type: ignore
+
+# ioctl request number to clone a whole file on btrfs/XFS (from linux/fs.h)
+FICLONE = 0x40049409
+CHUNK_SIZE = 1024 * 1024
+# Bytes copied in the kernel by a single call, after which copies of the asyncio
+# engine let the event loop run
+STEP_SIZE = 16 * CHUNK_SIZE
+
+# Generator that yields between the steps of a copy and returns its result
+Steps = Generator[None, None, str]
+
+# errno values that mean that a strategy is not supported for the given files
+_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.EPERM,
+}
+
+
+class TransferStats:
+    """Thread-safe counters for the number of files and bytes per strategy"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.strategies: Dict[str, Tuple[int, int]] = {}
+
+    def add(self, strategy: str, size: int):
+        with self._lock:
+            files, total = self.strategies.get(strategy, (0, 0))
+            self.strategies[strategy] = (files + 1, total + size)
+
+    def summary(self) -> str:
+        parts = [
+            f"{strategy} {files} files ({size / 1e6:.1f} MB)"
+            for strategy, (files, size) in sorted(self.strategies.items())
+        ]
+        return "Transferred files: " + ", ".join(parts) + "."
+
+
+def _reflink(fsrc: BinaryIO, fdst: BinaryIO) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def _copy_file_range(
+    fsrc: BinaryIO, fdst: BinaryIO, size: int
+) -> Generator[None, None, bool]:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    offset = 0
+    while offset < size:
+        try:
+            copied = os.copy_file_range(  # type: ignore[attr-defined]
+                fsrc.fileno(),
+                fdst.fileno(),
+                min(size - offset, STEP_SIZE),
+                offset,
+                offset,
+            )
+        except OSError as e:
+            # Only fall back if nothing was copied yet
+            if offset == 0 and e.errno in _UNSUPPORTED:
+                return False
+            raise
+        if copied == 0:
+            break
+        offset += copied
+        yield
+    return True
+
+
+def _sendfile(fsrc: BinaryIO, fdst: BinaryIO, size: int) -> Generator[None, None, bool]:
+    if not hasattr(os, "sendfile"):
+        return False
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(
+                fdst.fileno(), fsrc.fileno(), offset, min(size - offset, STEP_SIZE)
+            )
+        except OSError as e:
+            if offset == 0 and e.errno in _UNSUPPORTED:
+                return False
+            raise
+        if sent == 0:
+            break
+        offset += sent
+        yield
+    # sendfile does not move the file position of the output file
+    fdst.seek(offset)
+    return True
+
+
+def _copy_buffered(fsrc: BinaryIO, fdst: BinaryIO) -> Generator[None, None, None]:
+    while True:
+        chunk = fsrc.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        fdst.write(chunk)
+        yield
+
+
+def copy_file_steps(src_file: Path, dst_file: Path) -> Steps:
+    """Copy the contents of src_file to dst_file using the fastest available way.
+
+    Tries to clone the file (reflink), then copies in the kernel with copy_file_range
+    or sendfile and finally falls back to a buffered copy in user space. Permission
+    bits are not copied. Returns the name of the strategy that was used.
+    """
+    with open(src_file, "rb") as fsrc, open(dst_file, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if _reflink(fsrc, fdst):
+            return "reflink"
+        if size > 0:
+            if (yield from _copy_file_range(fsrc, fdst, size)):
+                return "copy_file_range"
+            if (yield from _sendfile(fsrc, fdst, size)):
+                return "sendfile"
+        yield from _copy_buffered(fsrc, fdst)
+        return "buffered"
+
+
+def _run_steps(steps: Steps) -> str:
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+
+
+def copy_file(src_file: Path, dst_file: Path) -> str:
+    """Like copy_file_steps, in one go"""
+    return _run_steps(copy_file_steps(src_file, dst_file))
+
+
+def transfer_file(
+    src_file: Path,
+    dst_file: Path,
+    link: bool = False,
+    stats: Optional[TransferStats] = None,
+) -> str:
+    """Copy or (if link is set and possible) hardlink src_file to dst_file"""
+    return _run_steps(transfer_file_steps(src_file, dst_file, link, stats))
+
+
+async def transfer_file_async(
+    src_file: Path,
+    dst_file: Path,
+    link: bool = False,
+    stats: Optional[TransferStats] = None,
+) -> str:
+    """Like transfer_file, letting the event loop run between the steps of a copy.
+
+    File I/O can not be awaited, but a copy needs no thread of its own like this.
+    """
+    steps = transfer_file_steps(src_file, dst_file, link, stats)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+        await asyncio.sleep(0)
+
+
+def transfer_file_steps(
+    src_file: Path,
+    dst_file: Path,
+    link: bool = False,
+    stats: Optional[TransferStats] = None,
+) -> Steps:
+    """transfer_file, yielding between the steps of a copy"""
+    strategy = None
+    if link:
+        try:
+            os.link(str(src_file), str(dst_file))
+            strategy = "hardlink"
+        except OSError as e:
+            # Different file systems or no hardlink support, copy instead
+            if e.errno not in _UNSUPPORTED and e.errno != errno.EMLINK:
+                raise
+    if strategy is None:
+        strategy = yield from copy_file_steps(src_file, dst_file)
+    if stats is not None:
+        stats.add(strategy, dst_file.stat().st_size)
+    return strategy
@@ -0,0 +1,339 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from .albumart import AlbumArtCache
+from .files import (
+    generate_output_path,
+    get_all_files,
+    is_temp_file,
+    name_matches,
+    scan_files,
+)
+from .manifest import FingerprintCache, Manifest
+from .metrics import metrics
+from .options import Options
+from .queue import Job, JobDelete, JobQueue, file_job, output_suffix, source_extensions
+from .transfer import TransferStats
+
+# from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_ONLYDIR
+)
+# struct inotify_event without the name that follows it
+EVENT_HEADER = struct.Struct("iIII")
+# Check at least this often (in seconds) if watching should stop
+POLL_INTERVAL = 1.0
+
+
+class WatchError(Exception):
+    pass
+
+
+class Changes:
+    """Paths below src_dir that changed since the last batch"""
+
+    def __init__(self) -> None:
+        # Files that were written, touched or moved in
+        self.files: Set[Path] = set()
+        # New directories, everything in them is new too
+        self.directories: Set[Path] = set()
+        # Files or directories that were deleted or moved away
+        self.removed: Set[Path] = set()
+        # The kernel dropped events, everything has to be rescanned
+        self.overflow = False
+
+    def __bool__(self) -> bool:
+        return bool(self.files or self.directories or self.removed or self.overflow)
+
+    def add(self, path: Path, is_dir: bool):
+        self.removed.discard(path)
+        if is_dir:
+            self.directories.add(path)
+        else:
+            self.files.add(path)
+
+    def remove(self, path: Path):
+        self.files.discard(path)
+        self.directories.discard(path)
+        self.removed.add(path)
+
+
+class Watcher:
+    """Watches a directory tree for changes using inotify.
+
+    Every directory of the tree gets its own watch, new directories are added as
+    they appear.
+    """
+
+    def __init__(self, directory: Path):
+        if not sys.platform.startswith("linux"):
+            raise WatchError("Watching for changes is only supported on Linux.")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise WatchError(f"Could not initialize inotify: {os.strerror(err)}")
+        self._paths: Dict[int, Path] = {}
+        self._stopped = False
+        self.add_tree(directory)
+
+    @property
+    def num_directories(self) -> int:
+        return len(self._paths)
+
+    def add_tree(self, directory: Path):
+        """Watch directory and all directories below it"""
+        pending = [str(directory)]
+        while pending:
+            path = pending.pop()
+            if not self._add_watch(path):
+                continue
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+            except OSError:
+                continue
+
+    def _add_watch(self, path: str) -> bool:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # Removed again in the meantime or not accessible
+                return False
+            if err == errno.ENOSPC:
+                raise WatchError(
+                    "Too many directories to watch, increase"
+                    " fs.inotify.max_user_watches."
+                )
+            raise OSError(err, os.strerror(err), path)
+        self._paths[wd] = Path(path)
+        return True
+
+    def _remove_tree(self, directory: Path):
+        # Watches of moved directories would report wrong paths, so drop them.
+        for wd, path in list(self._paths.items()):
+            if path == directory or directory in path.parents:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._paths[wd]
+
+    def _read_events(self, changes: Changes):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos : pos + length].rstrip(b"\0")
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                changes.overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            parent = self._paths.get(wd)
+            if parent is None or not name:
+                continue
+            path = parent / os.fsdecode(name)
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                if is_dir:
+                    self._remove_tree(path)
+                changes.remove(path)
+            elif is_dir:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files might have been created before the watch was added, so
+                    # the whole directory is treated as new.
+                    self.add_tree(path)
+                    changes.add(path, is_dir=True)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                changes.add(path, is_dir=False)
+
+    def wait(self, debounce: float) -> Optional[Changes]:
+        """Wait for changes and return them once no event came for debounce seconds.
+
+        Every event postpones the batch, including events that are not a change by
+        themselves like writes to a file that is still being copied. Returns None
+        once stop() was called.
+        """
+        changes = Changes()
+        deadline: Optional[float] = None
+        while not self._stopped:
+            timeout = POLL_INTERVAL
+            if deadline is not None:
+                timeout = min(max(deadline - time.monotonic(), 0.0), POLL_INTERVAL)
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if readable:
+                self._read_events(changes)
+                deadline = time.monotonic() + debounce
+            elif deadline is not None and time.monotonic() >= deadline:
+                if changes:
+                    return changes
+                deadline = None
+        return None
+
+    def stop(self):
+        self._stopped = True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def generate_changed_jobs(
+    options: Options,
+    changes: Changes,
+    manifest: Optional[Manifest] = None,
+    art_cache: Optional[AlbumArtCache] = None,
+    transfer_stats: Optional[TransferStats] = None,
+    fingerprints: Optional[FingerprintCache] = None,
+) -> Tuple[List[Job], List[JobDelete]]:
+    """Like generate_jobs, but only looks at the changed files and directories"""
+    extensions = source_extensions(options)
+    extensions_set = set(extensions)
+    allowed_names = set(options.copy_file) if options.copy_file is not None else None
+    stats: Dict[str, os.stat_result] = {}
+    for file in changes.files:
+        if not name_matches(file.name, extensions_set, allowed_names):
+            continue
+        try:
+            if file.is_file():
+                stats[str(file)] = file.lstat()
+        except OSError:
+            continue
+    for directory in changes.directories:
+        scan = scan_files(directory, extensions, options.copy_file, stat=True)
+        stats.update(scan.stats)
+
+    jobs: List[Job] = []
+    for src_file in sorted(stats):
+        _, job = file_job(
+            Path(src_file),
+            options,
+            manifest,
+            stats[src_file],
+            art_cache,
+            transfer_stats,
+            fingerprints,
+        )
+        if job is not None:
+            jobs.append(job)
+    metrics.count("skipped_jobs", len(stats) - len(jobs))
+
+    src_dir = options.src_dir.absolute()
+    dst_dir = options.dst_dir.absolute()
+    # Paths that were moved back or recreated in the meantime are not removed.
+    removed = [
+        path.relative_to(src_dir)
+        for path in sorted(changes.removed)
+        if not os.path.lexists(path)
+    ]
+    if manifest is not None and removed:
+        removed_keys = set(str(relative) for relative in removed)
+        prefixes = tuple(key + os.sep for key in removed_keys)
+        for key in list(manifest.entries):
+            if key in removed_keys or key.startswith(prefixes):
+                manifest.remove(key)
+    # A removed directory and the files in it can be reported at the same time.
+    delete_files: Dict[Path, None] = {}
+    if options.delete:
+        for relative in removed:
+            dst_path = dst_dir / relative
+            if dst_path.is_dir() and not dst_path.is_symlink():
+                for file in get_all_files(dst_path, extensions=None):
+                    if not is_temp_file(file):
+                        delete_files[file] = None
+                continue
+            dst_file = generate_output_path(
+                base=dst_dir,
+                input_suffix=".flac",
+                suffix=output_suffix(options),
+                file=relative,
+            )
+            if dst_file.is_file():
+                delete_files[dst_file] = None
+    jobs_delete = [JobDelete(file) for file in delete_files]
+    return jobs, jobs_delete
+
+
+def watch(watcher: Watcher, job_queue: JobQueue):
+    """Mirror every change reported by watcher until it is stopped"""
+    options = job_queue.options
+    print(
+        f"Watching {options.src_dir} for changes"
+        f" ({watcher.num_directories} directories)..."
+    )
+    try:
+        while True:
+            changes = watcher.wait(options.watch_debounce)
+            if changes is None:
+                break
+            # The metrics report describes the last sync only.
+            metrics.reset()
+            if changes.overflow:
+                print("Too many changes at once, rescanning everything.")
+                watcher.add_tree(options.src_dir.absolute())
+                job_queue.generate()
+            else:
+                with metrics.stage("watch.generate"):
+                    job_queue.set_jobs(
+                        [
+                            generate_changed_jobs(
+                                target,
+                                changes,
+                                manifest,
+                                job_queue.art_cache,
+                                job_queue.transfer_stats,
+                                job_queue.fingerprints,
+                            )
+                            for target, manifest in zip(
+                                job_queue.targets, job_queue.manifests
+                            )
+                        ]
+                    )
+            if job_queue.jobs or job_queue.jobs_delete:
+                job_queue.run()
+            else:
+                job_queue.save_manifest()
+            print("Waiting for changes...")
+    finally:
+        watcher.close()